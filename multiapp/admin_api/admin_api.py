@@ -20,13 +20,20 @@ from safrs import SAFRSBase, SAFRSAPI, jsonapi_rpc, jsonapi_attr, UnAuthorizedEr
 from passlib.apps import custom_app_context as pwd_context
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer, BadSignature, SignatureExpired
 from pathlib import Path
+from sqlalchemy import inspect
 
 db = SQLAlchemy()
-logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger()
 projects_dir = Path(os.environ.get("PROJECTS_DIR","")).resolve()
 
 
+def as_bool(value):
+    """
+        :return: the boolean value of an rpc argument, query string values are strings ("false", "0")
+    """
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
 class User(SAFRSBase, db.Model, UserMixin):
     """
     description: Users
@@ -54,7 +61,6 @@ class User(SAFRSBase, db.Model, UserMixin):
             >> User.query.filter(User.username == 'admin').first().hash_password('newpass')
         """
         if login.current_user != self:
-            log.info("x"*4000)
             raise UnAuthorizedError
         log.info(f"Changing password for {self}")
         self._password_hash = pwd_context.encrypt(password)
@@ -72,7 +78,7 @@ class User(SAFRSBase, db.Model, UserMixin):
             login.login_user(self)
             return True
 
-        log.warning(f"Password verification failed for {self.username} - {password}")
+        log.warning(f"Password verification failed for {self.username}")
         return False
     
     @classmethod
@@ -160,49 +166,155 @@ class Api(SAFRSBase, db.Model):
     port = db.Column(db.Integer, default=5656)
     hostname = db.Column(db.String, default="localhost")
     connection_string = db.Column(db.String, nullable=False)
+    replica_urls = db.Column(db.String, default="") # read replicas of connection_string, one url per line
+    log_level = db.Column(db.String, default="") # DEBUG, INFO, WARNING..., empty: LOG_LEVEL (log_pipeline.py)
     owner_id = db.Column(db.String, db.ForeignKey("Users.id"))
     owner = db.relationship("User", back_populates="apis")
     
     @staticmethod
     @jsonapi_rpc(http_methods=["POST"], valid_jsonapi=False)
-    def test_conn(connection_string = ""):
-        print(connection_string)
-        from sqlalchemy import create_engine, inspect
+    def test_conn(connection_string = "", refresh = False):
+        """
+            description: Test the connection and list the tables, the schema is cached (introspect.py)
+            args:
+                connection_string: sqlalchemy database url
+                refresh: ignore the cached schema
+        """
+        from introspect import introspect, format_tables
         try:
-            engine = create_engine(connection_string)
-            with engine.connect() as conn:
-                pass
-            insp = inspect(engine)
-            tablenames = "\n".join(insp.get_table_names())
-            return f"# Tables:\n{tablenames}" if tablenames else "# Empty DB"
+            return format_tables(introspect(connection_string, refresh=as_bool(refresh)))
         except Exception as exc:
             return str(exc)
 
 
+    @staticmethod
+    @jsonapi_rpc(http_methods=["GET"])
+    def pool_stats(project=None):
+        """
+            description: Database connection pool usage of the worker process serving the request
+            args:
+                project: project name (optional)
+        """
+        from pools import manager
+        return manager.stats(project=project or None)
+
+    @staticmethod
+    @jsonapi_rpc(http_methods=["GET"])
+    def memory_usage():
+        """
+            description: Shared and private memory of the gunicorn master and workers (KiB)
+        """
+        from memory import server_memory
+        return server_memory()
+
+    @staticmethod
+    @jsonapi_rpc(http_methods=["GET"])
+    def project_memory():
+        """
+            description: Memory attributed to the projects by tracemalloc and their mounts and evictions, in the worker process serving the request (mounts.py)
+        """
+        from mounts import stats
+        return stats()
+
+    @staticmethod
+    @jsonapi_rpc(http_methods=["GET"])
+    def resource_cache():
+        """
+            description: Size, hits and misses of the serialized resource object caches of the projects, in the worker process serving the request (resources.py)
+        """
+        from resources import stats
+        return stats()
+
+    @staticmethod
+    @jsonapi_rpc(http_methods=["GET"])
+    def audit_queue():
+        """
+            description: Queued, written and failed audit rows of the projects with AUDIT_MODE async, in the worker process serving the request (audit.py)
+        """
+        from audit import stats
+        return stats()
+
+    @staticmethod
+    @jsonapi_rpc(http_methods=["GET"])
+    def log_stats():
+        """
+            description: Levels, queued, dropped and suppressed log records, in the worker process serving the request (log_pipeline.py)
+        """
+        from log_pipeline import stats
+        return stats()
+
     @jsonapi_rpc(http_methods=["POST"], valid_jsonapi=False)
-    def generate(self):
-        output  = "Creating API"
-        als_args = {
-            "--project_name" : self.name,
-            "--db_url" : self.connection_string,
-            "--port" : str(self.port),
-            "--host" : self.hostname
-        }
-        proc_args = ['ApiLogicServer','create','--multi_api']
-        for a, v in als_args.items():
-            proc_args += [f'{a}={v}']
-        output += " ".join(proc_args)
-        process = subprocess.run(proc_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=projects_dir)
-        #process = subprocess.run(proc_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        output += str(process.stdout)
-        output += "\n\n"
-        output += str(process.stderr)
-        print('OUT '*40)
-        print(output)
-        # restart gunicorn
-        os.kill(os.getppid(), signal.SIGHUP)
+    def generate(self, full = False):
+        """
+            description: Generate the project, only the models of the changed tables are regenerated (regen.py)
+            args:
+                full: regenerate the complete project
+        """
+        from introspect import introspect
+        import regen
+        full = as_bool(full)
+        try:
+            # the schema cached by test_conn, reflected again if it shows no changes: it can predate them
+            schema = introspect(self.connection_string)
+            if schema["cached"] and not full and regen.unchanged(self, schema, projects_dir):
+                schema = introspect(self.connection_string, refresh=True)
+        except Exception as exc:
+            return f"Connection failed: {exc}"
+        result = regen.generate(self, schema, projects_dir, full=full)
+        output = result.report()
+        log.info(output)
+        if result.reload:
+            Api.reload()
         return output
+
+    @jsonapi_rpc(http_methods=["POST"], valid_jsonapi=False)
+    def recompute(self, repair = False, columns = ""):
+        """
+            description: Verify or repair the columns derived by the project rules with set-based SQL (recompute.py)
+            args:
+                repair: update the rows that are out of date
+                columns: comma separated Class.column names, default all derived columns
+        """
+        import recompute
+        columns = [column.strip() for column in (columns or "").split(",") if column.strip()]
+        try:
+            return recompute.recompute_project(self.name, repair=as_bool(repair), columns=columns or None)
+        except KeyError as exc:
+            return str(exc)
+
+    @jsonapi_rpc(http_methods=["GET"])
+    def slow_queries(self, limit = 50):
+        """
+            description: Slow statements of the project with their query plan and the suggested indexes, in the worker process serving the request (slow_queries.py)
+            args:
+                limit: number of statements
+        """
+        import slow_queries
+        try:
+            return slow_queries.report(self.name, limit=int(limit))
+        except KeyError as exc:
+            return str(exc)
+
+    @staticmethod
+    @jsonapi_rpc(http_methods=["POST"])
+    def reload():
+        """
+            description: Replace the server workers one by one, after the new worker has mounted the projects
+        """
+        import rolling
+        if rolling.request_reload():
+            return "Rolling reload requested"
+        # not started by gals.py: restart gunicorn
+        os.kill(os.getppid(), signal.SIGHUP)
+        return "Reload requested (SIGHUP)"
     
+    @property
+    def replica_list(self):
+        """
+            list of read replica urls
+        """
+        return [url.strip() for url in (self.replica_urls or "").replace(",", "\n").splitlines() if url.strip()]
+
     @jsonapi_attr
     def api_path(self):
         """
@@ -217,6 +329,30 @@ class Api(SAFRSBase, db.Model):
         """
         return f"{projects_dir / self.name}"
 
+def upgrade_db():
+    """
+        Add the columns that were added to the models after the admin db was created
+    """
+    insp = inspect(db.engine)
+    for model in (User, Api):
+        existing = {column["name"] for column in insp.get_columns(model.__tablename__)}
+        for column in model.__table__.columns:
+            if column.name in existing:
+                continue
+            col_type = column.type.compile(dialect=db.engine.dialect)
+            log.info(f"Adding column {model.__tablename__}.{column.name}")
+            db.session.execute(f'ALTER TABLE "{model.__tablename__}" ADD COLUMN "{column.name}" {col_type}')
+    db.session.commit()
+
+
+def api_log_levels(app):
+    """
+        :return: project name -> log_level of the Apis
+    """
+    with app.app_context():
+        return dict(db.session.query(Api.name, Api.log_level).all())
+
+
 def create_app(config_filename=None, host="localhost", port="5656", app_prefix="/admin"):
     app = Flask("demo_app")
     admin_db = os.getenv("ADMIN_DB","sqlite:////tmp/admin.db")
@@ -298,18 +434,19 @@ def create_app(config_filename=None, host="localhost", port="5656", app_prefix="
     def init_user():
         user = db.session.query(User).filter_by(username="admin").one_or_none()
         if not user:
-            print('Creating admin user')
+            log.info('Creating admin user')
             user = User(username = "admin", _password_hash = pwd_context.encrypt("p"))
             try:# this try/except is a stupid workaround because I didn't implemented sessions properly
                 # and it behaves differently between werkzeug and gunicorn
                 db.session.add(user)
                 db.session.commit()
             except Exception as exc:
-                print('Commit Failed ', exc)
+                log.error(f'Commit Failed {exc}')
             
 
     with app.app_context():
         db.create_all()
+        upgrade_db()
         init_user()
     
     return app
@@ -317,5 +454,6 @@ def create_app(config_filename=None, host="localhost", port="5656", app_prefix="
 if __name__ == "__main__":
     host = "localhost"
     port = 5656
+    logging.basicConfig(level=logging.DEBUG)
     app = create_app(host=host)
     app.run(host=host, port=5656)
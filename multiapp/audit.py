@@ -0,0 +1,262 @@
+"""
+    Audit trail writes of the projects (eg. the EmployeeAudit rows of the Employee copy_row rule)
+
+    Configured per project in the project config.Config:
+
+        AUDIT_MODE = "async"              # default "sync": the audit rows are inserted in the transaction of the change
+        AUDIT_CLASSES = ["EmployeeAudit"]
+        AUDIT_BATCH_SIZE = 100
+        AUDIT_FLUSH_MS = 500              # max delay of a queued audit row
+        AUDIT_QUEUE_SIZE = 10000
+
+    async: the new rows of the audit classes are taken out of the flush (before_flush, after the LogicBank listeners)
+    with their column values, the foreign keys are taken from the parents they're linked to. Rows linked to parents
+    that are inserted by the same flush stay in the transaction. The rows are queued when the transaction commits
+    (dropped when it's rolled back), the writer thread of the project inserts them in batches of AUDIT_BATCH_SIZE rows,
+    at most AUDIT_FLUSH_MS after the first row of the batch was queued. When the queue is full, the committing
+    thread inserts its rows. The queues are flushed when the worker exits (gunicorn worker_exit, interpreter exit)
+    and when a project is unmounted.
+
+    The audit rows are written after the commit of the change: the rows queued by a process that is killed are lost,
+    and the ids of the audit rows aren't known in the transaction. Deployments that need the audit row in the
+    transaction of the change keep AUDIT_MODE = "sync".
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from sqlalchemy import event, inspect
+from sqlalchemy.orm.interfaces import MANYTOONE
+from blobs import exposed_classes
+
+log = logging.getLogger()
+
+MODES = ("sync", "async")
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_MS = 500
+DEFAULT_QUEUE_SIZE = 10000
+CLOSE_TIMEOUT = 30
+PENDING = "audit_rows"  # session.info key of the rows of the transaction
+STOP = object()
+
+writers = {}  # audit class -> AuditWriter of its project
+projects = {}  # project name -> AuditWriter
+_lock = threading.Lock()
+
+
+class AuditWriter:
+    """
+        Queue of the audit rows of a project and the thread that inserts them in batches
+    """
+
+    def __init__(self, project, engine, batch_size, flush_ms, queue_size):
+        self.project = project
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_ms = flush_ms
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.written = 0
+        self.batches = 0
+        self.direct = 0  # rows inserted by the committing thread (queue full)
+        self.failed = 0
+        self.closed = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # (re)start the thread: threads don't survive the fork of the gunicorn workers
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name=f"audit-{self.project}", daemon=True)
+                self._thread.start()
+
+    def put(self, rows):
+        """
+            Queue the (table, values) audit rows of a committed transaction
+        """
+        if self.closed:
+            self.write(rows)
+            return
+        self.start()
+        overflow = []
+        for row in rows:
+            try:
+                self.queue.put_nowait(row)
+            except queue.Full:
+                overflow.append(row)
+        if overflow:
+            self.direct += len(overflow)
+            self.write(overflow)
+
+    def run(self):
+        while True:
+            row = self.queue.get()
+            batch = [] if row is STOP else [row]
+            deadline = time.monotonic() + self.flush_ms / 1000
+            while row is not STOP and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    row = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if row is not STOP:
+                    batch.append(row)
+            if batch:
+                self.write(batch)
+            for _ in range(len(batch) + (row is STOP)):
+                self.queue.task_done()
+            if row is STOP:
+                return
+
+    def write(self, rows, retries=1):
+        """
+            Insert the audit rows in a transaction
+        """
+        statements = {}  # (table, columns) -> values, the rows of an executemany have the same columns
+        for table, values in rows:
+            statements.setdefault((table, tuple(sorted(values))), []).append(values)
+        try:
+            with self.engine.begin() as connection:
+                for (table, columns), values in statements.items():
+                    connection.execute(table.insert(), values)
+        except Exception as exc:
+            if retries:
+                time.sleep(0.5)
+                return self.write(rows, retries - 1)
+            self.failed += len(rows)
+            log.error(f"{self.project}: failed to write {len(rows)} audit rows: {exc} {[values for table, values in rows]}")
+            return
+        self.written += len(rows)
+        self.batches += 1
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """
+            Write the queued rows and stop the thread
+        """
+        self.closed = True
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        try:
+            self.queue.put(STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        thread.join(timeout)
+        if thread.is_alive():
+            log.warning(f"{self.project}: {self.queue.qsize()} audit rows not written after {timeout}s")
+
+    def to_dict(self):
+        return {
+            "project": self.project,
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "batches": self.batches,
+            "direct": self.direct,
+            "failed": self.failed,
+        }
+
+
+def audit_values(instance):
+    """
+        :return: the column values of a new audit row, with the foreign keys of its parents,
+                 None if a parent is inserted by the flush (its key isn't known yet)
+    """
+    mapper = inspect(instance).mapper
+    state = instance.__dict__
+    values = {prop.columns[0].key: state[prop.key] for prop in mapper.column_attrs if prop.key in state}
+    for relationship in mapper.relationships:
+        related = state.get(relationship.key)
+        if not related:
+            continue
+        if relationship.direction is not MANYTOONE:
+            return None
+        parent_state = inspect(related)
+        if parent_state.key is None:
+            return None
+        for local, remote in relationship.local_remote_pairs:
+            values[local.key] = getattr(related, parent_state.mapper.get_property_by_column(remote).key)
+    return values
+
+
+def before_flush(session, flush_context, instances):
+    """
+        Take the new audit rows of the async projects out of the flush
+    """
+    for instance in list(session.new):
+        writer = writers.get(type(instance))
+        if writer is None:
+            continue
+        values = audit_values(instance)
+        if values is None:
+            continue
+        for relationship in inspect(instance).mapper.relationships:
+            if instance.__dict__.get(relationship.key) is not None:
+                setattr(instance, relationship.key, None)  # removes the row from the collection of its parent
+        session.expunge(instance)
+        session.info.setdefault(PENDING, []).append((writer, instance.__table__, values))
+
+
+def after_commit(session):
+    rows = {}
+    for writer, table, values in session.info.pop(PENDING, []):
+        rows.setdefault(writer, []).append((table, values))
+    for writer, writer_rows in rows.items():
+        writer.put(writer_rows)
+
+
+def after_rollback(session):
+    session.info.pop(PENDING, None)
+
+
+def install_audit(app, db):
+    """
+        Write the audit rows of the project app with a background writer (AUDIT_MODE = "async")
+    """
+    mode = app.config.get("AUDIT_MODE", "sync")
+    if mode not in MODES:
+        log.warning(f"{app.name}: invalid AUDIT_MODE {mode}, using sync")
+        return app
+    if mode == "sync":
+        return app
+    writer = AuditWriter(app.name, db.get_engine(app),
+                         batch_size=int(app.config.get("AUDIT_BATCH_SIZE", DEFAULT_BATCH_SIZE)),
+                         flush_ms=float(app.config.get("AUDIT_FLUSH_MS", DEFAULT_FLUSH_MS)),
+                         queue_size=int(app.config.get("AUDIT_QUEUE_SIZE", DEFAULT_QUEUE_SIZE)))
+    classes = {cls._s_type: cls for cls in exposed_classes(app)}
+    for name in app.config.get("AUDIT_CLASSES", []):
+        if name not in classes:
+            log.warning(f"{app.name}: audit class {name} is not exposed")
+            continue
+        writers[classes[name]] = writer
+    projects[app.name] = writer
+    with _lock:
+        # the listeners run after the LogicBank listeners (copy_row inserts), registered once by the first project (mounts.py)
+        for event_name, listener in (("before_flush", before_flush), ("after_commit", after_commit), ("after_rollback", after_rollback)):
+            if event.contains(db.session, event_name, listener):
+                event.remove(db.session, event_name, listener)
+            event.listen(db.session, event_name, listener)
+    log.info(f"{app.name}: async audit of {', '.join(cls.__name__ for cls, cls_writer in writers.items() if cls_writer is writer)}")
+    return app
+
+
+def close(project=None):
+    """
+        Write the queued audit rows of a project (all projects if project is None)
+    """
+    for name, writer in list(projects.items()):
+        if project is None or name == project:
+            writer.close()
+            if project is not None:
+                projects.pop(name, None)
+                for cls in [cls for cls, cls_writer in writers.items() if cls_writer is writer]:
+                    writers.pop(cls, None)
+
+
+def stats():
+    return [writer.to_dict() for writer in projects.values()]
+
+
+atexit.register(close)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+JSON encoder benchmark
+
+Encodes the json:api collections of the Northwind models (db2 project, example.nw.db.sqlite) with the
+project encoder (json) and with the fast_json.py orjson backend, the way jsonify encodes the responses,
+and compares the speed and the output.
+
+    python bench_json.py --limit 1000 --repeat 5
+"""
+import argparse
+import importlib.util
+import json
+import time
+from pathlib import Path
+from flask import Flask
+from flask.json import dumps
+from safrs import SAFRSAPI, SAFRSBase, DB as db
+from safrs.jsonapi_formatting import jsonapi_format_response
+import fast_json
+import wrappers
+
+default_db = Path(__file__).parent.resolve().parent / "example.nw.db.sqlite"
+models_py = Path(__file__).parent.resolve() / "db2/database/models.py"
+
+
+def create_bench_app(db_fn):
+    spec = importlib.util.spec_from_file_location("models", models_py)
+    models = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(models)
+    app = Flask("bench_json")
+    app.config.update(SQLALCHEMY_DATABASE_URI=f"sqlite:///{db_fn}", SQLALCHEMY_TRACK_MODIFICATIONS=False)
+    db.init_app(app)
+    classes = [cls for cls in vars(models).values() if isinstance(cls, type) and issubclass(cls, SAFRSBase) and cls is not SAFRSBase]
+    with app.app_context():
+        api = SAFRSAPI(app, host="localhost", port=5656, prefix="/api")
+        for cls in classes:
+            api.expose_object(cls)
+    wrappers.register(app)  # the attribute values of the orjson backend (fast_json.py)
+    fast_json.install_json(app)
+    return app, classes
+
+
+def encode(app, payload, encoder):
+    app.json_encoder = encoder
+    return dumps(payload, separators=(",", ":"))  # jsonify (not pretty printed)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="JSON encoder benchmark")
+    argparser.add_argument("--db", default=str(default_db), help="Northwind sqlite database")
+    argparser.add_argument("-l", "--limit", default=1000, type=int, help="Rows per collection")
+    argparser.add_argument("-r", "--repeat", default=5, type=int, help="Encodings per collection and encoder")
+    args = argparser.parse_args()
+    if fast_json.orjson is None:
+        raise SystemExit("orjson is not installed")
+
+    app, classes = create_bench_app(args.db)
+    encoder = app.json_encoder
+    orjson_encoder = fast_json.fast_encoder(encoder)
+    results = []
+    for cls in sorted(classes, key=lambda cls: cls.__name__):
+        with app.test_request_context(f"/api/{cls._s_collection_name}?page[limit]={args.limit}"):
+            app.preprocess_request()  # safrs before_request: g.ja_data, g.ja_included
+            instances = cls._s_query.limit(args.limit).all()
+            payload = jsonapi_format_response(instances, count=len(instances), links={"self": f"/api/{cls._s_collection_name}"})
+            timings = {}
+            outputs = {}
+            for name, cls_encoder in (("json", encoder), ("orjson", orjson_encoder)):
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    outputs[name] = encode(app, payload, cls_encoder)
+                timings[name] = (time.perf_counter() - start) / args.repeat
+        if outputs["json"] == outputs["orjson"]:
+            compatible = "identical"
+        elif json.loads(outputs["json"]) == json.loads(outputs["orjson"]):
+            compatible = "equal"
+        else:
+            compatible = "DIFFERENT"
+        results.append((cls.__name__, len(instances), len(outputs["json"]), timings["json"], timings["orjson"], compatible))
+    app.json_encoder = encoder
+
+    print(f"\n{'collection':<22}{'rows':>6}{'bytes':>10}{'json ms':>10}{'orjson ms':>11}{'speedup':>9}  output")
+    for name, rows, size, json_s, orjson_s, compatible in results:
+        print(f"{name:<22}{rows:>6}{size:>10}{json_s * 1000:>10.1f}{orjson_s * 1000:>11.1f}{json_s / orjson_s:>8.2f}x  {compatible}")
+    json_total, orjson_total = sum(result[3] for result in results), sum(result[4] for result in results)
+    print(f"{'total':<22}{sum(result[1] for result in results):>6}{sum(result[2] for result in results):>10}"
+          f"{json_total * 1000:>10.1f}{orjson_total * 1000:>11.1f}{json_total / orjson_total:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+SQLite profile benchmark
+
+Compares read and write throughput on a scratch copy of example.nw.db.sqlite
+with the default engine settings (NullPool, rollback journal) and with the sqlite_profile.py settings.
+
+    python bench_sqlite.py --threads 4 --duration 10
+"""
+import argparse
+import random
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+import sqlite_profile
+
+default_db = Path(__file__).parent.resolve().parent / "example.nw.db.sqlite"
+
+READS = [
+    "SELECT * FROM Customer WHERE Id = :id",
+    'SELECT o.*, d.* FROM "Order" o JOIN OrderDetail d ON d.OrderId = o.Id WHERE o.CustomerId = :id',
+    "SELECT * FROM Product WHERE CategoryId = :cat ORDER BY UnitPrice LIMIT 25",
+]
+WRITE = "UPDATE Product SET UnitsInStock = UnitsInStock + 1 WHERE Id = :pid"
+
+
+def create_bench_engine(db_fn, profile=None):
+    url = f"sqlite:///{db_fn}"
+    if profile is None:
+        # what flask_sqlalchemy creates for a sqlite file without SQLITE_PROFILE
+        return create_engine(url, poolclass=NullPool, connect_args={"check_same_thread": False})
+    engine = create_engine(url, **sqlite_profile.engine_options(profile))
+    return sqlite_profile.listen(engine, profile)
+
+
+def run(engine, workload, threads, duration, keys):
+    counts = [0] * threads
+    errors = [0] * threads
+    stop_at = time.time() + duration
+
+    def worker(index):
+        rnd = random.Random(index)
+        while time.time() < stop_at:
+            try:
+                if workload == "read" or (workload == "mixed" and rnd.random() < 0.8):
+                    query = rnd.choice(READS)
+                    params = {"id": rnd.choice(keys["customer"]), "cat": rnd.choice(keys["category"])}
+                    with engine.connect() as conn:
+                        conn.execute(text(query), params).fetchall()
+                else:
+                    with engine.begin() as conn:
+                        conn.execute(text(WRITE), {"pid": rnd.choice(keys["product"])})
+                counts[index] += 1
+            except Exception:
+                errors[index] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return sum(counts) / duration, sum(errors)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="SQLite profile benchmark")
+    argparser.add_argument("--db", default=str(default_db), help="Sqlite database (a scratch copy is used)")
+    argparser.add_argument("-t", "--threads", default=4, type=int)
+    argparser.add_argument("-d", "--duration", default=5, type=float, help="Seconds per workload")
+    args = argparser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="alsdock-bench-"))
+    try:
+        results = {}
+        for name, profile in (("default", None), ("profile", dict(sqlite_profile.DEFAULT_PROFILE))):
+            db_fn = workdir / f"{name}.sqlite"
+            shutil.copyfile(args.db, db_fn)
+            engine = create_bench_engine(db_fn, profile)
+            with engine.connect() as conn:
+                keys = {
+                    "customer": [row[0] for row in conn.execute(text("SELECT Id FROM Customer"))],
+                    "category": [row[0] for row in conn.execute(text("SELECT Id FROM Category"))],
+                    "product": [row[0] for row in conn.execute(text("SELECT Id FROM Product"))],
+                }
+            for workload in ("read", "write", "mixed"):
+                results[(name, workload)] = run(engine, workload, args.threads, args.duration, keys)
+            engine.dispose()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\n{'workload':<10}{'default ops/s':>16}{'profile ops/s':>16}{'speedup':>10}{'errors':>10}")
+    for workload in ("read", "write", "mixed"):
+        default_ops, default_err = results[("default", workload)]
+        profile_ops, profile_err = results[("profile", workload)]
+        speedup = profile_ops / default_ops if default_ops else 0
+        print(f"{workload:<10}{default_ops:>16.1f}{profile_ops:>16.1f}{speedup:>9.2f}x{default_err + profile_err:>10}")
+
+
+if __name__ == "__main__":
+    main()
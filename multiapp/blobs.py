@@ -0,0 +1,230 @@
+"""
+    Binary (LargeBinary) columns served from their own endpoint
+
+    The json:api attribute of a binary column (Employee.Photo) is replaced by the url of the column
+    endpoint, /api/Employee/{id}/Photo, or null if the column is NULL. The blob isn't loaded or encoded
+    to serialize the resource: a "<column> IS NOT NULL" column_property is loaded instead.
+    The endpoint returns the bytes (404 if the column is empty):
+    * content type from the column info ({"mimetype": ...}) or the magic bytes of the content
+    * ETag (If-None-Match: 304) and Range (206) requests, the body is sent in chunks
+    * blobs are cached in memory (per worker process) up to BLOB_CACHE_BYTES (default 64MiB) in total,
+      blobs larger than BLOB_CACHE_MAX_ITEM (default 1/8 of the budget) aren't cached. Cached blobs are
+      evicted when the row is updated or deleted in this process and after BLOB_CACHE_TTL seconds
+      (default 60, for changes made by other processes). The cache usage is available at /<project>/blob_stats
+"""
+import collections
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from flask import abort, has_request_context, request, send_file, url_for
+from sqlalchemy import LargeBinary, event
+from sqlalchemy.orm import column_property
+from sqlalchemy.orm.exc import UnmappedColumnError
+
+log = logging.getLogger()
+
+BLOB_CACHE_BYTES = int(os.getenv("BLOB_CACHE_BYTES", 64 * 1024 * 1024))
+BLOB_CACHE_MAX_ITEM = int(os.getenv("BLOB_CACHE_MAX_ITEM", BLOB_CACHE_BYTES // 8))
+BLOB_CACHE_TTL = float(os.getenv("BLOB_CACHE_TTL", 60))
+
+SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"%PDF-", "application/pdf"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"PK\x03\x04", "application/zip"),
+)
+
+linked_columns = {}  # class -> {field name: (endpoint, mapper key, mapper key of the IS NOT NULL flag)} of the binary columns with an endpoint
+
+
+def mimetype(column, data):
+    if column.info.get("mimetype"):
+        return column.info["mimetype"]
+    if data[8:12] == b"WEBP" and data.startswith(b"RIFF"):
+        return "image/webp"
+    for signature, content_type in SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    return "application/octet-stream"
+
+
+class BlobCache:
+    """
+        LRU cache of blobs with a byte budget
+    """
+
+    def __init__(self, budget=BLOB_CACHE_BYTES, max_item=BLOB_CACHE_MAX_ITEM, ttl=BLOB_CACHE_TTL):
+        self.budget = budget
+        self.max_item = max_item
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()  # key -> (data, etag, mimetype, expires)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[3] < time.time():
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item
+
+    def put(self, key, data, etag, content_type):
+        item = (data, etag, content_type, time.time() + self.ttl)
+        if len(data) > self.max_item:
+            return item
+        with self._lock:
+            self._discard(key)
+            self._items[key] = item
+            self.size += len(data)
+            while self.size > self.budget:
+                self._discard(next(iter(self._items)))
+        return item
+
+    def _discard(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.size -= len(item[0])
+
+    def evict(self, key_prefix):
+        """
+            Remove the blobs of all columns of a row, key_prefix: (class, id)
+        """
+        with self._lock:
+            for key in [key for key in self._items if key[:2] == key_prefix]:
+                self._discard(key)
+
+    def evict_class(self, cls):
+        with self._lock:
+            for key in [key for key in self._items if key[0] is cls]:
+                self._discard(key)
+
+    def stats(self):
+        return {"items": len(self._items), "bytes": self.size, "budget": self.budget, "hits": self.hits, "misses": self.misses}
+
+
+cache = BlobCache()
+
+
+def blob_response(cls, key, column, object_id):
+    cache_key = (cls, object_id, key)
+    item = cache.get(cache_key)
+    if item is None:
+        query = cls._s_get_instance_by_id(object_id)
+        row = query.with_entities(getattr(cls, key)).first() if query is not None else None
+        if row is None or row[0] is None:
+            abort(404)
+        data = bytes(row[0])
+        item = cache.put(cache_key, data, hashlib.sha1(data).hexdigest(), mimetype(column, data))
+    data, etag, content_type, _ = item
+    response = send_file(io.BytesIO(data), mimetype=content_type, etag=etag, conditional=True, max_age=0)
+    response.headers["Cache-Control"] = "no-cache"  # revalidate with the etag
+    response.headers.setdefault("Accept-Ranges", "bytes")
+    return response
+
+
+def binary_columns(cls):
+    """
+        :return: {field name: (mapper key, column)} of the binary jsonapi attributes of cls
+    """
+    result = {}
+    for name, column in cls._s_jsonapi_attrs.items():
+        if isinstance(getattr(column, "type", None), LargeBinary):
+            try:
+                result[name] = (cls.__mapper__.get_property_by_column(column).key, column)
+            except UnmappedColumnError:
+                pass
+    return result
+
+
+def install_blob_endpoints(app, api_prefix="/api"):
+    """
+        Add an endpoint for the binary columns of the classes exposed by the project app
+    """
+    for cls in exposed_classes(app):
+        columns = binary_columns(cls)
+        for name, (key, column) in columns.items():
+            endpoint = f"blob_{cls._s_type}_{name}"
+            app.add_url_rule(f"{api_prefix}/{cls._s_collection_name}/<path:object_id>/{name}", endpoint=endpoint,
+                             view_func=lambda object_id, cls=cls, key=key, column=column: blob_response(cls, key, column, object_id))
+            # "_" prefix: safrs doesn't expose the flag as an attribute
+            flag = f"_{key}_is_set"
+            cls.__mapper__.add_property(flag, column_property(column.isnot(None).label(flag)))
+            linked_columns.setdefault(cls, {})[name] = (endpoint, key, flag)
+        if columns:
+            event.listen(cls, "after_update", evict_row)
+            event.listen(cls, "after_delete", evict_row)
+            log.info(f"{app.name}: blob endpoints for {cls.__name__}.{', '.join(columns)}")
+
+    @app.route("/blob_stats")
+    def blob_stats():
+        return cache.stats()
+
+    return app
+
+
+def exposed_classes(app):
+    """
+        :return: the SAFRSBase classes exposed by the safrs api of app
+    """
+    classes = set()
+    for view_func in app.view_functions.values():
+        cls = getattr(getattr(view_func, "view_class", None), "SAFRSObject", None)
+        if getattr(cls, "__mapper__", None) is not None:
+            classes.add(cls)
+    return classes
+
+
+def evict_row(mapper, connection, target):
+    cache.evict((type(target), str(target.jsonapi_id)))
+
+
+def is_set(instance, key, flag):
+    """
+        :return: False if the binary column key of instance is NULL
+    """
+    if key in instance.__dict__:
+        return instance.__dict__[key] is not None  # loaded or set in the session
+    return bool(getattr(instance, flag))
+
+
+def linked_attrs(fget):
+    """
+        Wrap the SAFRSBase._s_jsonapi_attrs getter: serialize the binary columns as the url of their endpoint
+    """
+    def _s_jsonapi_attrs(self):
+        linked = linked_columns.get(type(self))
+        if not linked or not has_request_context() or getattr(request, "fields", None) is None:
+            return fget(self)
+        type_name = self._s_class_name
+        requested = request.fields.get(type_name)
+        names = requested if requested is not None else list(type(self)._s_jsonapi_attrs.keys())
+        # serialize the other attributes without loading the blobs
+        request.fields[type_name] = [name for name in names if name not in linked]
+        try:
+            result = fget(self)
+        finally:
+            if requested is None:
+                del request.fields[type_name]
+            else:
+                request.fields[type_name] = requested
+        for name in names:
+            if name in linked:
+                endpoint, key, flag = linked[name]
+                result[name] = url_for(endpoint, object_id=self.jsonapi_id, _external=True) if is_set(self, key, flag) else None
+        return result
+
+    _s_jsonapi_attrs.__wrapped__ = fget
+    return _s_jsonapi_attrs
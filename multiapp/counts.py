@@ -0,0 +1,183 @@
+"""
+    Count strategies for the paginated json:api collections of the projects
+
+    safrs runs a COUNT(*) of the (filtered) collection query for every page (meta.count and the
+    pagination links), on big tables the count can cost more than the page. The strategy is configured
+    per project and exposed model (type name) in the project config:
+
+        COUNT_STRATEGY = "exact"                                          # default for all models
+        COUNT_STRATEGIES = {"OrderDetail": "estimated", "Order": "cached"}
+        COUNT_CACHE_TTL = 60                                              # seconds
+
+    * exact: COUNT(*) of the query for every request
+    * cached: the count is cached per model and filter arguments for COUNT_CACHE_TTL seconds, writes
+      to the model in this worker process invalidate the cached counts of the model
+    * estimated: unfiltered collections use the row count statistics of the database (sqlite_stat1
+      after ANALYZE, pg_class.reltuples, information_schema.TABLES...), cached like above. Filtered
+      collections or tables without statistics fall back to "cached". The "last" link is approximate.
+
+    Clients can opt out of the count with `page[count]=false`: instead of the count the query only
+    probes the row after the page. meta.count is then a lower bound (offset + limit + 1 if there are more rows),
+    the "last" link points to the next page.
+"""
+import logging
+import threading
+import time
+from flask import current_app, g, has_request_context, request
+from safrs.config import get_config
+from sqlalchemy import event, text
+from sqlalchemy.orm import Query
+from blobs import exposed_classes
+
+log = logging.getLogger()
+
+STRATEGIES = ("exact", "cached", "estimated")
+DEFAULT_TTL = 60
+
+ESTIMATE_SQL = {
+    "sqlite": "SELECT stat FROM sqlite_stat1 WHERE tbl = :table ORDER BY idx IS NULL DESC LIMIT 1",
+    "postgresql": "SELECT reltuples FROM pg_class WHERE oid = to_regclass(:table)",
+    "mysql": "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table",
+    "mssql": "SELECT SUM(rows) FROM sys.partitions WHERE object_id = OBJECT_ID(:table) AND index_id IN (0, 1)",
+    "oracle": "SELECT num_rows FROM user_tables WHERE table_name = UPPER(:table)",
+}
+
+
+class CountCache:
+    """
+        Counts per (class, filter signature), invalidated by the writes to the class
+    """
+
+    def __init__(self):
+        self.generations = {}  # class -> number of writes
+        self._counts = {}  # (class, signature) -> (count, generation, expires)
+        self._lock = threading.Lock()
+
+    def get(self, cls, signature):
+        with self._lock:
+            entry = self._counts.get((cls, signature))
+            if entry is None or entry[1] != self.generations.get(cls, 0) or entry[2] < time.time():
+                return None
+            return entry[0]
+
+    def put(self, cls, signature, count, ttl):
+        with self._lock:
+            self._counts[(cls, signature)] = (count, self.generations.get(cls, 0), time.time() + ttl)
+
+    def invalidate(self, cls):
+        with self._lock:
+            self.generations[cls] = self.generations.get(cls, 0) + 1
+            for key in [key for key in self._counts if key[0] is cls]:
+                del self._counts[key]
+
+
+cache = CountCache()
+
+
+def count_strategy(cls):
+    config = current_app.config
+    strategy = (config.get("COUNT_STRATEGIES") or {}).get(cls._s_type, config.get("COUNT_STRATEGY", "exact"))
+    if strategy not in STRATEGIES:
+        log.warning(f"Invalid count strategy {strategy} for {cls._s_type}")
+        return "exact"
+    return strategy
+
+
+def filter_signature():
+    """
+        :return: the filter (and search) arguments of the request, the count doesn't depend on the others (page, sort, include...)
+    """
+    return tuple(sorted((arg, value) for arg, value in request.args.items(multi=True)
+                        if arg in ("filter", "search") or arg.startswith("filter[")))
+
+
+def estimate(cls, query):
+    """
+        :return: row count of the table of cls from the database statistics, None if there are none
+    """
+    connection = query.session.connection()
+    sql = ESTIMATE_SQL.get(connection.dialect.name)
+    if sql is None:
+        return None
+    try:
+        value = connection.execute(text(sql), {"table": cls.__table__.name}).scalar()
+    except Exception as exc:
+        log.debug(f"No count estimate for {cls.__table__.name}: {exc}")
+        return None
+    if value is None:
+        return None
+    if isinstance(value, str):  # sqlite_stat1: "<rows> <rows per key>..."
+        value = value.split()[0]
+    value = int(float(value))
+    return value if value >= 0 else None  # postgresql: -1 if the table was never analyzed
+
+
+def bounded_count(query):
+    """
+        Count the rows of the page and probe the row after it: a lower bound, offset + limit + 1 if there are more rows
+    """
+    limit = max(1, min(request.page_limit, get_config("MAX_PAGE_LIMIT")))
+    offset = max(0, request.page_offset)
+    return offset + query.offset(offset).limit(limit + 1).count()
+
+
+def count(cls, query):
+    """
+        :return: the count of the collection query according to the strategy, None for an exact count by safrs
+    """
+    if request.args.get("page[count]", "").lower() in ("false", "0", "none"):
+        return bounded_count(query)
+    strategy = count_strategy(cls)
+    if strategy == "exact":
+        return None
+    signature = filter_signature()
+    result = cache.get(cls, signature)
+    if result is not None:
+        return result
+    if strategy == "estimated" and not signature:
+        result = estimate(cls, query)
+    if result is None:
+        result = query.count()
+    cache.put(cls, signature, result, current_app.config.get("COUNT_CACHE_TTL", DEFAULT_TTL))
+    return result
+
+
+def counted_get(get):
+    """
+        Wrap SAFRSBase._s_get: keep the collection query of the request for _s_count
+    """
+    def _s_get(cls, **kwargs):
+        result = get(cls, **kwargs)
+        if has_request_context():
+            g.count_query = (cls, result)
+        return result
+
+    _s_get.__wrapped__ = get
+    return _s_get
+
+
+def counted(s_count):
+    """
+        Wrap SAFRSBase._s_count (the count used by safrs for the pagination)
+    """
+    def _s_count(cls):
+        cls_query = g.get("count_query") if has_request_context() else None
+        if cls_query is None or cls_query[0] is not cls or not isinstance(cls_query[1], Query):
+            return s_count(cls)
+        return count(cls, cls_query[1])
+
+    _s_count.__wrapped__ = s_count
+    return _s_count
+
+
+def install_counts(app):
+    """
+        Invalidate the cached counts when the models of the project app are written (wrappers.py: count strategies)
+    """
+    def invalidate(mapper, connection, target):
+        cache.invalidate(type(target))
+
+    for cls in exposed_classes(app):
+        for event_name in ("after_insert", "after_update", "after_delete"):
+            event.listen(cls, event_name, invalidate)
+    return app
@@ -53,6 +53,44 @@ class Config:
 
     # override SQLALCHEMY_DATABASE_URI here as required
 
+    # opt-in sqlite pragmas (WAL, mmap, cache...) when the project is served by the multiapp
+    # True for the defaults in multiapp/sqlite_profile.py, or a dict to override them, eg.
+    # SQLITE_PROFILE = {"mmap_size": 512 * 1024 * 1024, "synchronous": "FULL"}
+    SQLITE_PROFILE = False
+
+    # count strategy of the paginated collections (multiapp/counts.py): exact, cached or estimated,
+    # per model type in COUNT_STRATEGIES, eg. {"OrderDetail": "estimated"}
+    COUNT_STRATEGY = "exact"
+    COUNT_STRATEGIES = {}
+    COUNT_CACHE_TTL = 60
+
+    # full text search index of the `search: true` attributes of ui/admin/admin.yaml (multiapp/search.py),
+    # True or a dict {type name: [attribute names]}, queried with the search= parameter of the collections
+    SEARCH_INDEX = False
+
+    # filter= expressions on unindexed attributes (multiapp/filters.py): "warn", "reject" (400) or "allow"
+    FILTER_UNINDEXED = "warn"
+
+    # statements slower than SLOW_QUERY_MS are logged with their query plan (multiapp/slow_queries.py, admin api
+    # Apis/{id}/slow_queries), 0 disables the log
+    SLOW_QUERY_MS = 200
+    SLOW_QUERY_LOG_SIZE = 100
+    # keep the parameter values of the slow statements (they can contain personal data), default: their number and types
+    SLOW_QUERY_PARAMETERS = False
+
+    # encoder of the responses (multiapp/fast_json.py): "json" or "orjson" (faster, requires the orjson package)
+    JSON_BACKEND = "json"
+
+    # LRU cache of the serialized resource objects (multiapp/resources.py): rows per worker process, 0 disables it
+    SERIALIZATION_CACHE_SIZE = 10000
+
+    # audit rows (AUDIT_CLASSES, eg. the EmployeeAudit rows of an Employee copy_row rule): "sync", inserted in the
+    # transaction of the change, or "async", written in batches after the commit by a background writer (multiapp/audit.py)
+    AUDIT_MODE = "sync"
+    AUDIT_CLASSES = ["EmployeeAudit"]
+    AUDIT_BATCH_SIZE = 100
+    AUDIT_FLUSH_MS = 500
+
     app_logger.info(f'config.py - SQLALCHEMY_DATABASE_URI: {SQLALCHEMY_DATABASE_URI}')
 
     # SQLALCHEMY_ECHO = environ.get("SQLALCHEMY_ECHO")
@@ -0,0 +1,144 @@
+"""
+    Fast json encoding of the project responses (orjson)
+
+    Enabled per project in the project config.Config:
+
+        JSON_BACKEND = "orjson"  # default "json"
+
+    flask (jsonify) serializes the responses with app.json_encoder, the orjson backend replaces its encode():
+    the structure is encoded by orjson, the values orjson doesn't encode like safrs (Decimal, datetime, date,
+    time, UUID, sqlalchemy_utils Choice) are converted by a lookup of their type and the other objects
+    (SAFRSBase instances, Included...) by the default() of the project encoder. safrs encodes and decodes every
+    attribute value with the app encoder (SAFRSBase._s_jsonapi_attrs), the values of these types are converted
+    by their type instead.
+
+    The output is the output of the json encoder (compact separators, JSON_SORT_KEYS, JSON_AS_ASCII), except for:
+    * floats in exponent notation: 1e16 instead of 1e+16
+    * NaN and Infinity: null
+    Indented output (debug, JSONIFY_PRETTYPRINT_REGULAR), integers over 64 bits and keys that aren't strings
+    use the json encoder.
+
+    Benchmark: python bench_json.py
+"""
+import datetime
+import decimal
+import json
+import logging
+import re
+from uuid import UUID
+from flask import current_app, has_app_context, has_request_context, request
+
+try:
+    import orjson
+except ImportError:  # orjson not installed
+    orjson = None
+
+log = logging.getLogger()
+
+BACKENDS = ("json", "orjson")
+NATIVE_TYPES = {str, int, float, bool, type(None)}
+NOT_ASCII = re.compile(r"[^\x00-\x7e]")  # json escapes DEL too
+
+# conversions of SAFRSJSONEncoder.default
+FAST_TYPES = {
+    decimal.Decimal: float,
+    datetime.datetime: lambda obj: obj.isoformat(" "),
+    datetime.date: datetime.date.isoformat,
+    datetime.time: datetime.time.isoformat,
+    UUID: str,
+}
+try:
+    from sqlalchemy_utils.types.choice import Choice
+    FAST_TYPES[Choice] = lambda obj: obj.code  # api/json_encoder.py SAFRSJSONEncoderExt
+except ImportError:
+    pass
+
+
+def escape(match):
+    code = ord(match.group())
+    if code < 0x10000:
+        return f"\\u{code:04x}"
+    code -= 0x10000
+    return f"\\u{0xd800 | (code >> 10):04x}\\u{0xdc00 | (code & 0x3ff):04x}"
+
+
+def ensure_ascii(text):
+    """
+        Escape the characters that aren't ascii like json.dumps(ensure_ascii=True)
+    """
+    if text.isascii() and "\x7f" not in text:
+        return text
+    return NOT_ASCII.sub(escape, text)
+
+
+class OrjsonEncoderMixin:
+    """
+        encode() of a json.JSONEncoder (subclass) with orjson
+    """
+
+    def encode(self, obj):
+        if self.indent is not None or self.item_separator != "," or self.key_separator != ":":
+            return super().encode(obj)
+        option = orjson.OPT_PASSTHROUGH_DATETIME | (orjson.OPT_SORT_KEYS if self.sort_keys else 0)
+        try:
+            result = orjson.dumps(obj, default=self.fast_default, option=option).decode()
+        except orjson.JSONEncodeError:
+            return super().encode(obj)
+        return ensure_ascii(result) if self.ensure_ascii else result
+
+    def fast_default(self, obj):
+        convert = FAST_TYPES.get(type(obj))
+        return convert(obj) if convert is not None else self.default(obj)
+
+
+def fast_encoder(encoder):
+    """
+        :return: subclass of the json encoder class encoder that encodes with orjson
+    """
+    return type(f"Orjson{encoder.__name__}", (OrjsonEncoderMixin, encoder), {})
+
+
+def fast_attrs(fget):
+    """
+        Wrap the SAFRSBase._s_jsonapi_attrs getter: with the orjson backend, convert the attribute values by type
+        instead of json.loads(json.dumps(value))
+    """
+    def _s_jsonapi_attrs(self):
+        if not has_app_context() or not issubclass(current_app.json_encoder, OrjsonEncoderMixin):
+            return fget(self)
+        names = type(self)._s_jsonapi_attrs.keys()
+        fields = request.fields.get(self._s_class_name, names) if has_request_context() else names
+        allowed = {name for name in names if self._s_check_perm(name)}
+        result = {}
+        for name in fields:
+            value = ""
+            if name in allowed:
+                value = getattr(self, name) if hasattr(self, name) else getattr(self, self.colname_to_attrname(name))
+            if type(value) in NATIVE_TYPES:
+                result[name] = value
+            elif type(value) in FAST_TYPES:
+                result[name] = FAST_TYPES[type(value)](value)
+            else:
+                try:
+                    result[name] = json.loads(json.dumps(value, cls=current_app.json_encoder))
+                except Exception as exc:
+                    log.warning(f"Failed to fetch {self}.{name}: {exc}")
+        return result
+
+    _s_jsonapi_attrs.__wrapped__ = fget
+    return _s_jsonapi_attrs
+
+
+def install_json(app):
+    """
+        Encode the responses of the project app with the JSON_BACKEND of its config
+    """
+    backend = app.config.get("JSON_BACKEND", "json")
+    if backend not in BACKENDS:
+        log.warning(f"{app.name}: invalid JSON_BACKEND {backend}, using json")
+    elif backend == "orjson":
+        if orjson is None:
+            log.warning(f"{app.name}: JSON_BACKEND orjson is not installed, using json")
+        else:
+            app.json_encoder = fast_encoder(app.json_encoder)
+    return app
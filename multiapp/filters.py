@@ -0,0 +1,249 @@
+"""
+    Filter expressions for the json:api collections of the projects
+
+    The `filter` parameter of the collection endpoints (SAFRSBase._s_filter) accepts a json expression,
+    compiled to the WHERE clause of the collection query:
+
+        filter={"and": [{"name": "Freight", "op": "between", "val": [10, 100]},
+                        {"or": [{"name": "ShipCountry", "op": "in", "val": ["USA", "Mexico"]},
+                                {"name": "Customer.Country", "op": "eq", "val": "USA"}]},
+                        {"not": {"name": "ShippedDate", "op": "is_null"}}]}
+
+    * conditions: {"name": attribute, "op": operator, "val": value}
+      - name: a jsonapi attribute, "id" or a path of to-one relationships and an attribute (Customer.Country),
+        relationship paths are (outer) joined
+      - op: eq, ne, lt, le, gt, ge, between ([low, high]), in, notin (list or csv), startswith,
+        like, ilike, notilike, is_null (val: true (default) or false)
+    * {"and": [...]}, {"or": [...]}, {"not": {...}}
+    * a list of conditions is an "or" (the safrs filter format)
+
+    The attributes, operators and values are validated against the model (400 Validation Error).
+    Filters that can't use an index scan the table: the leading columns of the primary key, unique
+    constraints and indexes of the tables are reflected when the project is loaded, a filter is indexed
+    when a condition of every "or" branch uses an indexed column (and the foreign keys of its relationship
+    path) with an operator other than ne, notin, like, ilike and notilike. Unindexed filters are handled
+    according to FILTER_UNINDEXED in the project config: "warn" (default, logged), "reject" (400 with the
+    unindexed attributes) or "allow".
+"""
+import decimal
+import json
+import logging
+from flask import current_app, has_app_context
+from safrs.errors import ValidationError
+from sqlalchemy import and_, inspect, not_, or_
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.exc import UnmappedColumnError
+from sqlalchemy.orm.interfaces import MANYTOONE
+from blobs import exposed_classes
+
+log = logging.getLogger()
+
+MAX_CONDITIONS = 64
+MAX_VALUES = 1000
+INDEXABLE_OPS = {"eq", "lt", "le", "gt", "ge", "between", "in", "startswith", "is_null"}
+COMPARISONS = {
+    "eq": lambda attr, val: attr == val,
+    "ne": lambda attr, val: attr != val,
+    "lt": lambda attr, val: attr < val,
+    "le": lambda attr, val: attr <= val,
+    "gt": lambda attr, val: attr > val,
+    "ge": lambda attr, val: attr >= val,
+}
+ALIASES = {"is_": "is_null", "isnull": "is_null", "not_in": "notin", "prefix": "startswith"}
+
+indexed_columns = {}  # table -> names of the columns that lead an index
+
+
+def index_columns(engine, table):
+    """
+        :return: column names of the primary key, unique constraints and indexes of table (model and database)
+    """
+    result = []
+    if len(table.primary_key.columns):
+        result.append(tuple(column.name for column in table.primary_key.columns))
+    for index in table.indexes:
+        result.append(tuple(column.name for column in index.columns))
+    try:
+        inspector = inspect(engine)
+        for index in inspector.get_indexes(table.name, schema=table.schema) + inspector.get_unique_constraints(table.name, schema=table.schema):
+            result.append(tuple(index.get("column_names") or ()))
+    except Exception as exc:
+        log.debug(f"Failed to reflect the indexes of {table.name}: {exc}")
+    return [columns for columns in result if columns and columns[0]]
+
+
+def leading_columns(engine, table):
+    """
+        :return: names of the first columns of the primary key, unique constraints and indexes of table
+    """
+    return {columns[0] for columns in index_columns(engine, table)}
+
+
+class FilterCompiler:
+    """
+        Compile a filter expression of cls to a sqlalchemy expression and the joins of the relationship paths
+    """
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.joins = {}  # relationship path -> (relationship attribute of the join, alias)
+        self.conditions = 0
+        self.unindexed = []  # names of the conditions that can't use an index
+
+    def compile(self, node):
+        """
+            :return: (expression, indexed)
+        """
+        if isinstance(node, list):
+            node = {"or": node}
+        if not isinstance(node, dict):
+            raise ValidationError(f'Invalid filter "{node}"')
+        if "and" in node or "or" in node:
+            operator = "and" if "and" in node else "or"
+            children = node[operator]
+            if not isinstance(children, list) or not children or len(node) > 1:
+                raise ValidationError(f'Invalid filter "{node}", "{operator}" takes a list of filters')
+            compiled = [self.compile(child) for child in children]
+            expressions = [expression for expression, indexed in compiled]
+            if operator == "and":
+                return and_(*expressions), any(indexed for expression, indexed in compiled)
+            return or_(*expressions), all(indexed for expression, indexed in compiled)
+        if "not" in node:
+            expression, indexed = self.compile(node["not"])
+            if indexed:
+                self.unindexed.append("not")
+            return not_(expression), False
+        return self.condition(node)
+
+    def condition(self, node):
+        self.conditions += 1
+        if self.conditions > MAX_CONDITIONS:
+            raise ValidationError(f"Too many filter conditions (max {MAX_CONDITIONS})")
+        name, val = node.get("name"), node.get("val")
+        op = str(node.get("op", "eq")).strip("_").lower()
+        op = ALIASES.get(op, op)
+        if not isinstance(name, str):
+            raise ValidationError(f'Invalid filter "{node}", no attribute name')
+        attr, column, indexed = self.attribute(name)
+        if op in COMPARISONS:
+            expression = COMPARISONS[op](attr, coerce(column, val, name))
+        elif op == "between":
+            if not isinstance(val, list) or len(val) != 2:
+                raise ValidationError(f'Invalid filter "{node}", between takes a list [low, high]')
+            expression = attr.between(coerce(column, val[0], name), coerce(column, val[1], name))
+        elif op in ("in", "notin"):
+            values = val.split(",") if isinstance(val, str) else val
+            if not isinstance(values, list) or len(values) > MAX_VALUES:
+                raise ValidationError(f'Invalid filter "{node}", {op} takes a list of at most {MAX_VALUES} values')
+            values = [coerce(column, value, name) for value in values]
+            expression = attr.in_(values) if op == "in" else attr.notin_(values)
+        elif op == "startswith":
+            expression = attr.startswith(str(val), autoescape=True)
+        elif op in ("like", "ilike", "notilike"):
+            expression = getattr(attr, op)(str(val))
+        elif op == "is_null":
+            expression = attr.is_(None) if val in (None, True, "true", 1) else attr.isnot(None)
+        elif op == "is_not":
+            expression = attr.isnot(None)
+        else:
+            raise ValidationError(f'Invalid filter "{node}", unknown operator "{op}"')
+        indexed = indexed and op in INDEXABLE_OPS
+        if not indexed:
+            self.unindexed.append(f"{name} {op}")
+        return expression, indexed
+
+    def attribute(self, name):
+        """
+            :return: the attribute of the (joined) class for name, its column and whether the column and joins are indexed
+        """
+        *path, attr_name = name.split(".")
+        current, indexed = self.cls, True
+        for i, rel_name in enumerate(path):
+            prop = current.__mapper__.relationships.get(rel_name)
+            if prop is None or prop.direction is not MANYTOONE:
+                raise ValidationError(f'Invalid filter attribute "{name}", "{rel_name}" is not a to-one relationship')
+            indexed = indexed and all(is_indexed(column) for column in prop.local_columns)
+            key = tuple(path[:i + 1])
+            if key not in self.joins:
+                self.joins[key] = (getattr(current, rel_name), aliased(prop.mapper.class_))
+            current = self.joins[key][1]
+        mapped_cls = inspect(current).mapper.class_
+        if attr_name == "id":
+            primary_keys = list(mapped_cls.__mapper__.primary_key)
+            if len(primary_keys) != 1:
+                raise ValidationError(f'Invalid filter attribute "{name}", composite primary key')
+            column = primary_keys[0]
+        else:
+            column = mapped_cls._s_jsonapi_attrs.get(attr_name)
+            if column is None:
+                raise ValidationError(f'Invalid filter attribute "{name}", unknown attribute "{attr_name}"')
+        try:
+            key = mapped_cls.__mapper__.get_property_by_column(column).key
+        except (UnmappedColumnError, AttributeError, KeyError):
+            raise ValidationError(f'Invalid filter attribute "{name}", "{attr_name}" is not a column')
+        return getattr(current, key), column, indexed and is_indexed(column)
+
+    def query(self, query):
+        """
+            :return: query with the joins of the relationship paths
+        """
+        for path in sorted(self.joins, key=len):
+            rel_attr, alias = self.joins[path]  # rel_attr of the alias of the parent path
+            query = query.outerjoin(rel_attr.of_type(alias))
+        return query
+
+
+def is_indexed(column):
+    names = indexed_columns.get(column.table)
+    return names is None or column.name in names  # tables of classes that aren't exposed: unknown
+
+
+def coerce(column, value, name):
+    """
+        Convert json strings to the python type of numeric columns
+    """
+    if value is None or not isinstance(value, str):
+        return value
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if python_type in (int, float, decimal.Decimal):
+        try:
+            return python_type(value)
+        except (ValueError, decimal.InvalidOperation):
+            raise ValidationError(f'Invalid value "{value}" for filter attribute "{name}" ({python_type.__name__})')
+    return value
+
+
+def unindexed_policy():
+    return current_app.config.get("FILTER_UNINDEXED", "warn") if has_app_context() else "warn"
+
+
+def _s_filter(cls, *filter_args, **filter_kwargs):
+    """
+        Apply the filter expression (filter= parameter) to the collection query of cls
+    """
+    try:
+        filters = json.loads(filter_args[0])
+    except (json.decoder.JSONDecodeError, TypeError, IndexError):
+        raise ValidationError("Invalid filter format, the filter must be a json expression (see multiapp/filters.py)")
+    compiler = FilterCompiler(cls)
+    expression, indexed = compiler.compile(filters)
+    if not indexed:
+        policy = unindexed_policy()
+        message = f"Unindexed filter on {cls.__table__.name}: {', '.join(compiler.unindexed)}"
+        if policy == "reject":
+            raise ValidationError(f"{message}, add a condition on an indexed attribute")
+        if policy == "warn":
+            log.warning(message)
+    return compiler.query(cls._s_query).filter(expression)
+
+
+def install_filters(app, engine):
+    """
+        Reflect the indexes of the classes exposed by the project app (wrappers.py: filter expressions)
+    """
+    for cls in exposed_classes(app):
+        indexed_columns[cls.__table__] = leading_columns(engine, cls.__table__)
+    return app
@@ -2,9 +2,16 @@ from werkzeug.middleware.dispatcher import DispatcherMiddleware # use to combine
 from admin_api import create_app as create_admin_api_app, User, Api
 from flask import Flask
 import multiprocessing
+import os
+import gc
+import logging
+import shutil
+import tempfile
 import gunicorn.app.base
 from multiapp import get_args
 
+log = logging.getLogger()
+
 class ServerApp(gunicorn.app.base.BaseApplication):
     application = None
 
@@ -23,6 +30,14 @@ class ServerApp(gunicorn.app.base.BaseApplication):
 
     def load(self):
         return self.load_multiapp()
+
+    def reload(self):
+        # SIGHUP: with --preload the arbiter rebuilds the apps (Arbiter.setup) before it forks the new workers
+        super().reload()
+        if self.cfg.preload_app and self.callable is not None:
+            from mounts import release_all
+            release_all(self.callable)
+            self.callable = None
     
     def load_multiapp(self):
         print("\n\n  # Loading MA\n\n")
@@ -34,9 +49,63 @@ class ServerApp(gunicorn.app.base.BaseApplication):
         worker.log.debug("%s", worker.pid)
 
 
+def pre_fork(server, worker):
+    """
+        --preload: the apps were built in the master, don't let the workers inherit connections
+        or threads and keep the heap pages shared (the generator helper is shared by the workers)
+    """
+    from pools import manager as pool_manager
+    pool_manager.dispose_all()
+    # move the objects of the master to the permanent generation: the collector of the workers
+    # won't write to them (gc headers), so their pages aren't copied
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from pools import manager as pool_manager
+    # the connections are re-created by the pools on first use
+    pool_manager.dispose_all()
+    # threads don't survive the fork
+    pool_manager.start_reaper()
+    log.info(f"Worker {worker.pid}: {gc.get_freeze_count()} objects frozen")
+
+
+def when_ready(server):
+    import rolling
+    rolling.RollingReloader(server).start()
+
+
+def post_worker_init(worker):
+    import rolling
+    # the projects are mounted, warm them up before the worker is used to replace an old one
+    rolling.mark_ready(worker)
+
+
+def worker_exit(server, worker):
+    import rolling
+    import audit
+    import log_pipeline
+    rolling.unmark_ready(server.pid, worker.pid)
+    # write the queued audit rows (AUDIT_MODE async)
+    audit.close()
+    log_pipeline.close()
+
+
+def on_exit(server):
+    import rolling
+    from generator import generator
+    generator.stop()
+    shutil.rmtree(rolling.state_dir(server.pid), ignore_errors=True)
+
+
 if __name__ == '__main__':
     
     args = get_args()
+    # the connection budget (pools.py) is shared by the workers
+    os.environ.setdefault("MULTIAPP_WORKERS", str(args.workers))
+    # one generator helper for the workers (generator.py)
+    os.environ.setdefault("GENERATOR_SOCKET", os.path.join(tempfile.gettempdir(), f"alsdock-generator-{os.getpid()}.sock"))
     
     options = {
         'bind': '%s:%s' % (args.interface, args.port),
@@ -44,8 +113,27 @@ if __name__ == '__main__':
         'threads' : args.threads,
         'error-logfile' : args.error_log,
         'access-logfile' : args.access_log,
-        'reload' : True
+        'reload' : args.reload,
+        # rolling reload (rolling.py), triggered from the admin api
+        'when_ready': when_ready,
+        'post_worker_init': post_worker_init,
+        'worker_exit': worker_exit,
+        'on_exit': on_exit
     }
+    if args.worker_class == "gevent":
+        # cooperative workers with patched database drivers (green.py)
+        options.update({
+            'worker_class': 'green.GeventWorker',
+            'worker_connections': args.worker_connections
+        })
+    if args.preload:
+        # build the apps once in the master and fork the workers, code changes aren't reloaded
+        options.update({
+            'preload_app': True,
+            'reload': False,
+            'pre_fork': pre_fork,
+            'post_fork': post_fork
+        })
     server = ServerApp(args, options)
     server.run()
 
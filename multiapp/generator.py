@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+    Warm ApiLogicServer generator
+
+    Running the `ApiLogicServer` console script for every Api.generate pays for an interpreter start
+    and the generator imports each time. Instead, a helper process (`python generator.py serve`)
+    imports the generator once and forks a child for every generation, so a generation only costs
+    the schema work. The children are isolated from the web workers: own process, cwd, argv, stdout
+    and stderr, a crash doesn't affect the server.
+
+    One helper is shared by the web workers (and the servers using the same GENERATOR_SOCKET): the first
+    worker that needs it starts it under a file lock (in the background, by multiapp.create_app), the workers
+    send their jobs as json lines on the unix socket of the helper. The helper runs the jobs one at a time and
+    exits after GENERATOR_IDLE seconds without jobs, it is started again by the next generation.
+
+    GENERATOR_MODE:
+    * fork (default): use the warm helper, falls back to subprocess if the ApiLogicServer entry
+      point can't be found or the helper doesn't answer
+    * subprocess: run the console script
+    GENERATOR_TIMEOUT: seconds before a generation is killed (default 600)
+    GENERATOR_IDLE: seconds without jobs before the helper exits (default 900, 0: never)
+    GENERATOR_SOCKET: unix socket of the helper (gals.py sets one per server)
+"""
+import fcntl
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from importlib import metadata
+
+log = logging.getLogger()
+
+SCRIPT = "ApiLogicServer"
+GENERATOR_MODE = os.getenv("GENERATOR_MODE", "fork")
+GENERATOR_TIMEOUT = float(os.getenv("GENERATOR_TIMEOUT", 600))
+GENERATOR_IDLE = float(os.getenv("GENERATOR_IDLE", 900))
+GENERATOR_SOCKET = os.getenv("GENERATOR_SOCKET") or os.path.join(tempfile.gettempdir(), f"alsdock-generator-{os.getpid()}.sock")
+START_TIMEOUT = 120  # seconds to import the generator in the helper
+JOB_TIMEOUT = 30  # seconds to send a job to the helper
+
+
+def entry_point(name=SCRIPT):
+    """
+        :return: the console_scripts entry point of the generator or None if it isn't installed
+    """
+    try:
+        entry_points = metadata.entry_points(group="console_scripts")
+    except TypeError:  # python < 3.10
+        entry_points = metadata.entry_points().get("console_scripts", [])
+    for ep in entry_points:
+        if ep.name == name:
+            return ep
+    return None
+
+
+def run_child(main, job):
+    """
+        Runs in the forked child: call the entry point like the console script would
+    """
+    os.chdir(job["cwd"])
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_fd, 0)
+    for fd, fn in ((1, job["out"]), (2, job["err"])):
+        file_fd = os.open(fn, os.O_WRONLY | os.O_TRUNC)
+        os.dup2(file_fd, fd)
+        os.close(file_fd)
+    sys.stdout = sys.__stdout__
+    sys.argv = [SCRIPT] + job["args"]
+    code = 0
+    try:
+        main()
+    except SystemExit as exc:
+        code = exc.code
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        code = 1
+    if code is not None and not isinstance(code, int):
+        print(code, file=sys.stderr)
+        code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code or 0)
+
+
+def serve(socket_path, idle=GENERATOR_IDLE):
+    """
+        Helper process: import the generator and fork a child for every job received on socket_path
+    """
+    main = entry_point().load()
+    sys.stdout = sys.stderr  # the generator output of the helper itself
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    inode = os.stat(socket_path).st_ino
+    server.listen(16)
+    server.settimeout(idle or None)
+    try:
+        while True:
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                break
+            with connection:
+                if serve_job(server, connection, main):
+                    break
+    finally:
+        # unless a new helper replaced the socket of this one
+        if os.path.exists(socket_path) and os.stat(socket_path).st_ino == inode:
+            os.unlink(socket_path)
+        server.close()
+
+
+def serve_job(server, connection, main):
+    """
+        Run the job of a connection, :return: True if the helper has to stop
+    """
+    connection.settimeout(JOB_TIMEOUT)
+    try:
+        with connection.makefile("rw") as fp:
+            line = fp.readline()
+            if not line:
+                return False  # warm up
+            job = json.loads(line)
+            if job.get("stop"):
+                return True
+            connection.settimeout(None)
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                connection.close()
+                run_child(main, job)
+            fp.write(json.dumps({"pid": pid}) + "\n")
+            fp.flush()
+            _, status = os.waitpid(pid, 0)
+            code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            fp.write(json.dumps({"code": code}) + "\n")
+            fp.flush()
+    except (OSError, ValueError) as exc:
+        print(f"Generator job failed: {exc}", file=sys.stderr)
+    return False
+
+
+class Generator:
+    """
+        Runs the generator in children forked from the shared warm helper process
+    """
+
+    def __init__(self, mode=GENERATOR_MODE, timeout=GENERATOR_TIMEOUT, socket_path=GENERATOR_SOCKET):
+        self.timeout = timeout
+        self.socket_path = socket_path
+        self.ep = entry_point() if mode == "fork" else None
+        self.helper = None  # the helper process started by this process
+        if self.ep is None and mode == "fork":
+            log.warning(f"{SCRIPT} entry point not found, generating with subprocess")
+
+    @property
+    def mode(self):
+        return "fork" if self.ep else "subprocess"
+
+    def _connect(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.socket_path)
+        except OSError:
+            connection.close()
+            raise
+        return connection
+
+    def _lock(self, lock_fp, deadline):
+        # polled: a blocking flock would block the gevent hub
+        while True:
+            try:
+                fcntl.flock(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Timeout waiting for the generator helper lock")
+                time.sleep(0.1)
+
+    def _start_helper(self):
+        """
+            Start the shared helper unless it is running
+
+            :return: a connection to the helper
+        """
+        if self.helper is not None and self.helper.poll() is not None:
+            self.helper = None  # exited (idle), reaped
+        try:
+            return self._connect()
+        except OSError:
+            pass
+        deadline = time.monotonic() + START_TIMEOUT
+        with open(self.socket_path + ".lock", "w") as lock_fp:
+            self._lock(lock_fp, deadline)
+            try:
+                try:
+                    return self._connect()  # started by another worker
+                except OSError:
+                    pass
+                if os.path.exists(self.socket_path):
+                    os.unlink(self.socket_path)  # socket of a helper that didn't exit cleanly
+                t0 = time.time()
+                self.helper = subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve", self.socket_path],
+                                               stdin=subprocess.DEVNULL, start_new_session=True)
+                while True:
+                    try:
+                        connection = self._connect()
+                        break
+                    except OSError:
+                        if self.helper.poll() is not None or time.monotonic() > deadline:
+                            raise RuntimeError("Generator helper failed to start")
+                        time.sleep(0.1)
+                log.info(f"Generator helper {self.helper.pid} ready in {time.time() - t0:.1f}s")
+                return connection
+            finally:
+                fcntl.flock(lock_fp, fcntl.LOCK_UN)
+
+    def warm_up(self):
+        """
+            Start the helper (and import the generator) ahead of the first generation
+        """
+        if not self.ep:
+            return
+        try:
+            self._start_helper().close()
+        except Exception as exc:
+            log.warning(f"Generator warm up failed: {exc}")
+
+    def warm_up_background(self):
+        threading.Thread(target=self.warm_up, name="generator-warm-up", daemon=True).start()
+
+    def run(self, args, cwd):
+        """
+            Run the generator with the command line args in cwd
+
+            :return: subprocess.CompletedProcess
+        """
+        proc_args = [SCRIPT] + list(args)
+        if not self.ep:
+            return self._run_subprocess(proc_args, cwd)
+
+        with tempfile.NamedTemporaryFile("r", suffix=".out") as out_fp, \
+                tempfile.NamedTemporaryFile("r", suffix=".err") as err_fp:
+            job = {"args": list(args), "cwd": str(cwd), "out": out_fp.name, "err": err_fp.name}
+            try:
+                connection = self._start_helper()
+            except (OSError, RuntimeError) as exc:
+                log.warning(f"Generator helper failed: {exc}")
+                connection = None
+            if connection is not None:
+                with connection:
+                    result = self._run_job(connection, job, proc_args, out_fp, err_fp)
+                if result is not None:
+                    return result
+        log.warning("Generating with subprocess")
+        return self._run_subprocess(proc_args, cwd)
+
+    def _run_subprocess(self, proc_args, cwd):
+        return subprocess.run(proc_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True, cwd=cwd, timeout=self.timeout)
+
+    def _run_job(self, connection, job, proc_args, out_fp, err_fp):
+        """
+            Send the job to the helper and wait for its child, kill it after the timeout
+
+            :return: subprocess.CompletedProcess, None if the helper didn't start the job
+        """
+        # the helper runs the jobs of the other workers first
+        connection.settimeout(self.timeout)
+        with connection.makefile("rw") as fp:
+            try:
+                fp.write(json.dumps(job) + "\n")
+                fp.flush()
+                pid = json.loads(fp.readline() or "{}").get("pid")
+            except (OSError, ValueError) as exc:
+                log.warning(f"Generator helper failed: {exc}")
+                return None
+            if pid is None:
+                return None
+            try:
+                code = json.loads(fp.readline() or "{}").get("code", -1)
+            except socket.timeout:
+                os.kill(pid, signal.SIGKILL)
+                code = -signal.SIGKILL
+            except (OSError, ValueError):
+                code = -1
+        if code == -signal.SIGKILL:
+            raise subprocess.TimeoutExpired(proc_args, self.timeout, out_fp.read(), err_fp.read())
+        return subprocess.CompletedProcess(proc_args, code, out_fp.read(), err_fp.read())
+
+    def stop(self):
+        """
+            Stop the shared helper
+        """
+        try:
+            with self._connect() as connection:
+                connection.sendall(json.dumps({"stop": True}).encode() + b"\n")
+        except OSError:
+            pass
+
+
+generator = Generator()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["serve"]:
+        serve(sys.argv[2])
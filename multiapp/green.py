@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+    Cooperative (gevent) worker mode for gals.py
+
+        python gals.py -k gevent --worker-connections 1000
+
+    Each worker serves up to --worker-connections requests concurrently in greenlets, a request that
+    waits on the database yields to the others instead of blocking a thread.
+    * GeventWorker monkey patches the standard library (gunicorn) and the database drivers:
+      psycopg2 with psycogreen, pure python drivers (PyMySQL) use the patched sockets.
+      C drivers without wait callbacks (sqlite3, pyodbc, mysqlclient) block the worker while they
+      run a query, they work but aren't concurrent.
+    * the project sessions are scoped to the greenlet: flask_sqlalchemy scopes db.session with
+      greenlet.getcurrent when greenlet (a gevent dependency) is installed, also in the apps
+      loaded by the master (--preload). The session of a request is removed in the project app teardown
+    * the number of connections is still limited by the engine pools (SQLALCHEMY_ENGINE_OPTIONS)
+      and the connection budget (pools.py), greenlets wait for a free connection
+
+    Compatibility run, with the ADMIN_DB and PROJECTS_DIR of the server:
+
+        python green.py --requests 200
+"""
+import argparse
+import logging
+import sys
+
+log = logging.getLogger()
+
+COOPERATIVE_DRIVERS = {"psycopg2": "psycogreen", "pymysql": "patched sockets", "pg8000": "patched sockets"}
+BLOCKING_DRIVERS = ("pysqlite", "pyodbc", "mysqldb", "cx_oracle")
+
+
+def patch_drivers():
+    """
+        Make the database drivers yield to the gevent hub while they wait for the database
+    """
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        log.warning("psycogreen not installed, psycopg2 queries block the gevent worker")
+        return
+    try:
+        patch_psycopg()
+    except ImportError:
+        pass  # psycopg2 not installed
+
+
+def is_green():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
+def driver_info(engine):
+    driver = engine.dialect.driver
+    if driver in COOPERATIVE_DRIVERS:
+        return driver, True
+    return driver, driver not in BLOCKING_DRIVERS
+
+
+try:
+    from gunicorn.workers.ggevent import GeventWorker as _GeventWorker
+
+    class GeventWorker(_GeventWorker):
+        """
+            gunicorn gevent worker that also patches the database drivers
+        """
+
+        def patch(self):
+            super().patch()
+            patch_drivers()
+
+except ImportError:  # gevent not installed
+    GeventWorker = None
+
+
+def check(requests=200):
+    """
+        Compatibility run: load the multiapp in a patched process and send concurrent requests
+        to the projects, the sessions have to be isolated per greenlet and removed afterwards
+    """
+    from gevent.pool import Pool
+    from werkzeug.test import Client
+    from safrs import DB as db
+    import multiapp
+    from pools import manager as pool_manager
+
+    application = multiapp.main()
+    client = Client(application)
+    prefixes = [prefix for prefix in application.mounts if prefix != "/admin"]
+    for info in pool_manager.engines:
+        driver, cooperative = driver_info(info.engine)
+        print(f"{info.project:<20} {info.role:<8} {driver:<12} {'cooperative' if cooperative else 'blocking'}")
+
+    # the collection endpoints of the projects
+    paths = []
+    for prefix in prefixes:
+        swagger = client.get(f"{prefix}/api/swagger.json").json or {}
+        paths += [f"{prefix}/api{path}?page[limit]=5" for path, ops in swagger.get("paths", {}).items()
+                  if "get" in ops and "{" not in path and path.count("/") == 2]
+    errors = []
+
+    def request(i):
+        path = paths[i % len(paths)]
+        response = client.get(path)
+        if response.status_code >= 500:
+            errors.append((path, response.status))
+
+    pool = Pool(100)
+    for i in range(requests):
+        pool.spawn(request, i)
+    pool.join()
+
+    leaked = len(db.session.registry.registry)
+    print(f"{requests} requests, {len(errors)} errors, {leaked} sessions left")
+    for error in errors[:10]:
+        print(error)
+    return not errors and not leaked
+
+
+def main():
+    from gevent import monkey
+    monkey.patch_all()
+    patch_drivers()
+    argparser = argparse.ArgumentParser(description="gevent compatibility run")
+    argparser.add_argument("-r", "--requests", default=200, type=int)
+    args = argparser.parse_args()
+    sys.exit(0 if check(args.requests) else 1)
+
+
+if __name__ == "__main__":
+    main()
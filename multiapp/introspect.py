@@ -0,0 +1,207 @@
+"""
+    Asynchronous, cached schema introspection for the admin api (Api.test_conn, Api.generate)
+
+    Reflection runs on a small thread pool (INTROSPECT_WORKERS) so a slow or unreachable database
+    doesn't hang the request: the caller waits at most INTROSPECT_TIMEOUT seconds. A reflection that
+    times out keeps running and its result is cached, so a retry can return it.
+
+    The table/column/foreign key metadata is cached per connection string for INTROSPECT_TTL seconds,
+    in memory and as json in INTROSPECT_CACHE_DIR, so the gunicorn workers share it.
+    Cache keys are sha256 hashes, connection strings (and credentials) aren't written to disk.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from pathlib import Path
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+
+log = logging.getLogger()
+
+INTROSPECT_TIMEOUT = float(os.getenv("INTROSPECT_TIMEOUT", 10))
+INTROSPECT_TTL = float(os.getenv("INTROSPECT_TTL", 300))
+INTROSPECT_WORKERS = int(os.getenv("INTROSPECT_WORKERS", 2))
+cache_dir = Path(os.getenv("INTROSPECT_CACHE_DIR", Path(tempfile.gettempdir()) / "alsdock-introspect"))
+
+# dialect -> connect_args key of the driver connect timeout
+CONNECT_TIMEOUT_ARGS = {
+    "postgresql": "connect_timeout",
+    "mysql": "connect_timeout",
+    "sqlite": "timeout",
+    "mssql": "timeout",
+}
+
+
+class IntrospectionTimeout(Exception):
+    pass
+
+
+def cache_key(connection_string):
+    return hashlib.sha256(connection_string.encode()).hexdigest()
+
+
+def type_name(sa_type):
+    try:
+        return str(sa_type)
+    except Exception:
+        # eg. NullType for sqlite columns declared without a type
+        return type(sa_type).__name__
+
+
+def reflect(connection_string, timeout=INTROSPECT_TIMEOUT):
+    """
+        Reflect the tables, columns and foreign keys of the database
+
+        :return: dict with the metadata, json serializable
+    """
+    start = time.time()
+    url = make_url(connection_string)
+    connect_args = {}
+    timeout_arg = CONNECT_TIMEOUT_ARGS.get(url.get_backend_name())
+    if timeout_arg:
+        connect_args[timeout_arg] = int(timeout) if timeout_arg == "connect_timeout" else timeout
+    engine = create_engine(connection_string, poolclass=NullPool, connect_args=connect_args)
+    try:
+        with engine.connect() as conn:
+            insp = inspect(conn)
+            tables = {}
+            for table_name in insp.get_table_names():
+                pk = insp.get_pk_constraint(table_name) or {}
+                tables[table_name] = {
+                    "columns": [
+                        {
+                            "name": column["name"],
+                            "type": type_name(column["type"]),
+                            "nullable": column.get("nullable", True),
+                            "default": None if column.get("default") is None else str(column["default"]),
+                        }
+                        for column in insp.get_columns(table_name)
+                    ],
+                    "primary_key": pk.get("constrained_columns", []),
+                    "foreign_keys": [
+                        {
+                            "columns": fk["constrained_columns"],
+                            "referred_table": fk["referred_table"],
+                            "referred_columns": fk["referred_columns"],
+                        }
+                        for fk in insp.get_foreign_keys(table_name)
+                    ],
+                }
+            views = insp.get_view_names()
+    finally:
+        engine.dispose()
+
+    return {"tables": tables, "views": views, "reflected_at": time.time(), "duration": round(time.time() - start, 3)}
+
+
+class SchemaCache:
+    """
+        TTL cache of reflected metadata, the reflections are run by an executor
+    """
+
+    def __init__(self, ttl=INTROSPECT_TTL, workers=INTROSPECT_WORKERS, cache_dir=cache_dir):
+        self.ttl = ttl
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="introspect")
+        self._cache = {}  # key -> metadata
+        self._pending = {}  # key -> future, concurrent requests for the same db share the reflection
+        self._lock = threading.Lock()
+
+    def cache_fn(self, key):
+        return self.cache_dir / f"{key}.json"
+
+    def fresh(self, metadata):
+        return metadata is not None and time.time() - metadata["reflected_at"] < self.ttl
+
+    def get_cached(self, key):
+        metadata = self._cache.get(key)
+        if self.fresh(metadata):
+            return metadata
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self.cache_fn(key)) as cache_fp:
+                metadata = json.load(cache_fp)
+        except (OSError, ValueError):
+            return None
+        if not self.fresh(metadata):
+            return None
+        self._cache[key] = metadata
+        return metadata
+
+    def store(self, key, metadata):
+        self._cache[key] = metadata
+        if not self.cache_dir:
+            return
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_fn = self.cache_fn(key).with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_fn, "w") as cache_fp:
+                json.dump(metadata, cache_fp)
+            os.replace(tmp_fn, self.cache_fn(key))
+        except OSError as exc:
+            log.warning(f"Failed to write introspection cache: {exc}")
+
+    def invalidate(self, connection_string):
+        key = cache_key(connection_string)
+        self._cache.pop(key, None)
+        if self.cache_dir:
+            try:
+                self.cache_fn(key).unlink()
+            except OSError:
+                pass
+
+    def _reflect(self, key, connection_string, timeout):
+        try:
+            metadata = reflect(connection_string, timeout)
+            self.store(key, metadata)
+            return metadata
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def get(self, connection_string, timeout=INTROSPECT_TIMEOUT, refresh=False):
+        """
+            :param connection_string: sqlalchemy database url
+            :param timeout: max seconds to wait for the reflection
+            :param refresh: ignore the cached metadata
+            :return: metadata dict, "cached" is True if it was served from the cache
+        """
+        key = cache_key(connection_string)
+        if not refresh:
+            metadata = self.get_cached(key)
+            if metadata is not None:
+                return dict(metadata, cached=True)
+
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = self._executor.submit(self._reflect, key, connection_string, timeout)
+                self._pending[key] = future
+        try:
+            return dict(future.result(timeout), cached=False)
+        except FutureTimeoutError:
+            raise IntrospectionTimeout(f"Timeout: no response from the database within {timeout}s")
+
+
+schema_cache = SchemaCache()
+
+
+def introspect(connection_string, timeout=INTROSPECT_TIMEOUT, refresh=False):
+    return schema_cache.get(connection_string, timeout=timeout, refresh=refresh)
+
+
+def format_tables(metadata):
+    """
+        Table summary as shown by the admin ui DBConnection component
+    """
+    tables = metadata["tables"]
+    if not tables:
+        return "# Empty DB"
+    return "# Tables:\n" + "\n".join(tables)
@@ -0,0 +1,187 @@
+"""
+    Batched relationship and column loading for the json:api collection requests of the projects
+
+    The generated relationships are lazy loaded: serializing the `include=` relationships of a page of
+    100 orders costs a query per order and relationship. The include paths of the request are turned
+    into eager loader options on the collection query (SAFRSBase._s_get, used with and without filters):
+    * to-many relationships: selectinload, one `IN (...)` query per relationship path for the whole page
+    * to-one relationships: joinedload, a LEFT OUTER JOIN in the page query
+    so a page costs a constant number of queries. Nested paths (include=OrderDetailList.Product) chain the
+    loaders, relationships configured as lazy="dynamic", "noload" or "raise" are left alone.
+
+    Sparse fieldsets (fields[Employee]=LastName,FirstName) are pushed down to the queries of the collection
+    and the included classes: only the requested columns, the primary key and the relationship (foreign key)
+    columns are selected (load_only). Heavy columns (DEFERRED_COLUMN_TYPES, default "binary": LargeBinary,
+    "text": unbounded Text as well) are left out of collection responses unless they're requested with
+    fields[], the resource endpoint (/Employee/1) still returns them. Binary columns with an endpoint
+    (blobs.py) are never loaded, their attribute is a link.
+
+    safrs' own include optimization (SAFRS.OPTIMIZED_LOADING, joinedload for every relationship) is
+    disabled, it would join the to-many relationships into the paginated query.
+    INCLUDE_LOADING=lazy disables the batched relationship and column loading.
+"""
+import logging
+import os
+import safrs
+from flask import has_request_context, request
+from blobs import linked_columns
+from functools import lru_cache
+from sqlalchemy import LargeBinary, PickleType, Text
+from sqlalchemy.orm import Query, joinedload, load_only, selectinload
+from sqlalchemy.orm.exc import UnmappedColumnError
+from sqlalchemy.orm.interfaces import MANYTOONE
+
+log = logging.getLogger()
+
+INCLUDE_LOADING = os.getenv("INCLUDE_LOADING", "batched")
+DEFERRED_COLUMN_TYPES = {kind.strip() for kind in os.getenv("DEFERRED_COLUMN_TYPES", "binary").split(",") if kind.strip()}
+EAGER_LOADABLE = ("select", True, "joined", "subquery", "selectin")
+
+
+def include_paths():
+    """
+        :return: the relationship paths of the include= request parameter
+    """
+    included_csv = request.args.get("include", safrs.SAFRS.DEFAULT_INCLUDED)
+    return [inc for inc in included_csv.split(",") if inc]
+
+
+def loader(option, attr, prop):
+    """
+        Add the loader of relationship attr to option (a loader chain or None)
+    """
+    strategy = "joinedload" if prop.direction is MANYTOONE else "selectinload"
+    if option is None:
+        return joinedload(attr) if strategy == "joinedload" else selectinload(attr)
+    return getattr(option, strategy)(attr)
+
+
+def is_heavy(column):
+    column_type = column.type
+    if "binary" in DEFERRED_COLUMN_TYPES and isinstance(column_type, (LargeBinary, PickleType)):
+        return True
+    return "text" in DEFERRED_COLUMN_TYPES and isinstance(column_type, Text) and not column_type.length
+
+
+class ColumnInfo:
+    """
+        The jsonapi fields of a class and the columns that are always loaded
+    """
+
+    def __init__(self, cls):
+        mapper = cls.__mapper__
+        self.fields = {}  # field name -> mapper key, None if the field isn't a column (jsonapi_attr)
+        self.heavy = set()
+        for name, attr in cls._s_jsonapi_attrs.items():
+            try:
+                self.fields[name] = mapper.get_property_by_column(attr).key
+            except (UnmappedColumnError, AttributeError, KeyError):
+                self.fields[name] = None
+                continue
+            if is_heavy(attr):
+                self.heavy.add(name)
+        # the primary key and the columns of the relationships (joins, selectin loads, lazy loads)
+        columns = list(mapper.primary_key)
+        for relationship in mapper.relationships:
+            columns += [local for local, remote in relationship.local_remote_pairs if local.table in mapper.tables]
+        self.required = set()
+        for column in columns:
+            try:
+                self.required.add(mapper.get_property_by_column(column).key)
+            except UnmappedColumnError:
+                pass
+
+
+@lru_cache(maxsize=None)
+def column_info(cls):
+    return ColumnInfo(cls)
+
+
+def load_columns(cls):
+    """
+        :return: mapper keys of the columns of cls to load for the fields[] of the request, None: all columns
+    """
+    info = column_info(cls)
+    fields = getattr(request, "fields", None)
+    if fields is None:
+        return None
+    linked = linked_columns.get(cls, {})  # binary columns serialized as the url of their endpoint (blobs.py)
+    requested = fields.get(cls._s_class_name)
+    if requested is None:
+        heavy = info.heavy - set(linked)
+        if heavy:
+            # leave the heavy columns out of the response, the serialization would load them
+            requested = fields[cls._s_class_name] = [name for name in info.fields if name not in heavy]
+        elif linked:
+            requested = list(info.fields)
+        else:
+            return None
+    flags = {linked[name][2] for name in requested if name in linked}  # the IS NOT NULL flags of the links
+    requested = [name for name in requested if name not in linked]
+    if any(info.fields.get(name) is None for name in requested):
+        return None  # a jsonapi_attr may need any column
+    return sorted({info.fields[name] for name in requested} | info.required | flags)
+
+
+def include_options(cls, paths):
+    """
+        :param cls: SAFRSBase class of the collection
+        :param paths: include paths, eg. ["OrderDetailList.Product", "Customer"]
+        :return: list of loader options
+    """
+    if safrs.SAFRS.INCLUDE_ALL in paths:
+        # +all includes every relationship of the collection (not nested)
+        paths = [path for path in paths if path != safrs.SAFRS.INCLUDE_ALL] + list(cls.__mapper__.relationships.keys())
+
+    options = []
+    columns = load_columns(cls)
+    if columns:
+        options.append(load_only(*columns))
+    loaded = set()
+    for path in paths:
+        names = path.split(".")
+        option, current = chain(cls, names)
+        if option is None:
+            continue  # invalid paths are reported by safrs when the relationships are serialized
+        options.append(option)
+        for i in range(1, len(names) + 1):
+            prefix = ".".join(names[:i])
+            if prefix in loaded:
+                continue
+            loaded.add(prefix)
+            prefix_option, prefix_cls = chain(cls, names[:i])
+            columns = load_columns(prefix_cls)
+            if columns:
+                options.append(prefix_option.load_only(*columns))
+    return options
+
+
+def chain(cls, names):
+    """
+        :return: the loader chain for the relationship path names from cls (None if it can't be eager loaded)
+                 and the class at the end of the path
+    """
+    option, current = None, cls
+    for name in names:
+        prop = current.__mapper__.relationships.get(name)
+        if prop is None or prop.lazy not in EAGER_LOADABLE:
+            return None, current
+        option = loader(option, getattr(current, name), prop)
+        current = prop.mapper.class_
+    return option, current
+
+
+def batched_get(get):
+    """
+        Wrap SAFRSBase._s_get: add the loader options of the include= paths and fields[] to the collection query
+    """
+    def _s_get(cls, **kwargs):
+        result = get(cls, **kwargs)
+        if isinstance(result, Query) and has_request_context():
+            options = include_options(cls, include_paths())
+            if options:
+                result = result.options(*options)
+        return result
+
+    _s_get.__wrapped__ = get
+    return _s_get
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+Local load-test harness for the multiapp server
+
+Boots gals.py in a scratch directory against example.nw.db.sqlite and replays a weighted
+mix of requests (loadtest.yaml) at a fixed concurrency, then reports throughput and
+p50/p95/p99 latency per endpoint and per project.
+
+    python loadtest.py --concurrency 16 --duration 30
+    python loadtest.py --mix my_mix.yaml --json results.json -- -w 4 -t 4
+
+Everything after "--" is passed to gals.py, so different server configurations can be
+compared with the same mix. The scratch directory holds its own admin db and a copy of the
+db2 project, nothing in the tree is modified and no network access is required.
+Use --url to run the mix against a server that is already running.
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+import yaml
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+log = logging.getLogger("loadtest")
+
+multiapp_dir = Path(__file__).parent.resolve()
+default_db = multiapp_dir.parent / "example.nw.db.sqlite"
+default_mix = multiapp_dir / "loadtest.yaml"
+template_project = multiapp_dir / "db2"
+default_server_args = ["-w", "2", "-t", "4"]
+
+
+def load_mix(mix_fn, project):
+    """
+        Read the scenarios from the mix yaml file and fill in the project name
+    """
+    with open(mix_fn) as mix_fp:
+        mix = yaml.safe_load(mix_fp)
+
+    scenarios = []
+    for scenario in mix.get("scenarios", []):
+        scenario = dict(scenario)
+        scenario["path"] = scenario["path"].format(project=project)
+        scenario.setdefault("method", "GET")
+        scenario.setdefault("weight", 1)
+        scenario.setdefault("name", f"{scenario['method']} {scenario['path']}")
+        scenarios.append(scenario)
+
+    if not scenarios:
+        raise ValueError(f"No scenarios in {mix_fn}")
+    return scenarios
+
+
+def prepare_workdir(workdir, project, db_file):
+    """
+        Create the scratch projects dir and admin db the server will run against:
+        * <workdir>/projects/<project> : copy of the db2 project using db_file as its database
+        * <workdir>/admin.db : admin db with an Api row for the project
+    """
+    projects_dir = workdir / "projects"
+    project_dir = projects_dir / project
+    shutil.copytree(template_project, project_dir, ignore=shutil.ignore_patterns(".idea", ".vscode", ".devcontainer", "__pycache__"))
+    shutil.copyfile(db_file, project_dir / "database/db.sqlite")
+
+    admin_db = f"sqlite:///{workdir / 'admin.db'}"
+    env = dict(os.environ, ADMIN_DB=admin_db, PROJECTS_DIR=str(projects_dir))
+    # create the admin db in a separate interpreter: admin_api reads its settings from the environment on import
+    script = (
+        "from admin_api import create_app, Api\n"
+        "app = create_app()\n"
+        "with app.app_context():\n"
+        f"    app.db.session.execute(Api.__table__.insert().values(name={project!r}, prefix={project!r}, "
+        f"connection_string={'sqlite:///' + str(project_dir / 'database/db.sqlite')!r}))\n"
+        "    app.db.session.commit()\n"
+    )
+    subprocess.run([sys.executable, "-c", script], cwd=multiapp_dir, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return env
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workdir, env, port, server_args, ready_path, timeout=120):
+    """
+        Start gals.py and wait until ready_path responds
+    """
+    server_log = open(workdir / "server.log", "w")
+    args = [sys.executable, "gals.py", "-i", "127.0.0.1", "-p", str(port), "-H", "127.0.0.1", "-P", str(port)] + server_args
+    log.info(f"Starting server: {' '.join(args)} (log: {server_log.name})")
+    proc = subprocess.Popen(args, cwd=multiapp_dir, env=env, stdout=server_log, stderr=subprocess.STDOUT)
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Server exited with code {proc.returncode}, see {server_log.name}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", ready_path)
+            if conn.getresponse().status == 200:
+                return proc
+        except OSError:
+            pass
+        time.sleep(0.5)
+
+    stop_server(proc)
+    raise RuntimeError(f"Server not ready after {timeout}s, see {server_log.name}")
+
+
+def stop_server(proc):
+    if proc.poll() is None:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def percentile(sorted_values, pct):
+    """
+        Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(pct / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(samples, elapsed):
+    """
+        :param samples: list of (latency, ok) tuples
+        :param elapsed: measurement duration in seconds
+        :return: dict with the request count, errors, throughput and latency percentiles (ms)
+    """
+    latencies = sorted(latency for latency, _ in samples)
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for _, ok in samples if not ok),
+        "rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    }
+
+
+class LoadRunner:
+    """
+        Replay the scenarios with `concurrency` threads, each thread has its own keep-alive connection
+    """
+
+    def __init__(self, base_url, scenarios, concurrency=8, duration=30, warmup=5, seed=None, timeout=30, token=None):
+        url = urllib.parse.urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.scenarios = scenarios
+        self.weights = [s["weight"] for s in scenarios]
+        self.concurrency = concurrency
+        self.duration = duration
+        self.warmup = warmup
+        self.seed = seed
+        self.timeout = timeout
+        self.token = token
+        self.samples = {s["name"]: [] for s in scenarios}
+        self.lock = threading.Lock()
+
+    def request(self, conn, scenario):
+        headers = {"Accept": "application/vnd.api+json"}
+        if scenario.get("login"):
+            headers["Authorization"] = f"Bearer {self.token}"
+        body = None
+        if "body" in scenario:
+            body = json.dumps(scenario["body"])
+            headers["Content-Type"] = "application/vnd.api+json" if "data" in scenario["body"] else "application/json"
+        conn.request(scenario["method"], scenario["path"], body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status < 400
+
+    def worker(self, index, measure_from, stop_at):
+        rnd = random.Random(None if self.seed is None else self.seed + index)
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        samples = []
+        while time.time() < stop_at:
+            scenario = rnd.choices(self.scenarios, weights=self.weights)[0]
+            t0 = time.perf_counter()
+            try:
+                ok = self.request(conn, scenario)
+            except (OSError, http.client.HTTPException):
+                ok = False
+                conn.close()
+                conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            latency = time.perf_counter() - t0
+            if time.time() >= measure_from:
+                samples.append((scenario["name"], latency, ok))
+        conn.close()
+        with self.lock:
+            for name, latency, ok in samples:
+                self.samples[name].append((latency, ok))
+
+    def run(self):
+        start = time.time()
+        measure_from = start + self.warmup
+        stop_at = measure_from + self.duration
+        threads = [threading.Thread(target=self.worker, args=(i, measure_from, stop_at), daemon=True)
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report(self.duration)
+
+    def report(self, elapsed):
+        projects = {}
+        for scenario in self.scenarios:
+            project = scenario["path"].lstrip("/").split("/")[0]
+            projects.setdefault(project, []).extend(self.samples[scenario["name"]])
+
+        all_samples = [sample for samples in self.samples.values() for sample in samples]
+        return {
+            "concurrency": self.concurrency,
+            "duration": elapsed,
+            "total": summarize(all_samples, elapsed),
+            "endpoints": {name: summarize(samples, elapsed) for name, samples in self.samples.items()},
+            "projects": {name: summarize(samples, elapsed) for name, samples in projects.items()},
+        }
+
+
+def fetch_token(base_url, username, password, timeout=30):
+    """
+        Log in to the admin api, :return: the bearer token of the user
+    """
+    url = urllib.parse.urlsplit(base_url)
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+    try:
+        conn.request("POST", "/admin/api/Users/login_user", body=json.dumps({"username": username, "password": password}),
+                     headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        body = response.read()
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"Login as {username} failed: {response.status} {body[:200]}")
+    return json.loads(body)["auth_token"]
+
+
+def print_report(report):
+    columns = ["requests", "errors", "rps", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"]
+    header = f"{'':<24}" + "".join(f"{col:>10}" for col in columns)
+
+    def print_rows(title, rows):
+        print(f"\n# {title}")
+        print(header)
+        for name, stats in rows.items():
+            print(f"{name[:24]:<24}" + "".join(f"{stats[col]:>10}" for col in columns))
+
+    print_rows("Endpoints", report["endpoints"])
+    print_rows("Projects", report["projects"])
+    print_rows("Total", {"all": report["total"]})
+
+
+def get_args():
+    argparser = argparse.ArgumentParser(description="MultiApp load test", epilog="Arguments after -- are passed to gals.py")
+    argparser.add_argument("-c", "--concurrency", default=8, help="Number of concurrent clients", type=int)
+    argparser.add_argument("-d", "--duration", default=30, help="Measurement duration (seconds)", type=float)
+    argparser.add_argument("-W", "--warmup", default=5, help="Warmup duration, not measured (seconds)", type=float)
+    argparser.add_argument("-m", "--mix", default=str(default_mix), help="Request mix (yaml)")
+    argparser.add_argument("--db", default=str(default_db), help="Sqlite database served by the test project")
+    argparser.add_argument("--project", default="nw", help="Name of the test project")
+    argparser.add_argument("--url", default=None, help="Run against an already running server instead of booting gals.py")
+    argparser.add_argument("--user", default="admin", help="Admin api user of the login: true scenarios")
+    argparser.add_argument("--password", default="p", help="Password of --user")
+    argparser.add_argument("--seed", default=None, help="Random seed, for reproducible request sequences", type=int)
+    argparser.add_argument("--json", default=None, help="Write the report as json to this file")
+    argparser.add_argument("--keep", action="store_true", help="Keep the scratch directory")
+    argparser.add_argument("server_args", nargs=argparse.REMAINDER, help="gals.py arguments")
+    args = argparser.parse_args()
+    if args.server_args and args.server_args[0] == "--":
+        args.server_args = args.server_args[1:]
+    return args
+
+
+def main():
+    args = get_args()
+    scenarios = load_mix(args.mix, args.project)
+    server_args = args.server_args or default_server_args
+
+    proc = None
+    workdir = None
+    base_url = args.url
+    try:
+        if not base_url:
+            workdir = Path(tempfile.mkdtemp(prefix="alsdock-loadtest-"))
+            env = prepare_workdir(workdir, args.project, args.db)
+            port = free_port()
+            proc = start_server(workdir, env, port, server_args, ready_path=f"/{args.project}/api/Category?page[limit]=1")
+            base_url = f"http://127.0.0.1:{port}"
+
+        log.info(f"Running {len(scenarios)} scenarios against {base_url}: "
+                 f"concurrency={args.concurrency}, warmup={args.warmup}s, duration={args.duration}s")
+        # the scenarios with login: true share the token of one login
+        token = fetch_token(base_url, args.user, args.password) if any(s.get("login") for s in scenarios) else None
+        runner = LoadRunner(base_url, scenarios, concurrency=args.concurrency, duration=args.duration,
+                            warmup=args.warmup, seed=args.seed, token=token)
+        report = runner.run()
+    finally:
+        if proc:
+            stop_server(proc)
+        if workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report["server_args"] = None if args.url else server_args
+    report["mix"] = args.mix
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as json_fp:
+            json.dump(report, json_fp, indent=2)
+        log.info(f"Report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""
+    Logging of the multiapp: the request threads queue the records, a background thread writes them
+
+    Configured with environment variables:
+
+        LOG_LEVEL = INFO           # level of the admin app and of the projects without a log level
+        LOG_FORMAT = json          # json: one object per line (time, level, logger, project, pid, thread, message), or text
+        LOG_QUEUE_SIZE = 10000     # queued records, the records logged while the queue is full are dropped
+        LOG_RATE = 20              # records per second of a call site (project, file and line), 0: no rate limit
+        LOG_SAMPLE = 100           # 1 of LOG_SAMPLE records of a call site over its rate is kept, 0: none
+        LOG_LEVEL_REFRESH = 30     # seconds between the reloads of the project levels
+
+    Logging doesn't block the request threads: the message is formatted by the thread that logs it (the
+    arguments may change after the call) and put in the queue, the record is dropped if the queue is full. The writer
+    thread writes the queued records to stderr.
+
+    The level of a project is the log_level of its Api row (DEBUG, INFO, WARNING...), it applies to the records
+    logged in the app context of the project. The logger levels set by the projects still apply. The levels are
+    applied when this worker updates an Api and are reloaded from the admin database by the writer thread
+    (the Apis updated by the other workers).
+
+    Records of a call site over its rate are sampled (per project), the next record written for the call site has the number
+    of records that were left out ("suppressed"). ERROR and CRITICAL records aren't sampled.
+
+    The console handlers the projects add to their loggers (api_logic_server_app, logic_logger) are removed
+    when the project is mounted, the records are written by the pipeline.
+
+    Counters per worker process: admin api Apis/log_stats
+"""
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from flask import current_app, has_app_context
+from sqlalchemy import event
+
+log = logging.getLogger()
+
+FORMATS = ("json", "text")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+DEFAULT_LEVEL = "INFO"
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_RATE = 20
+DEFAULT_SAMPLE = 100
+DEFAULT_REFRESH = 30
+BATCH_SIZE = 500  # records per write
+CLOSE_TIMEOUT = 5
+STOP = object()
+
+levels = {}  # project name -> level
+_formatter = logging.Formatter()
+_lock = threading.Lock()
+
+
+def parse_level(level):
+    """
+        :return: the numeric level of a level name or number, None if level isn't a level
+    """
+    if isinstance(level, int) or str(level).strip().isdigit():
+        return int(level)
+    level = logging.getLevelName(str(level).strip().upper())
+    return level if isinstance(level, int) else None
+
+
+default_level = parse_level(os.getenv("LOG_LEVEL", DEFAULT_LEVEL)) or logging.INFO
+
+
+class ProjectFilter(logging.Filter):
+    """
+        Level of the project of the record and rate limit of its call site
+    """
+
+    def __init__(self, rate, sample):
+        super().__init__()
+        self.rate = rate
+        self.sample = sample
+        self.suppressed = 0
+        self.sites = {}  # (project, file, line) -> [window start, records in the window, suppressed since the last record, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        project = current_app.name if has_app_context() else None
+        if record.levelno < levels.get(project, default_level):
+            return False
+        record.project = project
+        record.suppressed = 0
+        if not self.rate or record.levelno >= logging.ERROR:
+            return True
+        key = (project, record.pathname, record.lineno)
+        with self._lock:
+            site = self.sites.get(key)
+            if site is None:
+                site = self.sites[key] = [record.created, 0, 0, 0]
+            if record.created - site[0] >= 1:
+                site[0] = record.created
+                site[1] = 0
+            site[1] += 1
+            over = site[1] - self.rate
+            if over > 0 and (not self.sample or over % self.sample):
+                site[2] += 1
+                site[3] += 1
+                self.suppressed += 1
+                return False
+            record.suppressed = site[2]
+            site[2] = 0
+        return True
+
+    def top_sites(self, limit=10):
+        with self._lock:
+            sites = sorted(((key, site[3]) for key, site in self.sites.items() if site[3]), key=lambda item: item[1], reverse=True)[:limit]
+        return [{"project": project, "file": path, "line": line, "suppressed": suppressed} for (project, path, line), suppressed in sites]
+
+
+def format_time(record):
+    return datetime.datetime.fromtimestamp(record.created).isoformat(" ", timespec="milliseconds")
+
+
+def to_json(record):
+    entry = {
+        "time": format_time(record),
+        "level": record.levelname,
+        "logger": record.name,
+        "project": getattr(record, "project", None),
+        "pid": record.process,
+        "thread": record.threadName,
+        "message": record.message,
+    }
+    if getattr(record, "suppressed", 0):
+        entry["suppressed"] = record.suppressed
+    if record.exc_text:
+        entry["exception"] = record.exc_text
+    if record.stack_info:
+        entry["stack"] = record.stack_info
+    return json.dumps(entry, default=str)
+
+
+def to_text(record):
+    line = f"{format_time(record)} {record.levelname} [{getattr(record, 'project', None) or '-'}] {record.name}: {record.message}"
+    if getattr(record, "suppressed", 0):
+        line += f" ({record.suppressed} suppressed)"
+    if record.exc_text:
+        line += "\n" + record.exc_text
+    if record.stack_info:
+        line += "\n" + record.stack_info
+    return line
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+        Queue the records for the writer thread, drop them when the queue is full
+    """
+
+    def __init__(self, writer, queue_size):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.writer = writer
+        self.queue_size = queue_size
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = _formatter.formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.writer.closed:
+            self.writer.write([record])
+            return
+        if self.writer.pid != os.getpid():
+            self.writer.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter:
+    """
+        Thread that writes the queued records and reloads the project levels
+    """
+
+    def __init__(self, fmt, refresh):
+        self.format = to_text if fmt == "text" else to_json
+        self.refresh = refresh
+        self.load_levels = None  # function that returns the project levels
+        self.handler = None
+        self.written = 0
+        self.closed = False
+        self.pid = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # (re)start the thread: threads don't survive the fork of the gunicorn workers
+        with self._lock:
+            if self.pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            if self.pid is not None and self.pid != os.getpid():
+                # the queue (and its lock) of the parent process
+                self.handler.queue = queue.Queue(maxsize=self.handler.queue_size)
+            self.pid = os.getpid()
+            self.closed = False
+            self._thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+            self._thread.start()
+
+    def run(self):
+        next_refresh = time.monotonic() + self.refresh
+        while True:
+            try:
+                record = self.handler.queue.get(timeout=max(next_refresh - time.monotonic(), 0.1))
+            except queue.Empty:
+                record = None
+            batch = []
+            while record is not None and record is not STOP:
+                batch.append(record)
+                if len(batch) >= BATCH_SIZE:
+                    break
+                try:
+                    record = self.handler.queue.get_nowait()
+                except queue.Empty:
+                    record = None
+            if batch:
+                self.write(batch)
+            if record is STOP:
+                return
+            if time.monotonic() >= next_refresh:
+                next_refresh = time.monotonic() + self.refresh
+                self.reload_levels()
+
+    def write(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record))
+            except Exception as exc:
+                lines.append(f"Failed to format log record {record.name} {record.pathname}:{record.lineno}: {exc}")
+        stream = sys.stderr
+        try:
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+        except Exception:
+            return
+        self.written += len(records)
+
+    def reload_levels(self):
+        if self.load_levels is None:
+            return
+        try:
+            set_levels(self.load_levels())
+        except Exception as exc:
+            log.warning(f"Failed to load the project log levels: {exc}")
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """
+            Write the queued records and stop the thread
+        """
+        self.closed = True
+        thread = self._thread
+        if thread is None or not thread.is_alive() or self.pid != os.getpid():
+            return
+        try:
+            self.handler.queue.put(STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        thread.join(timeout)
+
+
+writer = LogWriter(LOG_FORMAT, float(os.getenv("LOG_LEVEL_REFRESH", DEFAULT_REFRESH)))
+handler = QueueHandler(writer, int(os.getenv("LOG_QUEUE_SIZE", DEFAULT_QUEUE_SIZE)))
+writer.handler = handler
+project_filter = ProjectFilter(int(os.getenv("LOG_RATE", DEFAULT_RATE)), int(os.getenv("LOG_SAMPLE", DEFAULT_SAMPLE)))
+handler.addFilter(project_filter)
+
+
+def apply_root_level():
+    # the records of the most verbose project reach the filter of the queue handler
+    logging.getLogger().setLevel(min([default_level, *levels.values()]))
+
+
+def set_level(project, level):
+    """
+        Set the log level of a project, the default level if level is empty
+    """
+    with _lock:
+        if level in (None, ""):
+            levels.pop(project, None)
+        elif parse_level(level) is None:
+            log.warning(f"{project}: invalid log level {level}")
+        else:
+            levels[project] = parse_level(level)
+        apply_root_level()
+
+
+def set_levels(project_levels):
+    """
+        Replace the project levels, :param project_levels: project name -> level
+    """
+    with _lock:
+        levels.clear()
+        for project, level in project_levels.items():
+            if level not in (None, "") and parse_level(level) is not None:
+                levels[project] = parse_level(level)
+        apply_root_level()
+
+
+def install_levels(api_class, load_levels):
+    """
+        Apply the log_level of the Api rows, load_levels returns the project levels from the admin database
+    """
+    def apply(mapper, connection, target):
+        set_level(target.name, target.log_level)
+
+    for event_name in ("after_insert", "after_update"):
+        event.listen(api_class, event_name, apply)
+    writer.load_levels = load_levels
+    writer.reload_levels()
+
+
+def capture_handlers():
+    """
+        Remove the console handlers of the loggers: the records propagate to the queue handler
+    """
+    for logger in list(logging.root.manager.loggerDict.values()):
+        if not isinstance(logger, logging.Logger) or logger.name.startswith("gunicorn"):
+            continue
+        for logger_handler in list(logger.handlers):
+            if type(logger_handler) is logging.StreamHandler and logger_handler.stream in (sys.stderr, sys.stdout):
+                logger.removeHandler(logger_handler)
+
+
+def setup_logging():
+    """
+        Replace the handlers of the root logger by the queue handler
+    """
+    root = logging.getLogger()
+    for root_handler in list(root.handlers):
+        root.removeHandler(root_handler)
+    root.addHandler(handler)
+    apply_root_level()
+    capture_handlers()
+    writer.start()
+    if LOG_FORMAT not in FORMATS:
+        log.warning(f"Invalid LOG_FORMAT {LOG_FORMAT}, using json")
+
+
+def close():
+    """
+        Write the queued records, the records logged afterwards are written by the thread that logs them
+    """
+    writer.close()
+
+
+def stats():
+    return {
+        "pid": os.getpid(),
+        "level": logging.getLevelName(default_level),
+        "levels": {project: logging.getLevelName(level) for project, level in levels.items()},
+        "queued": handler.queue.qsize(),
+        "queue_size": handler.queue_size,
+        "written": writer.written,
+        "dropped": handler.dropped,
+        "suppressed": project_filter.suppressed,
+        "suppressed_sites": project_filter.top_sites(),
+    }
+
+
+atexit.register(close)
@@ -0,0 +1,196 @@
+"""
+    Per-rule timing of the LogicBank logic of the projects
+
+    The LogicBank rule classes are instrumented once (install_logic_stats), the rules declared in the
+    logic/declare_logic.py of every project are timed when they fire during a flush:
+    * formulas, constraints, copies and (early/commit) row events: time per execution, 1 row
+    * sums and counts: time to compute the adjustment, rows = parent rows adjusted
+    * parent cascades (child formulas referring to changed parent attributes): rows = child rows updated
+
+    The time of a rule is its self time: the rules it triggers (the child rules of a cascade, the logic of
+    the rows inserted by a row event...) are timed under their own key, the totals don't count them twice.
+
+    The rule timings of a request are aggregated in flask.g, added to the project totals after the
+    request, logged when the logic took more than LOGIC_SLOW_MS (project config, default 100) and
+    returned in a Server-Timing header. The project totals are available at /<project>/logic_stats
+    (per worker process).
+"""
+import logging
+import threading
+import time
+from flask import g, has_app_context, jsonify
+
+log = logging.getLogger()
+logic_log = logging.getLogger("logic_logger")
+
+DEFAULT_SLOW_MS = 100
+
+_installed = False
+_lock = threading.Lock()
+_local = threading.local()
+project_stats = {}  # project name -> {"requests": .., "logic_ms": .., "rules": {rule key -> totals}}
+
+
+def rule_key(rule):
+    kind = type(rule).__name__
+    column = getattr(rule, "_column", None)
+    if column:
+        return f"{kind} {rule.table}.{column}"
+    label = getattr(rule, "_error_msg", None) or getattr(getattr(rule, "_function", None), "__name__", "")
+    return f"{kind} {rule.table} {label}"[:120]
+
+
+def current_timings():
+    """
+        The rule timings of the current request (or of the current thread outside requests)
+    """
+    if has_app_context():
+        if "logic_timings" not in g:
+            g.logic_timings = {}
+        return g.logic_timings
+    if not hasattr(_local, "timings"):
+        _local.timings = {}
+    return _local.timings
+
+
+def record(key, seconds, rows):
+    timings = current_timings()
+    entry = timings.get(key)
+    if entry is None:
+        entry = timings[key] = [0, 0.0, 0]
+    entry[0] += 1
+    entry[1] += seconds
+    entry[2] += rows
+
+
+def row_updates():
+    return getattr(_local, "row_updates", 0)
+
+
+def timed(method, rows=lambda rule, args, updates: 1, key=rule_key):
+    """
+        Wrap a rule method to record its self time, nested calls of the same rule (super().execute()) are timed once
+    """
+    def wrapper(rule, *args, **kwargs):
+        active = getattr(_local, "active", None)
+        if active is None:
+            active = _local.active = set()
+        if id(rule) in active:
+            return method(rule, *args, **kwargs)
+        active.add(id(rule))
+        nested = getattr(_local, "nested", None)
+        if nested is None:
+            nested = _local.nested = []
+        nested.append(0.0)  # time of the timed calls nested in this one
+        updates = row_updates()
+        start = time.perf_counter()
+        try:
+            return method(rule, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            active.discard(id(rule))
+            nested_seconds = nested.pop()
+            if nested:
+                nested[-1] += elapsed
+            record(key(rule), elapsed - nested_seconds, rows(rule, args, row_updates() - updates))
+
+    wrapper.__wrapped__ = method
+    return wrapper
+
+
+def adjusted_parents(rule, args, updates):
+    parent_adjustor = args[0]
+    return int(parent_adjustor.parent_logic_row is not None) + int(parent_adjustor.previous_parent_logic_row is not None)
+
+
+def install_logic_stats(app):
+    """
+        Instrument the LogicBank rules (once) and aggregate the timings of the requests of app
+    """
+    instrument_rules()
+
+    @app.after_request
+    def logic_stats_after_request(response):
+        timings = g.pop("logic_timings", None)
+        if not timings:
+            return response
+        total_ms = sum(entry[1] for entry in timings.values()) * 1000
+        add_request(app.name, timings, total_ms)
+        response.headers.add("Server-Timing", f"logic;dur={total_ms:.1f}")
+        if total_ms >= app.config.get("LOGIC_SLOW_MS", DEFAULT_SLOW_MS):
+            slowest = sorted(timings.items(), key=lambda item: item[1][1], reverse=True)[:5]
+            logic_log.info(f"{app.name} logic {total_ms:.1f}ms: " +
+                           ", ".join(f"{key} {entry[1] * 1000:.1f}ms x{entry[0]} ({entry[2]} rows)" for key, entry in slowest))
+        return response
+
+    @app.route("/logic_stats")
+    def logic_stats():
+        return jsonify(get_stats(app.name))
+
+    return app
+
+
+def add_request(project, timings, total_ms):
+    with _lock:
+        stats = project_stats.setdefault(project, {"requests": 0, "logic_ms": 0.0, "rules": {}})
+        stats["requests"] += 1
+        stats["logic_ms"] += total_ms
+        for key, (calls, seconds, rows) in timings.items():
+            rule_stats = stats["rules"].setdefault(key, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0})
+            rule_stats["calls"] += calls
+            rule_stats["total_ms"] += seconds * 1000
+            rule_stats["max_ms"] = max(rule_stats["max_ms"], seconds * 1000 / calls)
+            rule_stats["rows"] += rows
+
+
+def get_stats(project):
+    with _lock:
+        stats = project_stats.get(project, {"requests": 0, "logic_ms": 0.0, "rules": {}})
+        rules = [
+            dict(rule=key, avg_ms=round(rule["total_ms"] / rule["calls"], 3),
+                 **{k: round(v, 3) if isinstance(v, float) else v for k, v in rule.items()})
+            for key, rule in stats["rules"].items()
+        ]
+        return {
+            "project": project,
+            "requests": stats["requests"],
+            "logic_ms": round(stats["logic_ms"], 3),
+            "rules": sorted(rules, key=lambda rule: rule["total_ms"], reverse=True),
+        }
+
+
+def instrument_rules():
+    global _installed
+    with _lock:
+        if _installed:
+            return
+        _installed = True
+
+    from logic_bank.rule_type.formula import Formula
+    from logic_bank.rule_type.constraint import Constraint
+    from logic_bank.rule_type.copy import Copy
+    from logic_bank.rule_type.row_event import AbstractRowEvent
+    from logic_bank.rule_type.sum import Sum
+    from logic_bank.rule_type.count import Count
+    from logic_bank.extensions.allocate import Allocate
+    from logic_bank.extensions.copy_row import CopyRow
+    from logic_bank.exec_row_logic.logic_row import LogicRow
+
+    for rule_class in (Formula, Constraint, Copy, AbstractRowEvent, Allocate, CopyRow):
+        rule_class.execute = timed(rule_class.__dict__["execute"])
+    for rule_class in (Sum, Count):
+        rule_class.adjust_parent = timed(rule_class.__dict__["adjust_parent"], rows=adjusted_parents)
+
+    # count the row updates, used for the rows touched by cascades
+    update = LogicRow.update
+
+    def counting_update(logic_row, *args, **kwargs):
+        _local.row_updates = row_updates() + 1
+        return update(logic_row, *args, **kwargs)
+
+    LogicRow.update = counting_update
+    LogicRow.parent_cascade_attribute_changes_to_children = timed(
+        LogicRow.parent_cascade_attribute_changes_to_children,
+        rows=lambda logic_row, args, updates: updates,
+        key=lambda logic_row: f"Cascade {logic_row.name}")
+    log.info("LogicBank rule timing installed")
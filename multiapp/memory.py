@@ -0,0 +1,65 @@
+"""
+    Shared vs private memory of the server processes, from /proc/<pid>/smaps_rollup (linux)
+
+    With gals.py --preload the apps are built in the gunicorn master and the workers share its
+    pages copy-on-write: "shared" is what the workers still share with the master, "private" is
+    what each worker added or touched. "pss" divides the shared pages over the processes sharing them,
+    the sum of the pss of all processes is the actual memory use of the server.
+"""
+import os
+
+FIELDS = {
+    "Rss": "rss",
+    "Pss": "pss",
+    "Shared_Clean": "shared_clean",
+    "Shared_Dirty": "shared_dirty",
+    "Private_Clean": "private_clean",
+    "Private_Dirty": "private_dirty",
+    "Swap": "swap",
+}
+
+
+def smaps_rollup(pid="self"):
+    """
+        :return: dict with the memory usage of the process in KiB or None if it's not available
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as smaps_fp:
+            lines = smaps_fp.readlines()
+    except OSError:
+        return None
+
+    usage = {}
+    for line in lines:
+        key, _, value = line.partition(":")
+        if key in FIELDS:
+            usage[FIELDS[key]] = int(value.split()[0])
+    usage["shared"] = usage.get("shared_clean", 0) + usage.get("shared_dirty", 0)
+    usage["private"] = usage.get("private_clean", 0) + usage.get("private_dirty", 0)
+    return usage
+
+
+def children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children_fp:
+            return [int(child) for child in children_fp.read().split()]
+    except OSError:
+        return []
+
+
+def server_memory():
+    """
+        Memory usage of the gunicorn master (parent of this worker) and its worker processes
+
+        :return: dict with the usage per process (KiB) and the totals
+    """
+    master = os.getppid()
+    processes = {"master": {"pid": master, **(smaps_rollup(master) or {})}}
+    workers = []
+    for pid in children(master):
+        usage = smaps_rollup(pid)
+        if usage is not None:
+            workers.append({"pid": pid, "self": pid == os.getpid(), **usage})
+
+    total = {key: sum(p.get(key, 0) for p in [processes["master"]] + workers) for key in ("rss", "pss", "private")}
+    return {"unit": "KiB", "master": processes["master"], "workers": workers, "total": total}
@@ -0,0 +1,357 @@
+"""
+    Memory accounting of the mounted projects and eviction of idle projects
+
+    tracemalloc (started when MEMORY_TRACE or MEMORY_BUDGET_MB is set) attributes the memory of the
+    worker process to the projects:
+    * mount: snapshots are taken before and after the project app is created, the difference is the
+      memory of its modules, mappers, app and caches (the files that allocated the most are kept)
+    * traffic: the growth of the traced memory during every MEMORY_SAMPLE_EVERY-th request of a
+      project (default 20) is sampled, the samples times the interval estimate the memory the project
+      retained since its mount (caches, sessions...). Concurrent requests of other projects add noise.
+
+    With a budget (MEMORY_BUDGET_MB, per worker process), the least recently used projects are unmounted
+    while the estimated memory of the mounted projects exceeds the budget. Projects with requests in
+    progress or used less than MEMORY_MIN_IDLE seconds ago (default 300) aren't unmounted. Unmounting a
+    project removes its app from the dispatcher, closes the connections of its engines and drops its
+    entries from the registries and caches of the multiapp modules and its modules from sys.modules.
+    The next request of the project mounts it again, the request waits for the mount.
+
+    LogicBank.activate (api_logic_server_run) registers its session listeners at every mount, the
+    listeners of a class aren't deduplicated by sqlalchemy: the logic would run once more per mount,
+    after the audit listener. They're registered by the first activation only (install_logic_activation).
+
+    Usage per worker process: admin api Apis/project_memory
+"""
+import contextlib
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from safrs import SAFRSAPI, SAFRSBase
+from sqlalchemy import event
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from werkzeug.wsgi import ClosingIterator
+import audit
+import blobs
+import counts
+import filters
+import loading
+import profiler
+import recompute
+import resources
+import search
+import slow_queries
+import wrappers
+from pools import manager as pool_manager
+
+log = logging.getLogger()
+
+MEMORY_BUDGET = int(float(os.getenv("MEMORY_BUDGET_MB", 0)) * 1024 * 1024)
+MEMORY_TRACE = os.getenv("MEMORY_TRACE", "").lower() not in ("", "0", "false") or bool(MEMORY_BUDGET)
+SAMPLE_EVERY = max(int(os.getenv("MEMORY_SAMPLE_EVERY", 20)), 1)
+MIN_IDLE = float(os.getenv("MEMORY_MIN_IDLE", 300))
+TOP_FILES = 10
+
+projects = {}  # prefix -> ProjectMemory
+_installed = False
+_lock = threading.Lock()
+
+
+class ProjectMemory:
+    """
+        Memory attributed to a project and its usage
+    """
+
+    def __init__(self, name, prefix):
+        self.name = name
+        self.prefix = prefix
+        self.mount_bytes = 0
+        self.shared_bytes = 0  # libraries imported by the first mount, not released by an unmount
+        self.retained = 0
+        self.top_files = []
+        self.requests = 0
+        self.samples = 0
+        self.in_flight = 0
+        self.mounts = 0
+        self.evictions = 0
+        self.mounted = False
+        self.last_used = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def estimate(self):
+        return max(self.mount_bytes + self.retained, 0) if self.mounted else 0
+
+    def begin(self):
+        """
+            Start a request, :return: the traced memory if the request is sampled
+        """
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.last_used = time.time()
+            sampled = self.requests % SAMPLE_EVERY == 0
+        return tracemalloc.get_traced_memory()[0] if sampled and tracemalloc.is_tracing() else None
+
+    def end(self, traced):
+        with self._lock:
+            self.in_flight -= 1
+            self.last_used = time.time()
+            if traced is not None and tracemalloc.is_tracing():
+                self.retained += (tracemalloc.get_traced_memory()[0] - traced) * SAMPLE_EVERY
+                self.samples += 1
+
+    def to_dict(self):
+        return {
+            "project": self.name,
+            "prefix": self.prefix,
+            "mounted": self.mounted,
+            "estimate": self.estimate,
+            "mount_bytes": self.mount_bytes,
+            "shared_bytes": self.shared_bytes,
+            "retained": self.retained,
+            "top_files": [{"file": filename, "bytes": size} for filename, size in self.top_files],
+            "requests": self.requests,
+            "samples": self.samples,
+            "in_flight": self.in_flight,
+            "mounts": self.mounts,
+            "evictions": self.evictions,
+            "idle_for": round(time.time() - self.last_used, 1),
+        }
+
+
+def start_tracing():
+    if MEMORY_TRACE and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        log.info(f"Memory tracing started (budget: {MEMORY_BUDGET // (1024 * 1024)}MB)")
+
+
+def install_logic_activation():
+    """
+        Register the LogicBank session listeners once: the following activations only replace the rules
+    """
+    global _installed
+    with _lock:
+        if _installed:
+            return
+        _installed = True
+    from logic_bank.rule_bank import rule_bank_setup
+    from logic_bank.rule_bank.rule_bank import RuleBank
+    setup = rule_bank_setup.setup
+
+    def setup_once(a_session):
+        if not event.contains(a_session, "before_flush", rule_bank_setup.before_flush):
+            return setup(a_session)
+        rule_bank = RuleBank()  # singleton, as set up by setup
+        rule_bank.orm_objects = {}
+        rule_bank._at = datetime.now()
+        return rule_bank
+
+    rule_bank_setup.setup = setup_once
+
+
+def module_files(names, project_path):
+    """
+        :return: the files of the modules names that aren't part of the project
+    """
+    result = set()
+    for name in names:
+        module_file = getattr(sys.modules.get(name), "__file__", None)
+        if module_file and project_path not in Path(module_file).resolve().parents:
+            result.add(module_file)
+    return result
+
+
+@contextlib.contextmanager
+def measure_mount(name, prefix, project_path):
+    """
+        Attribute the memory allocated in the block (the mount of a project) to the project,
+        the memory of the modules that were imported for the first time (libraries) is shared
+    """
+    account = projects.get(prefix)
+    if account is None:
+        account = projects[prefix] = ProjectMemory(name, prefix)
+    if not tracemalloc.is_tracing():
+        yield account
+        return
+    gc.collect()
+    modules = set(sys.modules)
+    before = tracemalloc.take_snapshot()
+    try:
+        yield account
+    finally:
+        # grouped by file, without the snapshot itself (filter_traces would go through all the traces)
+        stats = [stat for stat in tracemalloc.take_snapshot().compare_to(before, "filename") if stat.traceback[0].filename != tracemalloc.__file__]
+        del before
+        shared = module_files(set(sys.modules) - modules, Path(project_path).resolve())
+        account.mount_bytes = sum(stat.size_diff for stat in stats if stat.traceback[0].filename not in shared)
+        account.shared_bytes += sum(stat.size_diff for stat in stats if stat.traceback[0].filename in shared)
+        account.retained = 0
+        account.top_files = [(stat.traceback[0].filename, stat.size_diff) for stat in stats[:TOP_FILES]]
+
+
+def clear_cache(attr, depth=3):
+    """
+        Clear the lru_cache of a method, classmethod or (class)property
+    """
+    if hasattr(attr, "cache_clear"):
+        attr.cache_clear()
+    elif depth:
+        for name in ("__func__", "fget", "expr", "func"):
+            if getattr(attr, name, None) is not None:
+                clear_cache(getattr(attr, name), depth - 1)
+
+
+def release(name, app, project_path):
+    """
+        Drop the engines, registry and cache entries and the modules of an unmounted project
+    """
+    classes = blobs.exposed_classes(app)
+    audit.close(name)
+    pool_manager.unregister(name)
+    recompute.projects.pop(name, None)
+    slow_queries.projects.pop(name, None)
+    wrappers.unregister(classes)
+    for cls in classes:
+        search.indexes.pop(cls, None)
+        counts.cache.invalidate(cls)
+        counts.cache.generations.pop(cls, None)
+        blobs.linked_columns.pop(cls, None)
+        blobs.cache.evict_class(cls)
+        filters.indexed_columns.pop(cls.__table__, None)
+        resources.caches.pop(cls, None)
+    loading.column_info.cache_clear()
+    # safrs keeps the exposed classes in a SAFRSAPI class attribute and in the lru caches of SAFRSBase methods
+    SAFRSAPI._als_resources[:] = [cls for cls in SAFRSAPI._als_resources if cls not in classes]
+    for attr in vars(SAFRSBase).values():
+        clear_cache(attr)
+    project_path = Path(project_path).resolve()
+    for module_name, module in list(sys.modules.items()):
+        module_file = getattr(module, "__file__", None)
+        if module_file and project_path in Path(module_file).resolve().parents:
+            del sys.modules[module_name]
+    gc.collect()
+
+
+def release_all(dispatcher):
+    """
+        Release the projects of a dispatcher whose apps are rebuilt (gals.py --preload reload)
+    """
+    for prefix in list(dispatcher.mounts):
+        if prefix in dispatcher.apis:
+            dispatcher.unmount(prefix)
+    pool_manager.unregister("admin")
+
+
+class ProjectDispatcher(DispatcherMiddleware):
+    """
+        Dispatch the requests to the project apps, mount the unmounted projects and apply the memory budget
+    """
+
+    def __init__(self, app, mounts, apis, mount):
+        """
+            :param apis: prefix -> Api of the projects
+            :param mount: function that creates the app of an Api, returns (prefix, app)
+        """
+        super().__init__(app, mounts)
+        self.apis = apis
+        self.mount = mount
+        self._lock = threading.RLock()
+        for prefix in mounts:
+            if prefix in projects:
+                projects[prefix].mounted = True
+                projects[prefix].mounts += 1
+
+    def __call__(self, environ, start_response):
+        prefix = "/" + environ.get("PATH_INFO", "").lstrip("/").split("/", 1)[0]
+        account = projects.get(prefix) if prefix in self.apis else None
+        if account is None:
+            return super().__call__(environ, start_response)
+        with self._lock:
+            # pinned before the mount check: apply_budget doesn't unmount a project with requests in flight
+            traced = account.begin()
+            mounted = prefix in self.mounts
+        if not mounted:
+            self.remount(prefix)
+            if prefix not in self.mounts:
+                account.end(traced)
+                return ServiceUnavailable(f"Project {prefix} can't be mounted")(environ, start_response)
+        entry = profiler.begin(prefix, environ)
+        try:
+            response = super().__call__(environ, start_response)
+        except BaseException:
+            account.end(traced)
+            profiler.end(entry)
+            raise
+        return ClosingIterator(response, lambda: self.finish(account, traced, entry))
+
+    def finish(self, account, traced, entry):
+        account.end(traced)
+        profiler.end(entry)
+        if MEMORY_BUDGET and traced is not None:
+            self.apply_budget(exclude=account.prefix)
+
+    def remount(self, prefix):
+        with self._lock:
+            if prefix in self.mounts:
+                return
+            api = self.apis[prefix]
+            start = time.time()
+            with measure_mount(api.name, prefix, api.path) as account:
+                api_prefix, app = self.mount(api)
+            if app is None:
+                log.error(f"Failed to mount {prefix}")
+                return
+            self.mounts[prefix] = app
+            account.mounted = True
+            account.mounts += 1
+            log.info(f"Mounted {prefix} ({time.time() - start:.2f}s, {account.mount_bytes // 1024}KiB)")
+        self.apply_budget(exclude=prefix)
+
+    def unmount(self, prefix):
+        with self._lock:
+            app = self.mounts.pop(prefix, None)
+            if app is None:
+                return
+            account = projects[prefix]
+            account.mounted = False
+            account.evictions += 1
+            release(account.name, app, self.apis[prefix].path)
+            log.info(f"Unmounted {prefix} ({account.mount_bytes // 1024}KiB mounted, {account.retained // 1024}KiB retained)")
+
+    def apply_budget(self, exclude=None):
+        """
+            Unmount the least recently used idle projects while the mounted projects exceed the budget
+        """
+        if not MEMORY_BUDGET:
+            return
+        with self._lock:
+            mounted = [projects[prefix] for prefix in self.mounts if prefix in projects]
+            total = sum(account.estimate for account in mounted)
+            now = time.time()
+            for account in sorted(mounted, key=lambda account: account.last_used):
+                if total <= MEMORY_BUDGET:
+                    break
+                if account.prefix == exclude or account.in_flight or now - account.last_used < MIN_IDLE:
+                    continue
+                total -= account.estimate
+                self.unmount(account.prefix)
+
+
+def stats():
+    traced, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (None, None)
+    return {
+        "pid": os.getpid(),
+        "tracing": tracemalloc.is_tracing(),
+        "traced": traced,
+        "traced_peak": peak,
+        "budget": MEMORY_BUDGET or None,
+        "mounted": sum(account.estimate for account in projects.values()),
+        "projects": sorted((account.to_dict() for account in projects.values()), key=lambda project: project["estimate"], reverse=True),
+    }
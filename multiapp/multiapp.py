@@ -2,14 +2,31 @@
 # gunicorn -w 4 app:application -b 0.0.0.0:5656  --threads 5 --error-logfile - --access-logfile - --reload 
 #
 
-from werkzeug.middleware.dispatcher import DispatcherMiddleware # use to combine each Flask app into a larger one that is dispatched based on prefix
 from flask import Flask, send_from_directory, redirect, send_file, make_response
-from admin_api import create_app as create_admin_api_app, User, Api
+from admin_api import create_app as create_admin_api_app, User, Api, api_log_levels
 from safrs import SAFRSAPI as SafrsApi, DB as db
 from flask import Flask, abort
 from flask_swagger_ui import get_swaggerui_blueprint
 from pathlib import Path
 from flask import request
+from sqlite_profile import apply_sqlite_profile
+from replicas import install_replicas
+from pools import manager as pool_manager
+from generator import generator
+from logic_stats import install_logic_stats
+from blobs import install_blob_endpoints
+from counts import install_counts
+from search import install_search
+from filters import install_filters
+from fast_json import install_json
+from resources import install_resource_cache
+from wrappers import register as register_project_classes
+from audit import install_audit
+from mounts import ProjectDispatcher, install_logic_activation, measure_mount, start_tracing
+from log_pipeline import setup_logging, install_levels, capture_handlers
+from profiler import install_profiler
+import recompute
+import slow_queries
 import yaml
 import importlib
 import sys
@@ -21,7 +38,7 @@ import tempfile
 import shutil
 import os
 
-logging.basicConfig()
+setup_logging()
 log = logging.getLogger()
 
 #
@@ -84,7 +101,7 @@ def create_api(app, host="localhost", port=5000, app_prefix="", api_prefix="/api
     for model in models:
         api.expose_object(model)
     api.expose_als_schema(api_root=f"//{host}:{port}{app_prefix}{api_prefix}")
-    print(f"Created API: http://{host}:{port}{app_prefix}{api_prefix}")
+    log.info(f"Created API: http://{host}:{port}{app_prefix}{api_prefix}")
     return api
 
 
@@ -99,6 +116,8 @@ def project_2_app(api, host, port):
     # Some  database timeout
     #api_app.config.from_object(f"{project}.config.Config")
     os.chdir(project)
+    # the config module of the previous project is cached, import the config.py of this project
+    sys.modules.pop("config", None)
     api_app.config.from_object(f"config.Config")
     api_app_prefix = f"/{api.api_path}"
     api_prefix = "/api"
@@ -132,9 +151,21 @@ def project_2_app(api, host, port):
     mod_spec.loader.exec_module(models_proj)
     
     db.init_app(api_app)
+    apply_sqlite_profile(api_app, db)
+    replica_router = install_replicas(api_app, db, api.replica_list)
+    install_logic_stats(api_app)
+    pool_manager.register(db.get_engine(api_app), api.name)
+    # LogicBank.activate (api_logic_server_run) replaced the rule bank with the rules of this project
+    recompute.register(api.name, db.get_engine(api_app), recompute.activated_rules())
+    slow_queries.register(api.name, db.get_engine(api_app), api_app.config)
+    for engine in getattr(replica_router, "engines", []):
+        pool_manager.register(engine, api.name, role="replica")
+        slow_queries.register(api.name, engine, api_app.config)
     with api_app.app_context():
         db.create_all()
         api_app.register_blueprint(swaggerui_blueprint, url_prefix=f"{api_prefix}")
+        # SAFRSAPI calls db.init_app again, which would replace the engine configured and instrumented above
+        sqlalchemy_state = api_app.extensions["sqlalchemy"]
         expose_models(api_app,
                         HOST=host, 
                         PORT=port, 
@@ -142,6 +173,18 @@ def project_2_app(api, host, port):
                         swaggerui_blueprint=swaggerui_blueprint,
                         api_spec_url=api_spec_url,
                         custom_swagger={"basePath" : f"{api_app_prefix}{api_prefix}", "host" : ""})
+        api_app.extensions["sqlalchemy"] = sqlalchemy_state
+        # the SAFRSBase wrappers (collection queries, serialization) apply to the classes of the projects only
+        register_project_classes(api_app)
+        # before the blob endpoints: the binary columns are left out of the fast attribute values by the blobs wrapper
+        install_json(api_app)
+        install_blob_endpoints(api_app, api_prefix)
+        install_filters(api_app, db.get_engine(api_app))
+        # before the counts: the count query of a collection includes the search
+        install_search(api_app, db.get_engine(api_app), project)
+        install_counts(api_app)
+        install_resource_cache(api_app)
+        install_audit(api_app, db)
 
     @api_app.after_request
     def after_request(response):
@@ -170,12 +213,41 @@ def project_2_app(api, host, port):
 
     @api_app.teardown_appcontext
     def shutdown_session(exception=None):
+        # removes the session of the thread or greenlet that handled the request
         db.session.remove()
 
     log.info(f"API: {api_url}")
     return api_app_prefix, api_app
 
 
+def mount_project(api, host, port):
+    """
+        Create the app of a project
+        :return: (prefix, app) or (None, None) if the project can't be loaded
+    """
+    api_path = Path(api.path)
+    if not api_path.is_dir():
+        log.error(f"Path {api_path.resolve()} does not exist!")
+        return None, None
+    log.info(f"Exposing project in {api_path.resolve()}")
+    cwd = os.getcwd()
+    sys.path.insert(0, str(api_path.resolve()))
+    log.info(str(sys.path))
+    #os.chdir(api_path.parent)
+    try:
+        result = project_2_app(api, host, port)
+        # the console handlers of the project loggers (api_logic_server_run)
+        capture_handlers()
+        return result
+    except Exception as exc:
+        log.exception(exc)
+        log.error(f"Failed to create project app! ({api})")
+        return None, None
+    finally:
+        sys.path.pop(0)
+        os.chdir(cwd)
+
+
 def create_app(args): 
     #
     # MultiApp initialization: 
@@ -183,43 +255,43 @@ def create_app(args):
     #
     host = args.hostname
     port = args.port_ext
+    start_tracing()
+    # before the projects: LogicBank.activate registers its session listeners at every mount
+    install_logic_activation()
+    # after gals.py set MULTIAPP_WORKERS: the budgets are divided by the number of workers
+    pool_manager.configure_from_env()
     
     #
     # Create the admin api (endpoints for /Users, /Apis)
     #
     admin_app = create_admin_api_app(host=host)
+    # /admin/profile: sampling profiler of the worker
+    install_profiler(admin_app)
     with admin_app.app_context():
         create_api(admin_app, host=host, port=port, app_prefix="/admin", api_prefix="/api", models = [User,Api])
         apis = admin_app.db.session.query(Api).all()
+        pool_manager.register(admin_app.db.get_engine(admin_app), "admin")
+    # per project log levels, reloaded by the log writer thread
+    install_levels(Api, lambda: api_log_levels(admin_app))
     
     api_apps= {'/admin': admin_app}
+    project_apis = {}
     for api in apis:
-        api_path = Path(api.path)
-        if not api_path.is_dir():
-            log.error(f"Path {api_path.resolve()} does not exist!")
-            continue
-        log.info(f"Exposing project in {api_path.resolve()}")
-        cwd = os.getcwd()
-        sys.path.insert(0, str(api_path.resolve()))
-        log.info(str(sys.path))
-        #os.chdir(api_path.parent)
-        try:
-            api_app_prefix, api_app = project_2_app(api, host, port)
-            if api_app:
-                api_apps[api_app_prefix] = api_app
-        except Exception as exc:
-            log.exception(exc)
-            log.error(f"Failed to create project app! ({api})")
-        sys.path.pop(0)
-        os.chdir(cwd)
+        with measure_mount(api.name, f"/{api.api_path}", api.path):
+            api_app_prefix, api_app = mount_project(api, host, port)
+        if api_app:
+            api_apps[api_app_prefix] = api_app
+            project_apis[api_app_prefix] = api
     
     sra_app = create_sra_app(ui_path=os.getenv("SRA_UI_PATH","ui"))
     with sra_app.app_context():
         create_api(sra_app, api_prefix="/api")
     # wsgi application
-    print('#'*60)
-    print(api_apps)
-    application = DispatcherMiddleware(sra_app, api_apps)
+    log.info(f"Mounted: {', '.join(api_apps)}")
+    # unmounted projects (memory budget) are mounted again by their next request
+    application = ProjectDispatcher(sra_app, api_apps, project_apis, lambda api: mount_project(api, host, port))
+    # import the ApiLogicServer generator ahead of the first Api.generate
+    generator.warm_up_background()
     
     return application
 
@@ -232,10 +304,14 @@ def get_args():
     argparser.add_argument("-P", "--port-ext", default=5656, help="Port of the API", type=int) 
     argparser.add_argument("-w", "--workers", default=(multiprocessing.cpu_count() * 2) + 1, help="Server workers", type=int) 
     argparser.add_argument("-t", "--threads", default=2, help="Server threads", type=int)
+    argparser.add_argument("-k", "--worker-class", default="gthread", choices=["gthread", "gevent"], help="Server worker type (gals.py)")
+    argparser.add_argument("--worker-connections", default=1000, help="Concurrent requests per gevent worker", type=int)
     argparser.add_argument("-e", "--error-log", default="-", help="Error Log", type=str)
     argparser.add_argument("-a", "--access-log", default="-", help="Access Log", type=str)
     argparser.add_argument("-v", "--verbose", default=logging.INFO, help="LogLevel (0-50)", type=int)
     argparser.add_argument("-o", "--options", default=None, help="Project options")
+    argparser.add_argument("--reload", action="store_true", help="Restart all workers when the code changes (development, gals.py)")
+    argparser.add_argument("--preload", action="store_true", help="Load the apps in the master process before forking the workers (gals.py)")
     argparser.add_argument("projects", action="store", nargs='*', default=[])
     args = argparser.parse_args()
    
@@ -0,0 +1,296 @@
+"""
+    Connection budget for the engines of the mounted projects
+
+    Every project engine (and replica engine) is registered with the `manager`, which limits the number
+    of open DBAPI connections in this process:
+    * DB_CONNECTION_BUDGET : total number of connections to all database servers
+    * DB_SERVER_BUDGET : number of connections per database server (host:port)
+    Both budgets are for the whole server and divided by the number of gunicorn workers (MULTIAPP_WORKERS),
+    they're read when the multiapp is created (configure_from_env, gals.py sets MULTIAPP_WORKERS after importing it).
+    A connect that exceeds the budget first closes the idle pooled connections of other projects and
+    then waits up to DB_CONNECT_WAIT seconds for a connection to be closed.
+
+    The idle pooled connections of projects that haven't been used for DB_POOL_IDLE_TIMEOUT seconds
+    are closed by a background thread. SQLite engines are tracked but don't count towards the budget.
+"""
+import logging
+import os
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+log = logging.getLogger()
+
+BUDGET_KEY = "_budget_server"
+GENERATION_KEY = "_pool_generation"
+
+
+def env_int(name, default=None):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def close_idle(info):
+    """
+        Close the connections that are checked in to the pool of a registered engine: the engine gets a new
+        pool, the connections that are checked out of the old pool are closed when they're checked in
+        :return: number of closed connections
+    """
+    pool = info.engine.pool
+    count = pool.checkedin() if hasattr(pool, "checkedin") else 0
+    if not count or (not isinstance(pool, QueuePool) and pool.checkedout()):
+        return 0
+    info.generation += 1
+    info.engine.dispose()  # closes the checked in connections ("close" event, which releases the budget)
+    return count
+
+
+class EngineInfo:
+    """
+        Usage statistics of a registered engine
+    """
+
+    def __init__(self, engine, project, role, server, budgeted):
+        self.engine = engine
+        self.project = project
+        self.role = role
+        self.server = server
+        self.budgeted = budgeted
+        self.opened = 0
+        self.closed = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.reaped = 0
+        self.generation = 0  # pools replaced by close_idle
+        self.last_used = time.time()
+
+    @property
+    def checked_out(self):
+        return self.engine.pool.checkedout() if hasattr(self.engine.pool, "checkedout") else 0
+
+    @property
+    def idle(self):
+        return self.engine.pool.checkedin() if hasattr(self.engine.pool, "checkedin") else 0
+
+    def to_dict(self):
+        return {
+            "project": self.project,
+            "role": self.role,
+            "server": self.server,
+            "budgeted": self.budgeted,
+            "open": self.opened - self.closed,
+            "checked_out": self.checked_out,
+            "idle": self.idle,
+            "opened": self.opened,
+            "checkouts": self.checkouts,
+            "waits": self.waits,
+            "timeouts": self.timeouts,
+            "reaped": self.reaped,
+            "idle_for": round(time.time() - self.last_used, 1),
+        }
+
+
+class ConnectionManager:
+    """
+        Tracks the open connections of the registered engines and enforces the budgets
+    """
+
+    def __init__(self, budget=None, server_budget=None, idle_timeout=300, connect_wait=30, workers=1):
+        self.engines = []
+        self.open = {}  # server -> number of open budgeted connections
+        self._cond = threading.Condition()
+        self._reaper = None
+        self.configure(budget, server_budget, idle_timeout, connect_wait, workers)
+
+    def configure(self, budget=None, server_budget=None, idle_timeout=300, connect_wait=30, workers=1):
+        workers = max(workers, 1)
+        self.budget = max(budget // workers, 1) if budget else None
+        self.server_budget = max(server_budget // workers, 1) if server_budget else None
+        self.idle_timeout = idle_timeout
+        self.connect_wait = connect_wait
+        return self
+
+    def configure_from_env(self):
+        return self.configure(budget=env_int("DB_CONNECTION_BUDGET"),
+                              server_budget=env_int("DB_SERVER_BUDGET"),
+                              idle_timeout=env_int("DB_POOL_IDLE_TIMEOUT", 300),
+                              connect_wait=env_int("DB_CONNECT_WAIT", 30),
+                              workers=env_int("MULTIAPP_WORKERS", 1))
+
+    @staticmethod
+    def server_key(engine):
+        url = engine.url
+        if engine.dialect.name == "sqlite":
+            return f"sqlite:///{url.database}"
+        return f"{url.get_backend_name()}://{url.host or 'localhost'}:{url.port or ''}"
+
+    @property
+    def open_total(self):
+        return sum(self.open.values())
+
+    def register(self, engine, project, role="primary"):
+        """
+            Track the connections of engine and apply the budget to it
+        """
+        budgeted = engine.dialect.name != "sqlite"
+        info = EngineInfo(engine, project, role, self.server_key(engine), budgeted)
+        self.engines.append(info)
+
+        @event.listens_for(engine, "do_connect")
+        def do_connect(dialect, conn_rec, cargs, cparams):
+            if info.budgeted:
+                self.acquire(info)
+            try:
+                connection = dialect.connect(*cargs, **cparams)
+            except Exception:
+                if info.budgeted:
+                    self.release(info.server)
+                raise
+            if info.budgeted:
+                conn_rec.info[BUDGET_KEY] = info.server
+            info.opened += 1
+            return connection
+
+        @event.listens_for(engine, "checkout")
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            info.checkouts += 1
+            info.last_used = time.time()
+            connection_record.info[GENERATION_KEY] = info.generation
+
+        @event.listens_for(engine, "checkin")
+        def checkin(dbapi_connection, connection_record):
+            # the pool of the connection was replaced by close_idle while it was checked out
+            if dbapi_connection is not None and connection_record.info.get(GENERATION_KEY, info.generation) != info.generation:
+                connection_record.invalidate()
+
+        @event.listens_for(engine, "close")
+        def close(dbapi_connection, connection_record):
+            info.closed += 1
+            server = connection_record.info.pop(BUDGET_KEY, None)
+            if server:
+                self.release(server)
+
+        @event.listens_for(engine, "detach")
+        def detach(dbapi_connection, connection_record):
+            # detached connections are no longer managed by the pool
+            info.closed += 1
+            server = connection_record.info.pop(BUDGET_KEY, None)
+            if server:
+                self.release(server)
+
+        self.start_reaper()
+        return engine
+
+    def available(self, server):
+        if self.budget and self.open_total >= self.budget:
+            return False
+        if self.server_budget and self.open.get(server, 0) >= self.server_budget:
+            return False
+        return True
+
+    def acquire(self, info):
+        """
+            Reserve a connection slot for info.server, closing idle pooled connections or waiting if the budget is exhausted
+        """
+        with self._cond:
+            if self.available(info.server):
+                self.open[info.server] = self.open.get(info.server, 0) + 1
+                return
+
+        info.waits += 1
+        self.reap(idle_timeout=0, exclude=info)
+        deadline = time.time() + self.connect_wait
+        with self._cond:
+            while not self.available(info.server):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    info.timeouts += 1
+                    raise PoolTimeoutError(f"Connection budget exhausted for {info.server} "
+                                           f"(open: {self.open.get(info.server, 0)}, total: {self.open_total})")
+                self._cond.wait(remaining)
+            self.open[info.server] = self.open.get(info.server, 0) + 1
+
+    def release(self, server):
+        with self._cond:
+            self.open[server] = max(self.open.get(server, 0) - 1, 0)
+            self._cond.notify()
+
+    def reap(self, idle_timeout=None, exclude=None):
+        """
+            Close the idle pooled connections of the engines that weren't used for idle_timeout seconds,
+            least recently used first
+
+            :return: number of closed connections
+        """
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        now = time.time()
+        reaped = 0
+        for info in sorted(self.engines, key=lambda info: info.last_used):
+            if info is exclude or not info.idle or now - info.last_used < idle_timeout:
+                continue
+            closed = close_idle(info)
+            if closed:
+                log.debug(f"Closed {closed} idle connection(s) of {info.project} ({info.role}, {info.server})")
+            info.reaped += closed
+            reaped += closed
+        return reaped
+
+    def start_reaper(self):
+        if not self.idle_timeout or (self._reaper and self._reaper.is_alive()):
+            return
+
+        def reaper():
+            while True:
+                time.sleep(max(self.idle_timeout / 2, 1))
+                try:
+                    self.reap()
+                except Exception as exc:
+                    log.exception(exc)
+
+        self._reaper = threading.Thread(target=reaper, name="pool-reaper", daemon=True)
+        self._reaper.start()
+
+    def unregister(self, project):
+        """
+            Close the pooled connections of the engines of project and stop tracking them
+        """
+        infos = [info for info in self.engines if info.project == project]
+        self.engines = [info for info in self.engines if info.project != project]
+        for info in infos:
+            info.engine.dispose()  # closes the checked in connections, which releases the budget
+        return len(infos)
+
+    def dispose_all(self):
+        for info in self.engines:
+            info.engine.dispose()
+
+    def stats(self, project=None):
+        """
+            :param project: only return the engines of this project
+            :return: pool usage statistics
+        """
+        engines = [info.to_dict() for info in self.engines if project is None or info.project == project]
+        servers = {}
+        for info in engines:
+            server = servers.setdefault(info["server"], {"open": 0, "checked_out": 0, "idle": 0, "budgeted": info["budgeted"]})
+            for key in ("open", "checked_out", "idle"):
+                server[key] += info[key]
+        for server, count in self.open.items():
+            servers.setdefault(server, {})["budget_open"] = count
+
+        return {
+            "pid": os.getpid(),
+            "budget": self.budget,
+            "server_budget": self.server_budget,
+            "idle_timeout": self.idle_timeout,
+            "open": self.open_total,
+            "servers": servers,
+            "engines": engines,
+        }
+
+
+# configured by create_app (multiapp.py)
+manager = ConnectionManager()
@@ -0,0 +1,233 @@
+"""
+    Sampling profiler and watchdog of the project requests
+
+    Profile: GET /admin/profile?seconds=10&project=db2&interval_ms=10 (admin api authentication)
+
+    The stacks of the requests of the project (of all the threads of the worker without project) are sampled
+    every interval_ms during seconds (max PROFILE_MAX_SECONDS) in the worker process serving the request.
+    The response is a collapsed stacks file (one "frame;frame;...;frame count" line per stack) for
+    flamegraph.pl, speedscope or inferno:
+
+        curl -H "Authorization: Bearer $TOKEN" "http://localhost:5656/admin/profile?project=db2" > db2.folded
+        flamegraph.pl db2.folded > db2.svg
+
+    The sampler and the watchdog run in threads of the operating system, with gevent workers they also sample
+    the requests that don't yield (the suspended greenlets are sampled from their frame). Without project,
+    the gevent workers only show the running greenlet.
+
+    Watchdog: the stack of a request running longer than WATCHDOG_SECONDS (default 30, 0 disables the watchdog)
+    is logged (once per request).
+"""
+import _thread
+import collections
+import functools
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+from flask import abort, make_response, request
+from green import is_green
+
+log = logging.getLogger()
+
+MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 60))
+WATCHDOG_SECONDS = float(os.getenv("WATCHDOG_SECONDS", 30))
+DEFAULT_INTERVAL_MS = 10
+MAX_DEPTH = 200
+
+active = {}  # id -> ActiveRequest, the requests of the projects in progress
+_green = None
+_profile_lock = threading.Lock()
+_watchdog_pid = None
+_watchdog_lock = threading.Lock()
+
+
+def original(module, name):
+    """
+        :return: the function of the standard library, not patched by gevent
+    """
+    if is_green():
+        from gevent.monkey import get_original
+        return get_original(module, name)
+    return getattr(importlib.import_module(module), name)
+
+
+class ActiveRequest:
+    """
+        Request of a project in progress and the thread (or greenlet) serving it
+    """
+
+    __slots__ = ("prefix", "method", "path", "start", "thread", "thread_name", "greenlet", "dumped")
+
+    def __init__(self, prefix, environ):
+        global _green
+        if _green is None:
+            _green = is_green()
+        self.prefix = prefix
+        self.method = environ.get("REQUEST_METHOD")
+        self.path = environ.get("PATH_INFO")
+        self.start = time.monotonic()
+        self.thread = original("_thread", "get_ident")() if _green else _thread.get_ident()
+        self.thread_name = threading.current_thread().name
+        self.greenlet = None
+        if _green:
+            from greenlet import getcurrent
+            self.greenlet = getcurrent()
+        self.dumped = False
+
+    def frame(self, frames):
+        """
+            :param frames: sys._current_frames()
+        """
+        if self.greenlet is not None and self.greenlet.gr_frame is not None:
+            return self.greenlet.gr_frame  # suspended greenlet
+        return frames.get(self.thread)
+
+
+def begin(prefix, environ):
+    entry = ActiveRequest(prefix, environ)
+    active[id(entry)] = entry
+    if WATCHDOG_SECONDS and _watchdog_pid != os.getpid():
+        start_watchdog()
+    return entry
+
+
+def end(entry):
+    active.pop(id(entry), None)
+
+
+def run_native(target, *args):
+    """
+        Run target in a thread of the operating system and wait for its result
+    """
+    result = []
+
+    def run():
+        try:
+            result.append((target(*args), None))
+        except Exception as exc:
+            result.append((None, exc))
+
+    original("_thread", "start_new_thread")(run, ())
+    while not result:
+        time.sleep(0.05)  # yields to the other greenlets with gevent
+    value, exc = result[0]
+    if exc is not None:
+        raise exc
+    return value
+
+
+@functools.lru_cache(maxsize=4096)
+def short_filename(filename):
+    """
+        :return: filename relative to its sys.path directory
+    """
+    for path in sorted((path for path in sys.path if path), key=len, reverse=True):
+        if filename.startswith(path.rstrip(os.sep) + os.sep):
+            return filename[len(path.rstrip(os.sep)) + 1:]
+    return filename
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({short_filename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame):
+    """
+        :return: the stack of frame, outermost frame first, separated by ";"
+    """
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def sample(seconds, prefix=None, interval=DEFAULT_INTERVAL_MS / 1000, exclude=()):
+    """
+        Sample the stacks of the requests of the project prefix (all threads if prefix is None)
+        :return: stack -> samples, number of samples
+    """
+    stacks = collections.Counter()
+    samples = 0
+    exclude = set(exclude) | {original("_thread", "get_ident")()}
+    sleep = original("time", "sleep")
+    end_time = time.monotonic() + seconds
+    while time.monotonic() < end_time:
+        frames = sys._current_frames()
+        if prefix is None:
+            sampled = [frame for thread, frame in frames.items() if thread not in exclude]
+        else:
+            sampled = [entry.frame(frames) for entry in list(active.values()) if entry.prefix == prefix]
+        for frame in sampled:
+            if frame is not None:
+                stacks[collapse(frame)] += 1
+        del frames, sampled
+        samples += 1
+        sleep(interval)
+    return stacks, samples
+
+
+def watchdog():
+    sleep = original("time", "sleep")
+    interval = min(max(WATCHDOG_SECONDS / 4, 0.5), 5)
+    while True:
+        sleep(interval)
+        now = time.monotonic()
+        slow = [entry for entry in list(active.values()) if not entry.dumped and now - entry.start > WATCHDOG_SECONDS]
+        if not slow:
+            continue
+        frames = sys._current_frames()
+        for entry in slow:
+            entry.dumped = True
+            frame = entry.frame(frames)
+            stack = collapse(frame).replace(";", "\n") if frame is not None else "(stack not available)"
+            log.warning(f"{entry.prefix}: {entry.method} {entry.path} running for {now - entry.start:.1f}s ({entry.thread_name}):\n{stack}")
+        del frames
+
+
+def start_watchdog():
+    # (re)start the thread: threads don't survive the fork of the gunicorn workers
+    global _watchdog_pid
+    with _watchdog_lock:
+        if _watchdog_pid == os.getpid():
+            return
+        _watchdog_pid = os.getpid()
+        original("_thread", "start_new_thread")(watchdog, ())
+
+
+def install_profiler(app):
+    """
+        Add the /profile endpoint to the admin app
+    """
+    @app.route("/profile")
+    def profile():
+        from mounts import projects
+        try:
+            seconds = min(float(request.args.get("seconds", 10)), MAX_SECONDS)
+            interval = max(float(request.args.get("interval_ms", DEFAULT_INTERVAL_MS)), 1) / 1000
+        except ValueError:
+            abort(400, "seconds and interval_ms must be numbers")
+        project = request.args.get("project", "").strip("/")
+        prefix = f"/{project}" if project else None
+        if prefix is not None and prefix not in projects:
+            abort(404, f"Unknown project {project}")
+        if not _profile_lock.acquire(blocking=False):
+            abort(409, "A profile is in progress in this worker")
+        try:
+            log.info(f"Profiling {prefix or 'all threads'} for {seconds}s")
+            caller = original("_thread", "get_ident")()
+            stacks, samples = run_native(sample, seconds, prefix, interval, (caller,))
+        finally:
+            _profile_lock.release()
+        body = "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        response = make_response(body)
+        response.mimetype = "text/plain"
+        response.headers["Content-Disposition"] = f"attachment; filename=profile-{project or 'all'}-{os.getpid()}.folded"
+        response.headers["X-Profile-Samples"] = str(samples)
+        return response
+
+    return app
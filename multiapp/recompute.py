@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+"""
+    Set-based recompute of the derived columns of a project
+
+    The LogicBank rules maintain the derived columns (Customer.Balance, Order.AmountTotal,
+    OrderDetail.Amount...) row by row when the ORM writes. After a bulk load or a change made
+    outside the api they can be out of date. Instead of replaying every row through the ORM, the
+    declared rules are translated to SQL and the columns are checked or rebuilt with one UPDATE
+    per chunk of parent rows:
+    * Rule.sum / Rule.count: correlated SUM / COUNT subquery over the child rows (the "where"
+      lambda or string becomes part of the subquery)
+    * Rule.formula with as_expression / as_exp: the expression over the columns of the row and
+      its parents (row.Order.ShipCountry becomes a subquery)
+    Formulas with `calling` functions and where conditions that can't be translated (function calls,
+    python methods) are skipped and reported. Rule.copy isn't recomputed: copied values are
+    snapshots taken when the child was created (eg. OrderDetail.UnitPrice), not derivations.
+
+    The columns are processed in dependency order (OrderDetail.Amount before Order.AmountTotal
+    before Customer.Balance), in chunks of RECOMPUTE_CHUNK_SIZE rows (default 10000) by primary
+    key, each chunk in its own transaction. Only the rows whose value differs (numbers: more than
+    RECOMPUTE_TOLERANCE, or NULL and a value) are updated. The aggregates use the foreign key columns of the child
+    tables, these should be indexed.
+
+    The recompute doesn't lock the tables, run it when the project isn't written to.
+
+        python recompute.py path/to/project             # verify: count the rows that are out of date
+        python recompute.py path/to/project --repair    # update them
+
+    In the server: admin api Apis/{id}/recompute
+"""
+import argparse
+import ast
+import datetime
+import decimal
+import importlib
+import inspect
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+from sqlalchemy import and_, or_, not_, case, func, literal, select, create_engine, Numeric, Integer, Float
+from sqlalchemy.orm import class_mapper, RelationshipProperty, ColumnProperty
+from sqlalchemy.orm.interfaces import MANYTOONE
+
+log = logging.getLogger()
+
+CHUNK_SIZE = int(os.getenv("RECOMPUTE_CHUNK_SIZE", 10000))
+TOLERANCE = float(os.getenv("RECOMPUTE_TOLERANCE", 1e-6))
+
+LITERAL_TYPES = (int, float, str, bool, decimal.Decimal, datetime.date, datetime.datetime)
+SQL_FUNCTIONS = {"abs": func.abs, "round": func.round, "min": func.min, "max": func.max}
+
+projects = {}  # project name -> (engine, rules) of the projects mounted in this process
+
+
+class Untranslatable(Exception):
+    """
+        The rule can't be expressed in SQL
+    """
+
+
+def register(project, engine, rules):
+    """
+        Register the engine and the LogicBank rules of a mounted project
+    """
+    projects[project] = (engine, list(rules))
+
+
+def activated_rules():
+    """
+        :return: the rules of the LogicBank RuleBank, LogicBank.activate replaces them for every project
+    """
+    from logic_bank.rule_bank.rule_bank import RuleBank
+    return [rule for table_rules in RuleBank().orm_objects.values() for rule in table_rules.rules]
+
+
+#
+# rule lambdas -> sql expressions
+#
+class RowRef:
+    """
+        The `row` of a rule: the columns of a mapped class, parents are reached through its many-to-one relationships
+    """
+
+    def __init__(self, cls, reads, child=None, relationship=None):
+        self.cls = cls
+        self.mapper = class_mapper(cls)
+        self.table = self.mapper.local_table
+        self.reads = reads
+        self.child = child
+        self.relationship = relationship
+
+    def attribute(self, name):
+        prop = self.mapper.attrs.get(name)
+        if isinstance(prop, ColumnProperty):
+            self.reads.add((self.cls.__name__, name))
+            column = prop.columns[0]
+            if self.child is None:
+                return column
+            # parent attribute: correlated lookup of the parent row
+            return select([column]).where(join_condition(self.relationship)).as_scalar()
+        if isinstance(prop, RelationshipProperty) and prop.direction is MANYTOONE and self.child is None:
+            return RowRef(prop.mapper.class_, self.reads, child=self, relationship=prop)
+        raise Untranslatable(f"{self.cls.__name__}.{name} is not a column or parent of {self.cls.__name__}")
+
+
+def join_condition(relationship):
+    return and_(*[left == right for left, right in relationship.local_remote_pairs])
+
+
+def source(node):
+    return ast.unparse(node) if hasattr(ast, "unparse") else type(node).__name__  # python >= 3.9
+
+
+class Translator:
+    """
+        Evaluates the ast of a rule expression with sqlalchemy columns instead of row values
+    """
+
+    def __init__(self, row, row_name="row", names=None):
+        self.row = row
+        self.row_name = row_name
+        self.names = names or {}
+
+    def translate(self, node):
+        method = getattr(self, f"visit_{type(node).__name__}", None)
+        if method is None:
+            raise Untranslatable(f"unsupported expression: {source(node)}")
+        return method(node)
+
+    def visit_Expression(self, node):
+        return self.translate(node.body)
+
+    def visit_Name(self, node):
+        if node.id == self.row_name:
+            return self.row
+        if node.id in ("None", "True", "False"):
+            return {"None": None, "True": True, "False": False}[node.id]
+        value = self.names.get(node.id)
+        if not isinstance(value, LITERAL_TYPES):
+            raise Untranslatable(f"unsupported name: {node.id}")
+        return value
+
+    def visit_Constant(self, node):
+        return node.value
+
+    visit_NameConstant = visit_Num = visit_Str = visit_Constant  # python < 3.8
+
+    def visit_Attribute(self, node):
+        value = self.translate(node.value)
+        if not isinstance(value, RowRef):
+            raise Untranslatable(f"unsupported attribute: .{node.attr}")
+        return value.attribute(node.attr)
+
+    def visit_BinOp(self, node):
+        left, right = self.translate(node.left), self.translate(node.right)
+        operators = {ast.Add: lambda: left + right, ast.Sub: lambda: left - right, ast.Mult: lambda: left * right,
+                     ast.Div: lambda: left / right, ast.Mod: lambda: left % right}
+        if type(node.op) not in operators:
+            raise Untranslatable(f"unsupported operator: {type(node.op).__name__}")
+        return operators[type(node.op)]()
+
+    def visit_UnaryOp(self, node):
+        operand = self.translate(node.operand)
+        if isinstance(node.op, ast.USub):
+            return -operand
+        if isinstance(node.op, ast.Not):
+            return not_(operand)
+        raise Untranslatable(f"unsupported operator: {type(node.op).__name__}")
+
+    def visit_BoolOp(self, node):
+        values = [self.translate(value) for value in node.values]
+        return and_(*values) if isinstance(node.op, ast.And) else or_(*values)
+
+    def visit_Compare(self, node):
+        left = self.translate(node.left)
+        conditions = []
+        for op, comparator in zip(node.ops, node.comparators):
+            right = self.translate(comparator)
+            conditions.append(self.compare(op, left, right))
+            left = right
+        return and_(*conditions) if len(conditions) > 1 else conditions[0]
+
+    @staticmethod
+    def compare(op, left, right):
+        if isinstance(op, (ast.Is, ast.IsNot)):
+            if right is not None:
+                raise Untranslatable("'is' comparison with something else than None")
+            return left.is_(None) if isinstance(op, ast.Is) else left.isnot(None)
+        if isinstance(op, (ast.In, ast.NotIn)):
+            if not isinstance(right, (list, tuple)):
+                raise Untranslatable("'in' requires a list or tuple")
+            return left.in_(right) if isinstance(op, ast.In) else left.notin_(right)
+        operators = {ast.Eq: "__eq__", ast.NotEq: "__ne__", ast.Lt: "__lt__",
+                     ast.LtE: "__le__", ast.Gt: "__gt__", ast.GtE: "__ge__"}
+        if not hasattr(left, "comparator"):
+            left = literal(left)  # constant on the left side
+        return getattr(left, operators[type(op)])(right)
+
+    def visit_Tuple(self, node):
+        return tuple(self.translate(element) for element in node.elts)
+
+    visit_List = visit_Tuple
+
+    def visit_IfExp(self, node):
+        return case([(self.translate(node.test), self.translate(node.body))], else_=self.translate(node.orelse))
+
+    def visit_Call(self, node):
+        name = getattr(node.func, "id", None)
+        if node.keywords or name not in SQL_FUNCTIONS and name not in ("Decimal", "int", "float"):
+            raise Untranslatable(f"unsupported call: {source(node)}")
+        args = [self.translate(arg) for arg in node.args]
+        if name in SQL_FUNCTIONS:
+            return SQL_FUNCTIONS[name](*args)
+        if not all(isinstance(arg, LITERAL_TYPES) for arg in args):
+            raise Untranslatable(f"{name}() of a column")
+        return {"Decimal": decimal.Decimal, "int": int, "float": float}[name](*args)
+
+
+_sources = {}
+
+
+def lambda_ast(function, keyword):
+    """
+        :return: the ast.Lambda of function, found in the source file of the rule declaration
+    """
+    fn = inspect.getsourcefile(function)
+    if fn not in _sources:
+        _sources[fn] = ast.parse(Path(fn).read_text())
+    line = function.__code__.co_firstlineno
+    lambdas = [node for node in ast.walk(_sources[fn]) if isinstance(node, ast.Lambda) and node.lineno == line]
+    if len(lambdas) > 1:
+        # several lambdas on a line: use the one passed as keyword
+        lambdas = [kw.value for call in ast.walk(_sources[fn]) if isinstance(call, ast.Call)
+                   for kw in call.keywords if kw.arg == keyword and kw.value in lambdas]
+    if len(lambdas) != 1:
+        raise Untranslatable(f"can't find the source of the {keyword} lambda")
+    return lambdas[0]
+
+
+def translate(expression, row, keyword):
+    """
+        Translate the `where`, `as_exp` or `as_expression` of a rule: a string or lambda over `row`
+    """
+    if isinstance(expression, str):
+        return Translator(row).translate(ast.parse(expression.strip(), mode="eval"))
+    if not callable(expression) or not hasattr(expression, "__code__"):
+        raise Untranslatable(f"unsupported {keyword}")
+    node = lambda_ast(expression, keyword)
+    if len(node.args.args) != 1:
+        raise Untranslatable(f"{keyword} lambda must have one argument")
+    closure = inspect.getclosurevars(expression)
+    names = {**closure.globals, **closure.nonlocals}
+    return Translator(row, node.args.args[0].arg, names).translate(node.body)
+
+
+#
+# derived columns
+#
+class DerivedColumn:
+    """
+        A column derived by a rule and the sql expression computing it for a row of its table
+    """
+
+    def __init__(self, rule, cls, column, expression, reads):
+        self.rule = rule
+        self.cls = cls
+        self.table = class_mapper(cls).local_table
+        self.column = column
+        self.expression = expression
+        self.reads = reads
+
+    @property
+    def name(self):
+        return f"{self.cls.__name__}.{self.column.key}"
+
+    @property
+    def kind(self):
+        return type(self.rule).__name__
+
+    def differs(self):
+        """
+            :return: condition selecting the rows where the stored value is out of date
+        """
+        stored, computed = self.column, self.expression
+        if isinstance(self.column.type, (Numeric, Integer, Float)):
+            # a NULL differs from a value, the tolerance applies to two values
+            return or_(and_(stored.is_(None), computed.isnot(None)),
+                       and_(stored.isnot(None), computed.is_(None)),
+                       func.abs(stored - computed) > TOLERANCE)
+        return stored.is_distinct_from(computed)
+
+
+def aggregate_relationship(rule, parent_cls, child_cls):
+    relationships = [rel for rel in class_mapper(parent_cls).relationships if rel.mapper.class_ is child_cls]
+    named = [rel for rel in relationships if rel.key == getattr(rule, "_child_role_name", None)]
+    if len(named) == 1 or len(relationships) == 1:
+        return (named or relationships)[0]
+    raise Untranslatable(f"no unique relationship {parent_cls.__name__} -> {child_cls.__name__}")
+
+
+def derived_column(rule):
+    """
+        Translate a LogicBank rule to a DerivedColumn, raises Untranslatable
+    """
+    from logic_bank.rule_type.sum import Sum
+    from logic_bank.rule_type.count import Count
+    from logic_bank.rule_type.formula import Formula
+
+    cls = rule._decl_meta
+    mapper = class_mapper(cls)
+    prop = mapper.attrs.get(rule._column)
+    if not isinstance(prop, ColumnProperty):
+        raise Untranslatable(f"{cls.__name__}.{rule._column} is not a column")
+    column = prop.columns[0]
+    reads = set()
+
+    if isinstance(rule, Formula):
+        if rule._function is not None:
+            raise Untranslatable("formula calls a function")
+        expression = translate(rule._as_exp if rule._as_exp is not None else rule._as_expression,
+                               RowRef(cls, reads), "as_expression")
+        return DerivedColumn(rule, cls, column, expression, reads)
+
+    if isinstance(rule, (Sum, Count)):
+        if isinstance(rule, Sum):
+            if not hasattr(rule._as_sum_of, "class_"):
+                raise Untranslatable("as_sum_of must be a class attribute")
+            child_cls = rule._as_sum_of.class_
+        else:
+            child_cls = rule._as_count_of
+        child = RowRef(child_cls, reads)
+        relationship = aggregate_relationship(rule, cls, child_cls)
+        conditions = [join_condition(relationship)]
+        if rule._where is not None and rule._where != "":
+            conditions.append(translate(rule._where, child, "where"))
+        if isinstance(rule, Sum):
+            aggregate = func.coalesce(func.sum(child.attribute(rule._child_summed_field)), 0)
+        else:
+            aggregate = func.count()
+        expression = select([aggregate]).select_from(child.table).where(and_(*conditions)).as_scalar()
+        return DerivedColumn(rule, cls, column, expression, reads)
+
+    raise Untranslatable(f"{type(rule).__name__} rules aren't recomputed")
+
+
+def derived_columns(rules):
+    """
+        :return: the translatable derivations in dependency order and the skipped rules (rule, reason)
+    """
+    from logic_bank.rule_type.derivation import Derivation
+
+    columns, skipped = [], []
+    for rule in rules:
+        if not isinstance(rule, Derivation):
+            continue  # constraints, events
+        try:
+            columns.append(derived_column(rule))
+        except Untranslatable as exc:
+            skipped.append((rule, str(exc)))
+
+    # a column is computed after the columns it reads (declaration order otherwise, cycles keep it)
+    ordered, pending = [], list(columns)
+    while pending:
+        derived = {(c.cls.__name__, c.column.key) for c in pending}
+        ready = [c for c in pending if not (c.reads - {(c.cls.__name__, c.column.key)}) & derived] or pending[:1]
+        ordered += ready
+        pending = [c for c in pending if c not in ready]
+    return ordered, skipped
+
+
+#
+# chunked execution
+#
+def chunks(conn, table, size=CHUNK_SIZE):
+    """
+        :return: generator of conditions selecting chunks of `size` rows of table by primary key
+    """
+    pk = list(table.primary_key.columns)
+    if len(pk) != 1:
+        yield None  # composite key: one chunk
+        return
+    pk = pk[0]
+    low = None
+    while True:
+        query = select([pk]).order_by(pk).offset(size - 1).limit(1)
+        if low is not None:
+            query = query.where(pk > low)
+        high = conn.execute(query).scalar()
+        if high is None:
+            yield pk > low if low is not None else None
+            return
+        yield and_(pk > low, pk <= high) if low is not None else pk <= high
+        low = high
+
+
+def recompute(engine, rules, repair=False, columns=None, chunk_size=CHUNK_SIZE):
+    """
+        Verify (or repair) the columns derived by the rules
+
+        :param engine: engine of the project database
+        :param rules: LogicBank rules of the project
+        :param repair: update the rows that are out of date
+        :param columns: names (Class.column) of the columns to process, default all
+        :return: dict report
+    """
+    start = time.time()
+    derived, skipped = derived_columns(rules)
+    if columns:
+        derived = [c for c in derived if c.name in columns]
+    report = {"mode": "repair" if repair else "verify", "columns": [],
+              "skipped": [{"rule": f"{type(rule).__name__} {rule.table}.{rule._column}", "reason": reason}
+                          for rule, reason in skipped]}
+
+    for column in derived:
+        column_start = time.time()
+        mismatched = repaired = n_chunks = 0
+        with engine.connect() as conn:
+            for chunk in chunks(conn, column.table, chunk_size):
+                n_chunks += 1
+                condition = column.differs() if chunk is None else and_(chunk, column.differs())
+                if repair:
+                    with conn.begin():
+                        update = column.table.update().where(condition).values({column.column.name: column.expression})
+                        repaired += conn.execute(update).rowcount
+                else:
+                    mismatched += conn.execute(select([func.count()]).select_from(column.table).where(condition)).scalar()
+        entry = {"column": column.name, "rule": column.kind, "chunks": n_chunks,
+                 "duration": round(time.time() - column_start, 3)}
+        entry["repaired" if repair else "mismatched"] = repaired if repair else mismatched
+        report["columns"].append(entry)
+        log.info(f"Recompute {column.name}: {entry}")
+
+    report["duration"] = round(time.time() - start, 3)
+    return report
+
+
+def recompute_project(project, repair=False, columns=None):
+    """
+        Recompute a project mounted in this process (admin api)
+    """
+    if project not in projects:
+        raise KeyError(f"Project {project} isn't loaded")
+    engine, rules = projects[project]
+    report = recompute(engine, rules, repair=repair, columns=columns)
+    report["project"] = project
+    return report
+
+
+def format_report(report):
+    key = "repaired" if report["mode"] == "repair" else "mismatched"
+    lines = [f"{'column':<32} {'rule':<8} {key:>10} {'chunks':>7} {'seconds':>8}"]
+    for entry in report["columns"]:
+        lines.append(f"{entry['column']:<32} {entry['rule']:<8} {entry[key]:>10} {entry['chunks']:>7} {entry['duration']:>8}")
+    for entry in report["skipped"]:
+        lines.append(f"skipped: {entry['rule']} ({entry['reason']})")
+    lines.append(f"{report['mode']} took {report['duration']}s")
+    return "\n".join(lines)
+
+
+def load_project(project_dir, db_url=None):
+    """
+        Import the models and rules of a project outside the server
+
+        :return: engine, rules
+    """
+    from logic_bank.rule_bank.rule_bank import RuleBank
+    project_dir = str(Path(project_dir).resolve())
+    sys.path.insert(0, project_dir)
+    cwd = os.getcwd()
+    os.chdir(project_dir)
+    try:
+        import config
+        declare_logic = importlib.import_module("logic.declare_logic")
+        RuleBank().orm_objects = {}
+        declare_logic.declare_logic()
+    finally:
+        os.chdir(cwd)
+    return create_engine(db_url or config.Config.SQLALCHEMY_DATABASE_URI), activated_rules()
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Set-based recompute of the derived columns of a project")
+    argparser.add_argument("project", help="project directory")
+    argparser.add_argument("--repair", action="store_true", help="update the rows that are out of date")
+    argparser.add_argument("--db", help="database url, default: SQLALCHEMY_DATABASE_URI of the project config")
+    argparser.add_argument("--column", action="append", help="Class.column to recompute (repeatable)")
+    argparser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = argparser.parse_args()
+    engine, rules = load_project(args.project, args.db)
+    report = recompute(engine, rules, repair=args.repair, columns=args.column, chunk_size=args.chunk_size)
+    print(format_report(report))
+    if not args.repair and any(entry["mismatched"] for entry in report["columns"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+    Incremental project (re)generation for Api.generate
+
+    A per-table fingerprint of the schema (introspect.py metadata) is stored in
+    <project>/database/schema_fingerprint.json when a project is generated.
+    When the project is generated again:
+    * no fingerprint yet: the project is created by the ApiLogicServer CLI, as before
+    * no schema changes: nothing is generated and the server isn't reloaded
+    * otherwise the ApiLogicServer CLI generates the project in a scratch directory and only the
+      model classes (database/models.py) and expose_object calls (api/expose_api_models.py) of the
+      changed tables, and of the tables they're related to, are copied into the project.
+      All other files (logic, customizations, ui, config) are preserved.
+"""
+import ast
+import hashlib
+import json
+import logging
+import re
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+from generator import generator
+
+log = logging.getLogger()
+
+FINGERPRINT_FN = "database/schema_fingerprint.json"
+MODELS_FN = "database/models.py"
+EXPOSE_FN = "api/expose_api_models.py"
+EXPOSE_RE = re.compile(r"^(\s*)api\.expose_object\(models\.(\w+)\)\s*$")
+
+
+def fingerprint(schema):
+    """
+        :param schema: introspect.py metadata
+        :return: dict table name -> hash of the table definition
+    """
+    fingerprints = {}
+    for name, table in schema["tables"].items():
+        fingerprints[name] = hashlib.sha256(json.dumps(table, sort_keys=True).encode()).hexdigest()
+    for name in schema.get("views", []):
+        fingerprints[name] = "view"
+    return fingerprints
+
+
+def related_tables(schema, tables):
+    """
+        The tables that have a foreign key to or from one of `tables`,
+        their classes contain the relationships to the changed tables
+    """
+    related = set()
+    for name, table in schema["tables"].items():
+        for fk in table["foreign_keys"]:
+            if name in tables:
+                related.add(fk["referred_table"])
+            if fk["referred_table"] in tables:
+                related.add(name)
+    return related
+
+
+def referencing_tables(source, tables):
+    """
+        The tables whose model in models.py source refers to the models of `tables`
+        (the foreign keys of removed tables are no longer in the schema)
+    """
+    lines = source.splitlines()
+    blocks = model_blocks(source)
+    names = [blocks[t][0] for t in tables if t in blocks]
+    referencing = set()
+    for table, (_, start, end) in blocks.items():
+        text = "\n".join(lines[start:end + 1])
+        if any(f"'{name}'" in text or f'"{name}"' in text for name in names):
+            referencing.add(table)
+    return referencing
+
+
+class SchemaDiff:
+    def __init__(self, old, new):
+        self.added = sorted(set(new) - set(old))
+        self.removed = sorted(set(old) - set(new))
+        self.changed = sorted(name for name in set(old) & set(new) if old[name] != new[name])
+        self.unchanged = len(set(old) & set(new)) - len(self.changed)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def to_dict(self):
+        return {"added": self.added, "removed": self.removed, "changed": self.changed, "unchanged": self.unchanged}
+
+
+def model_blocks(source):
+    """
+        Find the model definitions in a generated models.py
+
+        :return: dict table name -> (class or variable name, first line, last line), 0-based line numbers
+    """
+    blocks = {}
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.ClassDef):
+            for stmt in node.body:
+                if isinstance(stmt, ast.Assign) and any(getattr(t, "id", None) == "__tablename__" for t in stmt.targets):
+                    start = min([node.lineno] + [dec.lineno for dec in node.decorator_list])
+                    blocks[ast.literal_eval(stmt.value)] = (node.name, start - 1, node.end_lineno - 1)
+        elif isinstance(node, ast.Assign) and isinstance(node.value, ast.Call) \
+                and getattr(node.value.func, "id", None) == "Table" and node.value.args:
+            # t_<name> = Table('<name>', metadata, ...) for tables without primary key and views
+            blocks[ast.literal_eval(node.value.args[0])] = (node.targets[0].id, node.lineno - 1, node.end_lineno - 1)
+    return blocks
+
+
+def header_end(blocks, lines):
+    return min((start for _, start, _ in blocks.values()), default=len(lines))
+
+
+def splice_models(old_source, new_source, tables):
+    """
+        Replace, add or remove the model definitions of `tables` in old_source
+
+        :return: new models.py source
+    """
+    old_lines = old_source.splitlines()
+    new_lines = new_source.splitlines()
+    old_blocks = model_blocks(old_source)
+    new_blocks = model_blocks(new_source)
+
+    replacements = []  # (start, end, lines), applied bottom up
+    appended = []
+    for table in tables:
+        new_block = new_lines[new_blocks[table][1]:new_blocks[table][2] + 1] if table in new_blocks else None
+        if table in old_blocks:
+            _, start, end = old_blocks[table]
+            if new_block is None:
+                # removed: drop the blank lines that separated the block too
+                while end + 1 < len(old_lines) and not old_lines[end + 1].strip():
+                    end += 1
+            replacements.append((start, end, new_block or []))
+        elif new_block:
+            appended.append(new_block)
+
+    # the imports may change too (eg. a new column type)
+    new_header = new_lines[:header_end(new_blocks, new_lines)]
+    replacements.append((0, header_end(old_blocks, old_lines) - 1, new_header))
+
+    lines = list(old_lines)
+    for start, end, block in sorted(replacements, key=lambda r: r[0], reverse=True):
+        lines[start:end + 1] = block
+    for block in appended:
+        lines += ["", ""] + block
+
+    return "\n".join(lines) + "\n"
+
+
+def splice_expose(old_source, new_source, old_names, new_names):
+    """
+        Update the expose_object calls of the changed models
+
+        :param old_names: table -> class name in the project models.py
+        :param new_names: table -> class name in the generated models.py
+    """
+    removed = {old_names[t] for t in old_names if old_names[t] != new_names.get(t)}
+    added = [new_names[t] for t in new_names if old_names.get(t) != new_names[t]]
+    lines = old_source.splitlines()
+    exposed = [i for i, line in enumerate(lines) if EXPOSE_RE.match(line)]
+    new_exposed = {EXPOSE_RE.match(line).group(2) for line in new_source.splitlines() if EXPOSE_RE.match(line)}
+    if not exposed:
+        return old_source
+
+    indent = EXPOSE_RE.match(lines[exposed[-1]]).group(1)
+    insert = [f"{indent}api.expose_object(models.{name})" for name in added if name in new_exposed]
+    lines[exposed[-1] + 1:exposed[-1] + 1] = insert
+    lines = [line for line in lines if not (EXPOSE_RE.match(line) and EXPOSE_RE.match(line).group(2) in removed)]
+    return "\n".join(lines) + "\n"
+
+
+def run_create(api, cwd):
+    """
+        Create the project with the ApiLogicServer CLI, in a process forked from the warm generator
+
+        :return: CompletedProcess
+    """
+    als_args = {
+        "--project_name": api.name,
+        "--db_url": api.connection_string,
+        "--port": str(api.port),
+        "--host": api.hostname
+    }
+    proc_args = ['ApiLogicServer', 'create', '--multi_api']
+    for a, v in als_args.items():
+        proc_args += [f'{a}={v}']
+    log.info(f"{' '.join(proc_args)} ({generator.mode})")
+    try:
+        return generator.run(proc_args[1:], cwd)
+    except subprocess.TimeoutExpired as exc:
+        return subprocess.CompletedProcess(proc_args, -1, exc.output or "", f"{exc.stderr or ''}\n{exc}")
+
+
+def write_fingerprint(project_dir, fingerprints):
+    with open(project_dir / FINGERPRINT_FN, "w") as fp:
+        json.dump(fingerprints, fp, indent=2, sort_keys=True)
+
+
+def read_fingerprint(project_dir):
+    try:
+        with open(project_dir / FINGERPRINT_FN) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def unchanged(api, schema, projects_dir):
+    """
+        :return: True if the project of api was generated from the tables of schema
+    """
+    return read_fingerprint(Path(projects_dir) / api.name) == fingerprint(schema)
+
+
+class GenerateResult:
+    def __init__(self, mode, output="", diff=None, files=None, ok=True):
+        self.mode = mode  # "full", "incremental" or "unchanged"
+        self.output = output
+        self.diff = diff
+        self.files = files or []
+        self.ok = ok
+
+    @property
+    def reload(self):
+        """
+            True if the server has to be reloaded to mount the changes
+        """
+        return self.ok and self.mode != "unchanged"
+
+    def report(self):
+        lines = [f"# Generate: {self.mode}"]
+        if self.diff is not None:
+            for key, tables in self.diff.to_dict().items():
+                lines.append(f"{key}: {', '.join(tables) if isinstance(tables, list) else tables}")
+        if self.files:
+            lines.append(f"updated: {', '.join(self.files)}")
+        if self.output:
+            lines += ["", self.output]
+        return "\n".join(lines)
+
+
+def generate(api, schema, projects_dir, full=False):
+    """
+        Generate the project of api, incrementally if it was generated before
+
+        :param api: admin_api Api instance
+        :param schema: introspect.py metadata of api.connection_string
+        :param projects_dir: directory containing the projects
+        :param full: regenerate the complete project
+        :return: GenerateResult
+    """
+    project_dir = Path(projects_dir) / api.name
+    fingerprints = fingerprint(schema)
+    old_fingerprints = None if full else read_fingerprint(project_dir)
+
+    if old_fingerprints is None or not (project_dir / MODELS_FN).exists():
+        process = run_create(api, projects_dir)
+        ok = process.returncode == 0 and (project_dir / MODELS_FN).exists()
+        if ok:
+            write_fingerprint(project_dir, fingerprints)
+        return GenerateResult("full", f"{process.stdout}\n\n{process.stderr}", ok=ok)
+
+    diff = SchemaDiff(old_fingerprints, fingerprints)
+    if not diff:
+        return GenerateResult("unchanged", diff=diff)
+
+    old_schema_tables = set(old_fingerprints)
+    touched = set(diff.added) | set(diff.removed) | set(diff.changed)
+    # relationships are declared on both sides, also in the classes of the related tables
+    touched |= related_tables(schema, touched) & (old_schema_tables | set(fingerprints))
+
+    workdir = Path(tempfile.mkdtemp(prefix="alsdock-generate-"))
+    try:
+        process = run_create(api, workdir)
+        output = f"{process.stdout}\n\n{process.stderr}"
+        generated_dir = workdir / api.name
+        if process.returncode != 0 or not (generated_dir / MODELS_FN).exists():
+            return GenerateResult("incremental", output, diff=diff, ok=False)
+
+        old_models = (project_dir / MODELS_FN).read_text()
+        new_models = (generated_dir / MODELS_FN).read_text()
+        touched |= referencing_tables(old_models, diff.removed)
+        old_names = {t: block[0] for t, block in model_blocks(old_models).items() if t in touched}
+        new_names = {t: block[0] for t, block in model_blocks(new_models).items() if t in touched}
+
+        files = {
+            MODELS_FN: splice_models(old_models, new_models, sorted(touched)),
+            EXPOSE_FN: splice_expose((project_dir / EXPOSE_FN).read_text(), (generated_dir / EXPOSE_FN).read_text(),
+                                     old_names, new_names),
+        }
+        for fn, source in files.items():
+            try:
+                compile(source, fn, "exec")  # don't write a broken project
+            except SyntaxError as exc:
+                output += f"\n\nThe merged {fn} doesn't compile, the project isn't updated: {exc}"
+                return GenerateResult("incremental", output, diff=diff, ok=False)
+        updated = [fn for fn, source in files.items() if (project_dir / fn).read_text() != source]
+        for fn in updated:
+            (project_dir / fn).write_text(files[fn])
+        write_fingerprint(project_dir, fingerprints)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return GenerateResult("incremental", output, diff=diff, files=updated)
@@ -0,0 +1,118 @@
+"""
+    Read/write splitting for project apps
+
+    When read replica urls are configured for an Api (Api.replica_urls), safe requests (GET, HEAD, OPTIONS)
+    are served from a session bound to one of the replicas, everything else uses the primary
+    (config.Config.SQLALCHEMY_DATABASE_URI).
+
+    Replica lag is tolerated with a read-your-writes window: after a successful write the client gets
+    a cookie and its reads go to the primary until the window (READ_YOUR_WRITES_WINDOW in the
+    project config, seconds) has passed.
+"""
+import itertools
+import logging
+import threading
+import time
+from flask import request, g
+from sqlalchemy import create_engine
+from blobs import exposed_classes
+
+log = logging.getLogger()
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+DEFAULT_WINDOW = 10
+COOKIE_NAME = "als_read_primary"
+
+
+class ReplicaRouter:
+    """
+        Routes the db session of safe requests to the replica engines (round robin)
+    """
+
+    def __init__(self, app, db, replica_urls, window=DEFAULT_WINDOW):
+        self.app = app
+        self.db = db
+        self.window = window
+        self.engines = [self.create_engine(url) for url in replica_urls]
+        self._binds = {}  # replica engine -> binds of its sessions
+        self._next = itertools.cycle(range(len(self.engines)))
+        self._lock = threading.Lock()
+        self.stats = {"replica": 0, "primary": 0, "read_your_writes": 0}
+
+    def create_engine(self, url):
+        return create_engine(url, pool_pre_ping=True, **self.app.config.get("REPLICA_ENGINE_OPTIONS", {}))
+
+    def next_engine(self):
+        with self._lock:
+            return self.engines[next(self._next)]
+
+    def replica_binds(self, engine):
+        """
+            :return: table -> engine binds of a replica session: the flask_sqlalchemy sessions bind the tables
+                     of db.Model to the primary engine (db.get_binds), the binds take precedence over the session bind
+        """
+        binds = self._binds.get(engine)
+        if binds is None:
+            primary = self.db.get_engine(self.app)
+            tables = [table for table, bind in self.db.get_binds(self.app).items() if bind is primary]
+            # the models of the project may have their own declarative base
+            for cls in exposed_classes(self.app):
+                tables += [table for table in cls.metadata.sorted_tables if table.info.get("bind_key") is None]
+            binds = self._binds[engine] = {table: engine for table in tables}
+        return binds
+
+    def must_read_primary(self):
+        """
+            True if the client wrote less than `window` seconds ago
+        """
+        try:
+            return float(request.cookies.get(COOKIE_NAME, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def before_request(self):
+        if request.method not in SAFE_METHODS:
+            self.stats["primary"] += 1
+            return
+        if self.must_read_primary():
+            self.stats["read_your_writes"] += 1
+            return
+        if self.db.session.registry.has():
+            # a session was already created for this request, don't switch binds halfway
+            return
+        # create the request scoped session bound to the replica, it's removed in the teardown
+        engine = self.next_engine()
+        self.db.session(bind=engine, binds=self.replica_binds(engine))
+        g.db_replica = True
+        self.stats["replica"] += 1
+
+    def after_request(self, response):
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            response.set_cookie(COOKIE_NAME, str(time.time() + self.window), max_age=int(self.window) + 1,
+                                path=request.script_root or "/", httponly=True, samesite="Strict")
+        return response
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+def install_replicas(app, db, replica_urls):
+    """
+        Route the safe requests of app to the replicas
+
+        :param app: project flask app
+        :param db: flask_sqlalchemy db of the project
+        :param replica_urls: list of replica database urls
+        :return: ReplicaRouter or None if no replicas are configured
+    """
+    if not replica_urls:
+        return None
+
+    window = app.config.get("READ_YOUR_WRITES_WINDOW", DEFAULT_WINDOW)
+    router = ReplicaRouter(app, db, replica_urls, window=window)
+    app.before_request(router.before_request)
+    app.after_request(router.after_request)
+    app.extensions["replicas"] = router
+    log.info(f"{app.name}: routing reads to {len(replica_urls)} replica(s), read-your-writes window {window}s")
+    return router
@@ -0,0 +1,150 @@
+"""
+    Cache of the serialized json:api resource objects of the projects
+
+    Enabled per project in the project config.Config:
+
+        SERIALIZATION_CACHE_SIZE = 10000  # rows per worker process, 0 disables the cache
+
+    safrs serializes every instance of a collection page and of the included[] resources (SAFRSBase._s_jsonapi_encode:
+    attributes, links and relationship links). The resource objects of the instances rendered without included
+    relationships are kept in an LRU cache per project, keyed by class and id with a variant per url root and
+    sparse fieldset (fields[Type]). An entry is used while the row version of the instance is the version it was
+    serialized with: the value of the version_id_col of the mapper or else the values of the columns of the row, so
+    writes by other processes are seen. The updates and deletes flushed by this process drop the entries of the rows.
+
+    Classes with attributes that aren't columns (jsonapi_attr) aren't cached.
+"""
+import collections
+import logging
+import threading
+import safrs
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.orm.exc import UnmappedColumnError
+from sqlalchemy.schema import Column
+from blobs import exposed_classes
+
+log = logging.getLogger()
+
+caches = {}  # class -> (ResourceCache of its project, names of the row version attributes)
+
+
+class ResourceCache:
+    """
+        Resource objects per (class, id) and variant, least recently used rows are dropped
+    """
+
+    def __init__(self, project, size):
+        self.project = project
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._rows = collections.OrderedDict()  # (class, id) -> {variant: (row version, resource object)}
+        self._lock = threading.Lock()
+
+    def get(self, key, variant, version):
+        with self._lock:
+            entry = self._rows.get(key, {}).get(variant)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._rows.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, variant, version, resource):
+        with self._lock:
+            self._rows.setdefault(key, {})[variant] = (version, resource)
+            self._rows.move_to_end(key)
+            while len(self._rows) > self.size:
+                self._rows.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._rows.pop(key, None)
+
+    def evict_class(self, cls):
+        with self._lock:
+            for key in [key for key in self._rows if key[0] is cls]:
+                del self._rows[key]
+
+    def to_dict(self):
+        return {"project": self.project, "size": self.size, "rows": len(self._rows), "hits": self.hits, "misses": self.misses}
+
+
+def version_attributes(cls):
+    """
+        :return: names of the attributes of the row version of cls, None if cls can't be cached
+    """
+    mapper = cls.__mapper__
+    if not all(isinstance(attr, Column) for attr in cls._s_jsonapi_attrs.values()):
+        return None
+    if mapper.version_id_col is not None:
+        try:
+            return [mapper.get_property_by_column(mapper.version_id_col).key]
+        except UnmappedColumnError:
+            pass
+    return [prop.key for prop in mapper.column_attrs]
+
+
+def without_includes(instance):
+    """
+        :return: True if no relationships of instance are included (safrs _s_get_related)
+    """
+    included_list = getattr(instance, "included_list", None)
+    if included_list is None:
+        included_list = [inc for inc in request.args.get("include", safrs.SAFRS.DEFAULT_INCLUDED).split(",") if inc]
+    return not included_list
+
+
+def cached_encode(encode):
+    """
+        Wrap SAFRSBase._s_jsonapi_encode: reuse the cached resource object of the instance
+    """
+    def _s_jsonapi_encode(self):
+        registered = caches.get(type(self))
+        if registered is None or not has_request_context() or not without_includes(self):
+            return encode(self)
+        cache, names = registered
+        key = (type(self), self.jsonapi_id)  # loads the attributes of an expired instance
+        fields = getattr(request, "fields", {}).get(self._s_class_name)
+        variant = (request.url_root, tuple(fields) if fields is not None else None)
+        state = self.__dict__
+        version = tuple(state.get(name) for name in names)
+        resource = cache.get(key, variant, version)
+        if resource is None:
+            resource = encode(self)
+            cache.put(key, variant, version, resource)
+        else:
+            g.ja_data.add(self)  # the instance isn't repeated in included[]
+        return resource
+
+    _s_jsonapi_encode.__wrapped__ = encode
+    return _s_jsonapi_encode
+
+
+def install_resource_cache(app):
+    """
+        Cache the resource objects of the classes exposed by the project app (SERIALIZATION_CACHE_SIZE)
+    """
+    size = int(app.config.get("SERIALIZATION_CACHE_SIZE", 0) or 0)
+    if size <= 0:
+        return app
+    cache = ResourceCache(app.name, size)
+
+    def invalidate(mapper, connection, target):
+        cache.invalidate((type(target), target.jsonapi_id))
+
+    for cls in exposed_classes(app):
+        names = version_attributes(cls)
+        if names is None:
+            log.info(f"{app.name}: {cls._s_type} resource objects aren't cached (attributes that aren't columns)")
+            continue
+        caches[cls] = (cache, names)
+        for event_name in ("after_update", "after_delete"):
+            event.listen(cls, event_name, invalidate)
+    return app
+
+
+def stats():
+    return [cache.to_dict() for cache in {id(cache): cache for cache, names in caches.values()}.values()]
@@ -0,0 +1,169 @@
+"""
+    Rolling worker reload for gals.py
+
+    Instead of gunicorn --reload (which restarts all workers when a file changes) the workers are
+    replaced one at a time by a coordinator thread in the gunicorn master:
+    1. SIGTTIN: the master starts an extra worker, it loads the projects and warms them up
+       (post_worker_init) and writes a readiness file
+    2. SIGTTOU: when the new worker is ready the master retires the oldest worker with SIGTERM,
+       which stops accepting connections and finishes its in-flight requests (graceful_timeout)
+    until all the workers that were running when the reload started are replaced. A new worker that isn't
+    ready in time is terminated and the reload is aborted, the old workers keep running.
+
+    With --preload the apps are built in the master: the reload is a SIGHUP, the arbiter rebuilds the apps
+    on its own thread (gals.ServerApp.reload) and replaces the workers by workers forked from the new apps.
+
+    A reload is requested by creating the trigger file in the state directory of the master,
+    eg. from a worker with `request_reload()` (admin api Apis/reload, Apis/generate).
+    ROLLING_READY_TIMEOUT: seconds to wait for a new worker to become ready (default 120)
+"""
+import logging
+import os
+import signal
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+log = logging.getLogger()
+
+READY_TIMEOUT = float(os.getenv("ROLLING_READY_TIMEOUT", 120))
+TRIGGER_FN = "reload"
+COORDINATOR_FN = "coordinator"
+
+
+def state_dir(master_pid):
+    return Path(tempfile.gettempdir()) / f"alsdock-gals-{master_pid}"
+
+
+def ready_fn(master_pid, worker_pid):
+    return state_dir(master_pid) / f"{worker_pid}.ready"
+
+
+def warm_up(application):
+    """
+        Load the swagger (all models and endpoints) of every mounted project
+    """
+    from werkzeug.test import Client
+    client = Client(application)
+    for prefix in getattr(application, "mounts", {}):
+        if prefix == "/admin":
+            continue
+        start = time.time()
+        try:
+            response = client.get(f"{prefix}/api/swagger.json")
+            log.info(f"Warm up {prefix}: {response.status} ({time.time() - start:.2f}s)")
+        except Exception as exc:
+            log.warning(f"Warm up {prefix} failed: {exc}")
+
+
+def mark_ready(worker):
+    """
+        Called in the worker (post_worker_init) when its app is loaded
+    """
+    warm_up(worker.wsgi)
+    fn = ready_fn(worker.ppid, worker.pid)
+    if fn.parent.is_dir():
+        fn.touch()
+
+
+def unmark_ready(master_pid, worker_pid):
+    try:
+        ready_fn(master_pid, worker_pid).unlink()
+    except OSError:
+        pass
+
+
+def request_reload():
+    """
+        Ask the master of this worker for a rolling reload
+
+        :return: False if the master doesn't run the coordinator (eg. not started by gals.py)
+    """
+    directory = state_dir(os.getppid())
+    if not (directory / COORDINATOR_FN).exists():
+        return False
+    (directory / TRIGGER_FN).touch()
+    return True
+
+
+class RollingReloader(threading.Thread):
+    """
+        Runs in the gunicorn master and replaces the workers one by one when a reload is requested
+    """
+
+    def __init__(self, arbiter, ready_timeout=READY_TIMEOUT, poll_interval=0.5):
+        super().__init__(name="rolling-reload", daemon=True)
+        self.arbiter = arbiter
+        self.ready_timeout = ready_timeout
+        self.poll_interval = poll_interval
+        self.directory = state_dir(arbiter.pid)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        (self.directory / COORDINATOR_FN).write_text(str(arbiter.pid))
+
+    @property
+    def workers(self):
+        return set(self.arbiter.WORKERS)
+
+    def ready(self, pid):
+        return ready_fn(self.arbiter.pid, pid).exists()
+
+    def wait_for(self, condition, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if condition():
+                return True
+            time.sleep(self.poll_interval)
+        return False
+
+    def reload(self):
+        old_workers = self.workers
+        if self.arbiter.cfg.preload_app:
+            # building the apps in this thread would race with the forks of the arbiter
+            log.info(f"Reload of {len(old_workers)} preloaded workers (SIGHUP)")
+            os.kill(self.arbiter.pid, signal.SIGHUP)
+            return True
+        log.info(f"Rolling reload of {len(old_workers)} workers")
+
+        # oldest first, that's the worker the master retires on SIGTTOU
+        for old_pid in sorted(old_workers, key=lambda pid: getattr(self.arbiter.WORKERS.get(pid), "age", 0)):
+            if old_pid not in self.arbiter.WORKERS:
+                continue
+            before = self.workers
+            os.kill(self.arbiter.pid, signal.SIGTTIN)
+            if not self.wait_for(lambda: any(self.ready(pid) for pid in self.workers - before), self.ready_timeout):
+                log.error(f"Rolling reload aborted: no new worker ready after {self.ready_timeout}s")
+                self.abort(self.workers - before)
+                return False
+            # the master retires the oldest worker, it drains its in-flight requests
+            os.kill(self.arbiter.pid, signal.SIGTTOU)
+            self.wait_for(lambda: old_pid not in self.workers, self.arbiter.cfg.graceful_timeout + 5)
+        log.info("Rolling reload finished")
+        return True
+
+    def abort(self, new_workers):
+        """
+            Terminate the new workers and undo the SIGTTIN, SIGTTOU would retire the oldest (healthy) worker
+        """
+        for pid in new_workers:
+            # removed first: the arbiter doesn't replace them and doesn't retire an old worker for them
+            worker = self.arbiter.WORKERS.pop(pid, None)
+            self.arbiter.num_workers = max(self.arbiter.num_workers - 1, 1)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+            if worker is not None:
+                worker.tmp.close()
+
+    def run(self):
+        trigger = self.directory / TRIGGER_FN
+        while True:
+            time.sleep(self.poll_interval)
+            if not trigger.exists():
+                continue
+            try:
+                trigger.unlink()
+                self.reload()
+            except Exception as exc:
+                log.exception(exc)
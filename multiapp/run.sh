@@ -1 +1,2 @@
-gunicorn -w 1 "multiapp:main()" -b 0.0.0.0:5656  --threads 1 --error-logfile - --access-logfile - --reload
+# workers are replaced one by one on Apis/reload and Apis/generate (rolling.py), add --reload to restart on code changes
+python gals.py -w 1 -t 1 -i 0.0.0.0 -p 5656
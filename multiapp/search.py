@@ -0,0 +1,229 @@
+"""
+    Full text search of the json:api collections of the projects
+
+    Enabled per project in the project config.Config:
+
+        SEARCH_INDEX = True  # index the attributes marked `search: true` in the project ui/admin/admin.yaml
+        SEARCH_INDEX = {"Customer": ["CompanyName", "ContactName"]}  # type name -> attributes
+
+    The string columns of the search attributes are indexed when the project is loaded:
+    * sqlite: an FTS5 table (external content) kept in sync by insert, update and delete triggers,
+      rebuilt when the indexed columns change
+    * postgresql: a GIN index on the to_tsvector('simple', ...) of the columns
+    * mysql: a FULLTEXT index on the columns
+    * other databases: no index, the search is a LIKE of the columns
+
+    The `search` parameter of the collection endpoints (/api/Customer?search=mar ber) returns the rows
+    matching all words (word prefixes), ranked by relevance unless a `sort` is requested. It combines with
+    the filter[] parameters and pagination.
+"""
+import logging
+import re
+import yaml
+from pathlib import Path
+from flask import has_request_context, request
+from sqlalchemy import String, and_, desc, func, literal_column, or_, text
+from sqlalchemy.orm import Query
+from sqlalchemy.sql import column, select, table
+from blobs import exposed_classes
+
+log = logging.getLogger()
+
+SEARCH_PARAM = "search"
+WORD = re.compile(r"\w+", re.UNICODE)
+
+indexes = {}  # class -> SearchIndex
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def search_words(terms):
+    return WORD.findall(terms or "")[:16]
+
+
+class SearchIndex:
+    """
+        LIKE search of the columns, used for databases without a full text index
+    """
+
+    def __init__(self, cls, columns):
+        self.cls = cls
+        self.table = cls.__table__.name
+        self.columns = columns  # string columns of the table
+
+    def create(self, connection):
+        pass
+
+    def apply(self, query, words, ranked):
+        """
+            :return: query filtered (and ordered if ranked) by the search words
+        """
+        return query.filter(and_(*[or_(*[column.ilike(f"%{word}%") for column in self.columns]) for word in words]))
+
+
+class SqliteSearchIndex(SearchIndex):
+    """
+        FTS5 external content table of the columns, updated by triggers on the table
+    """
+
+    def __init__(self, cls, columns):
+        super().__init__(cls, columns)
+        self.fts = f"{self.table}_fts"
+
+    def ddl(self):
+        names = ", ".join(quote(column.name) for column in self.columns)
+        new = ", ".join(f"new.{quote(column.name)}" for column in self.columns)
+        old = ", ".join(f"old.{quote(column.name)}" for column in self.columns)
+        fts, table_name = quote(self.fts), quote(self.table)
+        delete = f"INSERT INTO {fts}({fts}, rowid, {names}) VALUES ('delete', old.rowid, {old});"
+        insert = f"INSERT INTO {fts}(rowid, {names}) VALUES (new.rowid, {new});"
+        return [
+            f"CREATE VIRTUAL TABLE {fts} USING fts5({names}, content={table_name}, content_rowid='rowid')",
+            f"CREATE TRIGGER {quote(self.fts + '_ai')} AFTER INSERT ON {table_name} BEGIN {insert} END",
+            f"CREATE TRIGGER {quote(self.fts + '_ad')} AFTER DELETE ON {table_name} BEGIN {delete} END",
+            f"CREATE TRIGGER {quote(self.fts + '_au')} AFTER UPDATE OF {names} ON {table_name} BEGIN {delete} {insert} END",
+        ]
+
+    def create(self, connection):
+        statements = self.ddl()
+        existing = connection.execute(text("SELECT sql FROM sqlite_master WHERE name = :name"), {"name": self.fts}).scalar()
+        if existing == statements[0]:
+            return
+        # the indexed columns changed (or the table is new): recreate the index and its triggers
+        for suffix in ("_ai", "_ad", "_au"):
+            connection.execute(f"DROP TRIGGER IF EXISTS {quote(self.fts + suffix)}")
+        connection.execute(f"DROP TABLE IF EXISTS {quote(self.fts)}")
+        for statement in statements:
+            connection.execute(statement)
+        connection.execute(f"INSERT INTO {quote(self.fts)}({quote(self.fts)}) VALUES ('rebuild')")
+        log.info(f"Created search index {self.fts}")
+
+    def apply(self, query, words, ranked):
+        fts = table(self.fts, column(self.fts), column("rowid"), column("rank"))
+        match = " ".join(f'"{word}"*' for word in words)
+        matches = select([fts.c.rowid, fts.c.rank]).where(fts.c[self.fts].match(match)).alias(f"{self.fts}_match")
+        query = query.join(matches, matches.c.rowid == literal_column(f"{quote(self.table)}.rowid"))
+        return query.order_by(matches.c.rank) if ranked else query  # bm25: lower is better
+
+
+class PostgresqlSearchIndex(SearchIndex):
+    """
+        GIN index on the text search vector of the columns
+    """
+
+    def document(self, qualified):
+        prefix = f"{quote(self.table)}." if qualified else ""
+        columns = " || ' ' || ".join(f"coalesce({prefix}{quote(column.name)}::text, '')" for column in self.columns)
+        return f"to_tsvector('simple', {columns})"
+
+    def create(self, connection):
+        connection.execute(f"CREATE INDEX IF NOT EXISTS {quote(self.table + '_search')} "
+                           f"ON {quote(self.table)} USING gin ({self.document(False)})")
+
+    def apply(self, query, words, ranked):
+        document = literal_column(self.document(True))
+        tsquery = func.to_tsquery(literal_column("'simple'"), " & ".join(f"{word}:*" for word in words))
+        query = query.filter(document.op("@@")(tsquery))
+        return query.order_by(desc(func.ts_rank(document, tsquery))) if ranked else query
+
+
+class MysqlSearchIndex(SearchIndex):
+    """
+        FULLTEXT index of the columns
+    """
+
+    def create(self, connection):
+        name = f"{self.table}_search"
+        exists = connection.execute(text("SELECT COUNT(*) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() "
+                                         "AND TABLE_NAME = :table AND INDEX_NAME = :name"), {"table": self.table, "name": name}).scalar()
+        if not exists:
+            names = ", ".join(f"`{column.name}`" for column in self.columns)
+            connection.execute(f"ALTER TABLE `{self.table}` ADD FULLTEXT INDEX `{name}` ({names})")
+            log.info(f"Created search index {name}")
+
+    def apply(self, query, words, ranked):
+        names = ", ".join(f"`{self.table}`.`{column.name}`" for column in self.columns)
+        terms = " ".join(f"+{word}*" for word in words)
+        query = query.filter(text(f"MATCH ({names}) AGAINST (:search_terms IN BOOLEAN MODE)").bindparams(search_terms=terms))
+        return query.order_by(text(f"MATCH ({names}) AGAINST (:search_rank IN BOOLEAN MODE) DESC").bindparams(search_rank=terms)) if ranked else query
+
+
+INDEX_TYPES = {"sqlite": SqliteSearchIndex, "postgresql": PostgresqlSearchIndex, "mysql": MysqlSearchIndex}
+
+
+def search_attributes(config, project):
+    """
+        :return: {type name: [attribute names]} of the SEARCH_INDEX config or the `search: true` attributes of the admin.yaml
+    """
+    setting = config.get("SEARCH_INDEX")
+    if not setting:
+        return {}
+    if isinstance(setting, dict):
+        return setting
+    yaml_fn = Path(project) / "ui/admin/admin.yaml"
+    if not yaml_fn.is_file():
+        log.warning(f"SEARCH_INDEX: {yaml_fn} does not exist")
+        return {}
+    with open(yaml_fn) as yaml_fp:
+        resources = (yaml.safe_load(yaml_fp) or {}).get("resources") or {}
+    result = {}
+    for name, resource in resources.items():
+        attributes = [attr["name"] for attr in resource.get("attributes") or [] if isinstance(attr, dict) and attr.get("search")]
+        if attributes:
+            result[resource.get("type", name)] = attributes
+    return result
+
+
+def search_columns(cls, names):
+    columns = []
+    for name in names:
+        attr = cls._s_jsonapi_attrs.get(name)
+        if attr is None or not isinstance(getattr(attr, "type", None), String) or attr.table is not cls.__table__:
+            log.warning(f"Search attribute {cls._s_type}.{name} is not a string column of {cls.__table__.name}")
+            continue
+        columns.append(attr)
+    return columns
+
+
+def searched_get(get):
+    """
+        Wrap SAFRSBase._s_get: filter the collection query by the search parameter
+    """
+    def _s_get(cls, **kwargs):
+        result = get(cls, **kwargs)
+        if isinstance(result, Query) and has_request_context() and request.args.get(SEARCH_PARAM):
+            index = indexes.get(cls)
+            words = search_words(request.args[SEARCH_PARAM])
+            if index is not None and words:
+                result = index.apply(result, words, ranked=not request.args.get("sort"))
+        return result
+
+    _s_get.__wrapped__ = get
+    return _s_get
+
+
+def install_search(app, engine, project):
+    """
+        Create the search indexes of the classes exposed by the project app (wrappers.py: search parameter)
+    """
+    attributes = search_attributes(app.config, project)
+    if not attributes:
+        return app
+
+    index_type = INDEX_TYPES.get(engine.dialect.name, SearchIndex)
+    for cls in exposed_classes(app):
+        columns = search_columns(cls, attributes.get(cls._s_type, []))
+        if not columns:
+            continue
+        index = index_type(cls, columns)
+        try:
+            with engine.begin() as connection:
+                index.create(connection)
+        except Exception as exc:
+            log.warning(f"{app.name}: no search index for {cls._s_type}, LIKE search: {exc}")
+            index = SearchIndex(cls, columns)
+        indexes[cls] = index
+        log.info(f"{app.name}: search {cls._s_type}.{', '.join(column.name for column in columns)} ({type(index).__name__})")
+    return app
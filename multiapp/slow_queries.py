@@ -0,0 +1,299 @@
+"""
+    Slow statement log and index advisor of the projects
+
+    The statements executed by the engines of a project that take longer than SLOW_QUERY_MS (project
+    config, default 200, 0 disables the log) are kept in a ring buffer of SLOW_QUERY_LOG_SIZE (default 100)
+    entries per project, with the query plan of the SELECT statements:
+    * sqlite: EXPLAIN QUERY PLAN, postgresql and mysql: EXPLAIN (without ANALYZE, the statement isn't run twice)
+    * the plan is taken on the connection of the statement, with the same parameters, once per statement
+      text for SLOW_QUERY_EXPLAIN_TTL seconds (default 60). SLOW_QUERY_EXPLAIN = False disables it.
+      On postgresql the EXPLAIN runs in a savepoint: a failed statement aborts the transaction of the request.
+    * tables read with a full scan are listed
+    * the parameter values aren't kept, they can contain personal data: only their number and types, and the
+      string literals of the plans (postgresql) are replaced by '?'. SLOW_QUERY_PARAMETERS = True keeps the values.
+
+    The index advisor aggregates the columns used by the slow statements: the columns compared with
+    =, IN and IS (and join conditions) come first, followed by a range (<, >, BETWEEN, LIKE) or ORDER BY
+    column. Candidates that are a prefix of an existing index are left out, the others are ranked by
+    the total time of their statements.
+
+    The log is per worker process, available in the admin api: Apis/{id}/slow_queries
+"""
+import collections
+import datetime
+import logging
+import re
+import threading
+import time
+from sqlalchemy import Table, event
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression, Grouping, Label, UnaryExpression
+from sqlalchemy.sql.expression import Alias
+from sqlalchemy.sql.schema import Column
+from sqlalchemy.sql.selectable import Select
+from filters import index_columns
+
+log = logging.getLogger()
+
+DEFAULT_SLOW_MS = 200
+DEFAULT_LOG_SIZE = 100
+DEFAULT_EXPLAIN_TTL = 60
+MAX_STATEMENT = 4000
+MAX_INDEX_COLUMNS = 3
+
+EXPLAIN = {"sqlite": "EXPLAIN QUERY PLAN ", "postgresql": "EXPLAIN ", "mysql": "EXPLAIN "}
+SAVEPOINT_DIALECTS = {"postgresql"}  # dialects where an error aborts the transaction
+SAVEPOINT = "slow_query_explain"
+FULL_SCAN = {
+    "sqlite": re.compile(r"^SCAN (\S+)(?!.* USING )", re.M),
+    "postgresql": re.compile(r"Seq Scan on (\S+)"),
+    "mysql": re.compile(r"table=(\S+).* type=ALL\b"),
+}
+LITERAL = re.compile(r"'(?:[^']|'')*'")
+SUBQUERY = re.compile(r"(?:CO-ROUTINE|MATERIALIZE) (\S+)")  # sqlite: scans of subqueries aren't table scans
+EQUALITY = {operators.eq, operators.in_op, operators.is_}
+RANGE = {operators.lt, operators.le, operators.gt, operators.ge, operators.between_op, operators.like_op, operators.startswith_op}
+
+projects = {}  # project name -> SlowQueryLog
+_lock = threading.Lock()
+
+
+class SlowQueryLog:
+    """
+        Slow statements of a project and the columns they use
+    """
+
+    def __init__(self, project, config):
+        self.project = project
+        self.threshold = float(config.get("SLOW_QUERY_MS", DEFAULT_SLOW_MS))
+        self.explain = config.get("SLOW_QUERY_EXPLAIN", True)
+        self.explain_ttl = float(config.get("SLOW_QUERY_EXPLAIN_TTL", DEFAULT_EXPLAIN_TTL))
+        self.parameters = config.get("SLOW_QUERY_PARAMETERS", False)
+        self.entries = collections.deque(maxlen=int(config.get("SLOW_QUERY_LOG_SIZE", DEFAULT_LOG_SIZE)))
+        self.engines = []
+        self.plans = {}  # statement -> (plan, full scans, expires)
+        self.candidates = {}  # (table, columns) -> [statements, total ms]
+        self._lock = threading.Lock()
+
+    def add(self, entry, candidates):
+        with self._lock:
+            self.entries.append(entry)
+            for candidate in candidates:
+                totals = self.candidates.setdefault(candidate, [0, 0.0])
+                totals[0] += 1
+                totals[1] += entry["ms"]
+
+    def cached_plan(self, statement):
+        with self._lock:
+            plan = self.plans.get(statement)
+            if plan is None or plan[2] < time.time():
+                return None
+            return plan
+
+    def cache_plan(self, statement, plan, scans):
+        with self._lock:
+            if len(self.plans) > 1000:
+                self.plans.clear()
+            self.plans[statement] = (plan, scans, time.time() + self.explain_ttl)
+
+
+def base_column(element):
+    """
+        :return: (table, column name) of a column expression of a table or of an alias of a table, None otherwise
+    """
+    while isinstance(element, (Grouping, Label, UnaryExpression)):
+        element = element.element
+    if not isinstance(element, Column):
+        return None
+    table = element.table
+    while isinstance(table, Alias):
+        table = table.element
+    if not isinstance(table, Table):
+        return None
+    return table, element.name
+
+
+def statement_columns(statement):
+    """
+        :return: {table: (equality columns, range columns, order by columns)} of the statement and its subqueries
+    """
+    result = {}
+
+    def add(element, kind):
+        table_column = base_column(element)
+        if table_column is not None:
+            table, name = table_column
+            columns = result.setdefault(table, ([], [], []))[kind]
+            if name not in columns:
+                columns.append(name)
+
+    for element in visitors.iterate(statement, {}):
+        if isinstance(element, BinaryExpression):
+            kind = 0 if element.operator in EQUALITY else 1 if element.operator in RANGE else None
+            if kind is not None:
+                add(element.left, kind)
+                add(element.right, kind)
+        elif isinstance(element, Select):
+            for clause in element._order_by_clause.clauses:
+                add(clause, 2)
+    return result
+
+
+def index_candidates(statement):
+    """
+        :return: the (table, columns) indexes that would serve the statement
+    """
+    candidates = []
+    for table, (equality, ranges, order) in statement_columns(statement).items():
+        columns = sorted(equality)
+        for name in ranges[:1] or order[:1]:
+            if name not in columns:
+                columns.append(name)
+        if columns:
+            candidates.append((table, tuple(columns[:MAX_INDEX_COLUMNS])))
+    return candidates
+
+
+def format_plan(cursor, rows, dialect):
+    if dialect == "sqlite":
+        return "\n".join(str(row[-1]) for row in rows)  # id, parent, notused, detail
+    names = [column[0] for column in cursor.description or []]
+    if len(names) == 1:
+        return "\n".join(str(row[0]) for row in rows)
+    return "\n".join(" ".join(f"{name}={value}" for name, value in zip(names, row)) for row in rows)
+
+
+def parameter_types(parameters, executemany=False):
+    """
+        :return: the number and the types of the parameters of a statement, without their values
+    """
+    if executemany:
+        return {"rows": len(parameters), **parameter_types(parameters[0] if parameters else ())}
+    if isinstance(parameters, dict):
+        return {"count": len(parameters), "types": {name: type(value).__name__ for name, value in parameters.items()}}
+    parameters = parameters or ()
+    return {"count": len(parameters), "types": [type(value).__name__ for value in parameters]}
+
+
+def explain(slow_log, connection, statement, parameters):
+    """
+        :return: (query plan, tables with a full scan) of a select statement, (None, []) if there's no plan
+    """
+    dialect = connection.dialect.name
+    prefix = EXPLAIN.get(dialect)
+    if not slow_log.explain or prefix is None or not statement.lstrip().upper().startswith(("SELECT", "WITH")):
+        return None, []
+    cached = slow_log.cached_plan(statement)
+    if cached is not None:
+        return cached[0], cached[1]
+    savepoint = dialect in SAVEPOINT_DIALECTS and connection.in_transaction()
+    cursor = connection.connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute(f"SAVEPOINT {SAVEPOINT}")
+        try:
+            cursor.execute(prefix + statement, parameters)
+            plan = format_plan(cursor, cursor.fetchall(), dialect)
+        except Exception as exc:
+            plan = f"EXPLAIN failed: {exc}"
+            if savepoint:
+                cursor.execute(f"ROLLBACK TO SAVEPOINT {SAVEPOINT}")
+        if savepoint:
+            cursor.execute(f"RELEASE SAVEPOINT {SAVEPOINT}")
+    finally:
+        cursor.close()
+    if not slow_log.parameters:
+        plan = LITERAL.sub("'?'", plan)
+    scans = sorted({scan.strip('"`') for scan in FULL_SCAN[dialect].findall(plan)} - set(SUBQUERY.findall(plan)))
+    slow_log.cache_plan(statement, plan, scans)
+    return plan, scans
+
+
+def register(project, engine, config):
+    """
+        Log the slow statements of an engine of a project (primary or replica)
+    """
+    with _lock:
+        slow_log = projects.get(project)
+        if slow_log is None:
+            slow_log = projects[project] = SlowQueryLog(project, config)
+    slow_log.engines.append(engine)
+    if not slow_log.threshold:
+        return slow_log
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._slow_query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_slow_query_start", None)
+        if start is None:
+            return
+        ms = (time.perf_counter() - start) * 1000
+        if ms < slow_log.threshold:
+            return
+        try:
+            compiled = getattr(context, "compiled", None)
+            candidates = index_candidates(compiled.statement) if compiled is not None else []
+            plan, scans = explain(slow_log, connection, statement, parameters) if not executemany else (None, [])
+        except Exception as exc:
+            log.warning(f"{project}: failed to analyze a slow statement: {exc}")
+            candidates, plan, scans = [], None, []
+        slow_log.add({
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "ms": round(ms, 1),
+            "statement": statement[:MAX_STATEMENT],
+            "parameters": repr(parameters)[:MAX_STATEMENT] if slow_log.parameters else parameter_types(parameters, executemany),
+            "plan": plan,
+            "full_scans": scans,
+        }, candidates)
+        log.info(f"{project}: slow statement ({ms:.0f}ms) {' '.join(statement.split())[:200]}")
+
+    return slow_log
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def suggestions(slow_log):
+    """
+        :return: the candidate indexes that aren't covered by an existing index, by total time
+    """
+    with slow_log._lock:
+        candidates = dict(slow_log.candidates)
+    existing = {}
+    result = []
+    for (table, columns), (statements, total_ms) in candidates.items():
+        if table not in existing:
+            existing[table] = index_columns(slow_log.engines[0], table) if slow_log.engines else []
+        if any(index[:len(columns)] == columns for index in existing[table]):
+            continue
+        name = f"{table.name}_{'_'.join(columns)}_ix"
+        result.append({
+            "table": table.name,
+            "columns": list(columns),
+            "statements": statements,
+            "total_ms": round(total_ms, 1),
+            "ddl": f"CREATE INDEX {quote(name)} ON {quote(table.name)} ({', '.join(quote(column) for column in columns)})",
+        })
+    return sorted(result, key=lambda suggestion: suggestion["total_ms"], reverse=True)
+
+
+def report(project, limit=50):
+    """
+        :return: the latest slow statements of a project and the index suggestions
+    """
+    slow_log = projects.get(project)
+    if slow_log is None:
+        raise KeyError(f"Project {project} isn't mounted in this process")
+    with slow_log._lock:
+        entries = list(slow_log.entries)[::-1][:limit]
+    return {
+        "project": project,
+        "threshold_ms": slow_log.threshold,
+        "statements": entries,
+        "suggestions": suggestions(slow_log),
+    }
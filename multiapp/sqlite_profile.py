@@ -0,0 +1,111 @@
+"""
+    Opt-in SQLite performance profile for project engines
+
+    Enabled per project in the project config.Config:
+
+        SQLITE_PROFILE = True  # use the DEFAULT_PROFILE settings
+        SQLITE_PROFILE = {"mmap_size": 512 * 1024 * 1024, "synchronous": "FULL"}  # override some settings
+
+    The pragmas are set on every new DBAPI connection of the engine and the engine uses a
+    QueuePool instead of the flask_sqlalchemy NullPool default, so the page cache and memory
+    map of a connection are reused across requests.
+"""
+import logging
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+log = logging.getLogger()
+
+DEFAULT_PROFILE = {
+    "journal_mode": "WAL",  # readers don't block the writer
+    "synchronous": "NORMAL",  # fsync on checkpoint only, safe in WAL mode
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64000,  # negative: size in KiB (64MB)
+    "busy_timeout": 5000,  # ms to wait for a lock instead of failing with "database is locked"
+    "temp_store": "MEMORY",
+    "pool_size": 5,
+    "max_overflow": 10,
+}
+
+PRAGMAS = ("busy_timeout", "journal_mode", "synchronous", "mmap_size", "cache_size", "temp_store")
+
+
+def get_profile(config):
+    """
+        :param config: flask app config
+        :return: the profile settings or None if the profile isn't enabled
+    """
+    profile = config.get("SQLITE_PROFILE")
+    if not profile:
+        return None
+    if profile is True:
+        return dict(DEFAULT_PROFILE)
+    return {**DEFAULT_PROFILE, **profile}
+
+
+def engine_options(profile):
+    """
+        SQLAlchemy create_engine() options for the profile
+    """
+    return {
+        "poolclass": QueuePool,
+        "pool_size": profile["pool_size"],
+        "max_overflow": profile["max_overflow"],
+        "connect_args": {"check_same_thread": False, "timeout": profile["busy_timeout"] / 1000},
+    }
+
+
+def set_pragmas(dbapi_connection, profile):
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in PRAGMAS:
+            value = profile.get(pragma)
+            if value is None:
+                continue
+            try:
+                cursor.execute(f"PRAGMA {pragma}={value}")
+            except Exception as exc:
+                # eg. WAL isn't possible on a read-only filesystem
+                log.warning(f"Failed to set PRAGMA {pragma}={value}: {exc}")
+    finally:
+        cursor.close()
+
+
+def listen(engine, profile):
+    """
+        Set the profile pragmas on every connection created by the engine pool
+    """
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        set_pragmas(dbapi_connection, profile)
+
+    return engine
+
+
+def apply_sqlite_profile(app, db):
+    """
+        Apply the profile configured in app.config to the flask_sqlalchemy engine of app
+        This has to be called after db.init_app(app) and before the engine is used
+
+        :return: the profile or None if it wasn't applied
+    """
+    profile = get_profile(app.config)
+    if not profile:
+        return None
+
+    uri = app.config.get("SQLALCHEMY_DATABASE_URI") or ""
+    sa_url = make_url(uri) if uri else None
+    if sa_url is None or sa_url.drivername != "sqlite" or sa_url.database in (None, "", ":memory:"):
+        log.warning(f"SQLITE_PROFILE ignored for {app.name}: not a sqlite database file")
+        return None
+
+    options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    for key, value in engine_options(profile).items():
+        options.setdefault(key, value)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+    listen(db.get_engine(app), profile)
+    log.info(f"SQLite profile for {app.name}: { {k: profile[k] for k in PRAGMAS} }")
+    return profile
@@ -0,0 +1,97 @@
+"""
+    Fixtures of the multiapp tests
+
+    The projects are copies of the db2 project with the Northwind database (example.nw.db.sqlite),
+    the multiapp serving them runs in a subprocess: the projects share the safrs db, the SAFRSBase
+    wrappers and the LogicBank listeners of the process.
+
+        cd multiapp && python -m pytest tests
+"""
+import json
+import shutil
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+import pytest
+
+multiapp_dir = Path(__file__).resolve().parent.parent
+nw_db = multiapp_dir.parent / "example.nw.db.sqlite"
+admin_db = multiapp_dir.parent / "admin.db"
+
+RUNNER = """
+import json, os, sys
+sys.path.insert(0, {multiapp_dir!r})
+os.chdir({multiapp_dir!r})
+import multiapp
+from werkzeug.test import Client
+app = multiapp.main()
+client = Client(app)
+result = {{}}
+exec(compile(open({script!r}).read(), {script!r}, "exec"))
+print("RESULT " + json.dumps(result, default=str))
+"""
+
+
+class Projects:
+    """
+        Projects dir and admin database of a multiapp
+    """
+
+    def __init__(self, tmp_path):
+        self.dir = tmp_path / "projects"
+        self.dir.mkdir()
+        self.admin_db = tmp_path / "admin.db"
+        shutil.copy(admin_db, self.admin_db)
+
+    def add(self, name, config=None, rules=None, replica_urls=""):
+        """
+            Copy the db2 project as name
+            :param config: config.Config attributes
+            :param rules: source of the declare_logic module
+            :return: project directory
+        """
+        project_dir = self.dir / name
+        shutil.copytree(multiapp_dir / "db2", project_dir, ignore=shutil.ignore_patterns("__pycache__"))
+        shutil.copy(nw_db, project_dir / "database/db.sqlite")
+        if config:
+            with open(project_dir / "config.py", "a") as config_fp:
+                config_fp.write("\n" + "".join(f"Config.{key} = {value!r}\n" for key, value in config.items()))
+        if rules:
+            (project_dir / "logic/declare_logic.py").write_text(rules)
+        with sqlite3.connect(self.admin_db) as connection:
+            connection.execute("insert into Apis(name, prefix, port, hostname, connection_string) values (?, ?, 5656, 'localhost', ?)",
+                               (name, name, f"sqlite:///{project_dir}/database/db.sqlite"))
+        if replica_urls:
+            with sqlite3.connect(self.admin_db) as connection:
+                columns = [row[1] for row in connection.execute('pragma table_info("Apis")')]
+                if "replica_urls" not in columns:
+                    connection.execute('alter table "Apis" add column replica_urls VARCHAR')
+                connection.execute("update Apis set replica_urls = ? where name = ?", (replica_urls, name))
+        return project_dir
+
+
+@pytest.fixture
+def projects(tmp_path):
+    return Projects(tmp_path)
+
+
+@pytest.fixture
+def run_multiapp(tmp_path, projects):
+    """
+        :return: function that runs a script with the multiapp of the projects (app, client) and returns its result dict
+    """
+    def run(script, env=None, timeout=300):
+        script_fn = tmp_path / "script.py"
+        script_fn.write_text(script)
+        runner_fn = tmp_path / "runner.py"
+        runner_fn.write_text(RUNNER.format(multiapp_dir=str(multiapp_dir), script=str(script_fn)))
+        run_env = {"ADMIN_DB": f"sqlite:///{projects.admin_db}", "PROJECTS_DIR": str(projects.dir),
+                   "PATH": "/usr/bin:/bin", "HOME": str(tmp_path), **(env or {})}
+        proc = subprocess.run([sys.executable, str(runner_fn)], env=run_env, capture_output=True, text=True, timeout=timeout)
+        for line in proc.stdout.splitlines():
+            if line.startswith("RESULT "):
+                return json.loads(line[len("RESULT "):])
+        raise AssertionError(f"multiapp script failed ({proc.returncode}):\n{proc.stderr[-4000:]}")
+
+    return run
@@ -0,0 +1,21 @@
+import sqlite3
+
+
+def test_null_binary_column_has_no_link(projects, run_multiapp):
+    project_dir = projects.add("nw")
+    with sqlite3.connect(project_dir / "database/db.sqlite") as connection:
+        connection.execute("update Employee set Photo = ? where Id = 1", (b"\x89PNG\r\n\x1a\n...",))
+    result = run_multiapp("""
+def photos(path):
+    data = client.get(path).json["data"]
+    return {row["id"]: row["attributes"]["Photo"] for row in (data if isinstance(data, list) else [data])}
+
+result["collection"] = photos("/nw/api/Employee?page[limit]=2&sort=Id")
+result["sparse"] = photos("/nw/api/Employee?page[limit]=2&sort=Id&fields[Employee]=LastName,Photo")
+result["resource"] = {**photos("/nw/api/Employee/1"), **photos("/nw/api/Employee/2")}
+result["blob"] = client.get("/nw/api/Employee/1/Photo").status_code
+""")
+    for key in ("collection", "sparse", "resource"):
+        assert result[key]["1"].endswith("/nw/api/Employee/1/Photo"), key
+        assert result[key]["2"] is None, key
+    assert result["blob"] == 200
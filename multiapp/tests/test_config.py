@@ -0,0 +1,23 @@
+import sqlite3
+
+
+def test_config_per_project(projects, run_multiapp):
+    projects.add("a", config={"COUNT_STRATEGY": "cached", "SQLITE_PROFILE": True})
+    project_dir = projects.add("b", config={"COUNT_STRATEGY": "estimated"})
+    with sqlite3.connect(project_dir / "database/db.sqlite") as connection:
+        connection.execute("update Category set Description = 'b' where Id = 1")
+    result = run_multiapp("""
+for name in ("a", "b"):
+    config = app.mounts[f"/{name}"].config
+    result[name] = {
+        "count_strategy": config["COUNT_STRATEGY"],
+        "sqlite_profile": config["SQLITE_PROFILE"],
+        "database": config["SQLALCHEMY_DATABASE_URI"],
+        "description": client.get(f"/{name}/api/Category/1").json["data"]["attributes"]["Description"],
+    }
+""")
+    assert result["a"]["count_strategy"] == "cached" and result["b"]["count_strategy"] == "estimated"
+    assert result["a"]["sqlite_profile"] is True and result["b"]["sqlite_profile"] is False
+    assert result["a"]["database"].endswith("/a/database/db.sqlite")
+    assert result["b"]["database"].endswith("/b/database/db.sqlite")
+    assert result["a"]["description"] != "b" and result["b"]["description"] == "b"
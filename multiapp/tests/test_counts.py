@@ -0,0 +1,14 @@
+def test_count_opt_out_is_a_lower_bound(projects, run_multiapp):
+    projects.add("nw")
+    result = run_multiapp("""
+def page(offset):
+    json = client.get(f"/nw/api/Customer?page[count]=false&page[limit]=10&page[offset]={offset}").json
+    return {"count": json["meta"]["count"], "rows": len(json["data"]), "last": json["links"].get("last", "")}
+
+result["first"] = page(0)
+result["last"] = page(90)
+""")
+    # 91 customers: the row after the page is probed, the last link is the next page
+    assert result["first"]["count"] == 11 and result["first"]["rows"] == 10
+    assert result["first"]["last"].endswith("page[offset]=10&page[limit]=10")
+    assert result["last"]["count"] == 91 and result["last"]["rows"] == 1
@@ -0,0 +1,37 @@
+import json
+import sqlite3
+
+EXPRESSION = {"and": [{"name": "Freight", "op": "between", "val": [10, 100]},
+                      {"or": [{"name": "ShipCountry", "op": "in", "val": ["USA", "Mexico"]},
+                              {"name": "Customer.Country", "op": "eq", "val": "USA"}]},
+                      {"not": {"name": "ShippedDate", "op": "is_null"}}]}
+
+
+def sql_count(project_dir, where):
+    with sqlite3.connect(project_dir / "database/db.sqlite") as connection:
+        return connection.execute(f'select count(*) from "Order" o left join Customer c on c.Id = o.CustomerId where {where}').fetchone()[0]
+
+
+def test_filter_expressions(projects, run_multiapp):
+    project_dir = projects.add("nw")
+    projects.add("strict", config={"FILTER_UNINDEXED": "reject"})
+    filters = {
+        "expression": ("nw", EXPRESSION),
+        "csv": ("nw", {"name": "ShipCountry", "op": "in", "val": "USA,Mexico"}),
+        "list": ("nw", [{"name": "ShipCountry", "op": "eq", "val": "USA"}, {"name": "ShipCountry", "op": "eq", "val": "Mexico"}]),
+        "unknown": ("nw", {"name": "Nope", "op": "eq", "val": 1}),
+        "indexed": ("strict", {"name": "CustomerId", "op": "in", "val": ["ALFKI", "ANATR"]}),
+        "unindexed": ("strict", {"name": "Freight", "op": "gt", "val": 10}),
+    }
+    result = run_multiapp(f"""
+from urllib.parse import quote
+for key, (project, expression) in {json.dumps(filters)}.items():
+    response = client.get(f"/{{project}}/api/Order?page[limit]=1&filter={{quote(json.dumps(expression))}}")
+    result[key] = [response.status_code, response.json["meta"]["count"] if response.status_code == 200 else None]
+""")
+    assert result["expression"] == [200, sql_count(project_dir, "o.Freight between 10 and 100 and (o.ShipCountry in ('USA', 'Mexico') "
+                                                               "or c.Country = 'USA') and o.ShippedDate is not null")]
+    assert result["csv"] == result["list"] == [200, sql_count(project_dir, "o.ShipCountry in ('USA', 'Mexico')")]
+    assert result["unknown"][0] == 400
+    assert result["indexed"] == [200, sql_count(project_dir, "o.CustomerId in ('ALFKI', 'ANATR')")]
+    assert result["unindexed"][0] == 400
@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+from conftest import multiapp_dir
+
+SCRIPT = """
+import os, sys
+sys.path.insert(0, {multiapp_dir!r})
+from generator import Generator
+workers = [Generator(socket_path={socket!r}) for _ in range(2)]
+results = [worker.run(["create", str(i)], {cwd!r}) for i, worker in enumerate(workers)]
+helpers = [worker.helper.pid for worker in workers if worker.helper is not None]
+for result in results:
+    print("RESULT", result.returncode, result.stdout.strip(), result.stderr.strip())
+print("HELPERS", len(helpers), len(set(result.stderr.strip() for result in results)))
+workers[0].stop()
+workers[0].helper.wait(10)
+print("STOPPED", os.path.exists({socket!r}))
+"""
+
+FAKE_GENERATOR = """
+import os, sys
+
+def main():
+    print("generated", " ".join(sys.argv[1:]), os.getcwd())
+    print(os.getppid(), file=sys.stderr)
+    sys.exit(int(sys.argv[-1]))
+"""
+
+
+def test_workers_share_the_helper(tmp_path):
+    # a console script ApiLogicServer = fake_als:main
+    site = tmp_path / "site"
+    dist_info = site / "fake_als-1.0.dist-info"
+    dist_info.mkdir(parents=True)
+    (dist_info / "METADATA").write_text("Metadata-Version: 2.1\nName: fake-als\nVersion: 1.0\n")
+    (dist_info / "entry_points.txt").write_text("[console_scripts]\nApiLogicServer = fake_als:main\n")
+    (site / "fake_als.py").write_text(FAKE_GENERATOR)
+    script = tmp_path / "script.py"
+    script.write_text(SCRIPT.format(multiapp_dir=str(multiapp_dir), socket=str(tmp_path / "gen.sock"), cwd=str(tmp_path)))
+    env = {**os.environ, "PYTHONPATH": str(site)}
+    proc = subprocess.run([sys.executable, str(script)], env=env, capture_output=True, text=True, timeout=120)
+    lines = proc.stdout.splitlines()
+    assert len(lines) == 4, proc.stderr
+    for i, line in enumerate(lines[:2]):
+        assert line.startswith(f"RESULT {i} generated create {i} {tmp_path} ")
+    # one helper, started by the first worker, forked the children of both workers
+    assert lines[2] == "HELPERS 1 1"
+    assert lines[3] == "STOPPED False"
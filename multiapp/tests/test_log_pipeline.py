@@ -0,0 +1,40 @@
+import logging
+import sys
+import threading
+from flask import Flask
+from conftest import multiapp_dir
+
+sys.path.insert(0, str(multiapp_dir))
+import log_pipeline  # noqa: E402
+
+
+def record(created):
+    result = logging.LogRecord("test", logging.INFO, "site.py", 10, "message", None, None)
+    result.created = created
+    return result
+
+
+def test_call_sites_are_rate_limited_per_project():
+    project_filter = log_pipeline.ProjectFilter(rate=2, sample=0)
+    kept = {}
+    for name in ("a", "b"):
+        with Flask(name).app_context():
+            kept[name] = sum(project_filter.filter(record(1000.0)) for _ in range(5))
+    assert kept == {"a": 2, "b": 2}
+    assert [(site["project"], site["suppressed"]) for site in project_filter.top_sites()] == [("a", 3), ("b", 3)]
+
+
+def test_concurrent_records_are_counted_once():
+    project_filter = log_pipeline.ProjectFilter(rate=100, sample=0)
+    kept = []
+
+    def log_records():
+        kept.append(sum(project_filter.filter(record(1000.0)) for _ in range(2000)))
+
+    threads = [threading.Thread(target=log_records) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(kept) == 100
+    assert project_filter.suppressed == 8 * 2000 - 100
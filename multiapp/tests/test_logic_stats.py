@@ -0,0 +1,21 @@
+import sys
+import time
+from conftest import multiapp_dir
+
+sys.path.insert(0, str(multiapp_dir))
+import logic_stats  # noqa: E402
+
+
+class Rule:
+    pass
+
+
+def test_nested_rules_are_counted_once():
+    child = logic_stats.timed(lambda rule: time.sleep(0.05), key=lambda rule: "child")
+    cascade = logic_stats.timed(lambda rule: (time.sleep(0.02), child(Rule()), child(Rule())), key=lambda rule: "cascade")
+    logic_stats._local.timings = {}
+    cascade(Rule())
+    timings = logic_stats._local.timings
+    assert timings["child"][0] == 2 and 0.1 <= timings["child"][1] < 0.14
+    # self time of the cascade, without its children
+    assert 0.02 <= timings["cascade"][1] < 0.04
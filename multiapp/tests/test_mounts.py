@@ -0,0 +1,71 @@
+RULES = """
+import __main__
+from logic_bank.logic_bank import Rule
+from database import models
+
+
+def declare_logic():
+    Rule.row_event(on_class=models.Category, calling=lambda row, old_row, logic_row: __main__.row_events.append(row.Id))
+"""
+
+
+def test_remount_runs_logic_once(projects, run_multiapp):
+    projects.add("nw", config={"AUDIT_MODE": "async"}, rules=RULES)
+    result = run_multiapp("""
+from safrs import DB
+row_events = []
+
+def listeners():
+    with app.mounts["/nw"].app_context():
+        return [f"{fn.__module__}.{fn.__name__}" for fn in DB.session().dispatch.before_flush]
+
+def write(description):
+    body = {"data": {"type": "Category", "id": "1", "attributes": {"Description": description}}}
+    return client.patch("/nw/api/Category/1", json=body).status_code
+
+result["listeners"] = listeners()
+result["write"] = write("mounted")
+app.unmount("/nw")
+result["remount_write"] = write("remounted")
+result["remount_listeners"] = listeners()
+result["row_events"] = row_events
+""")
+    assert result["write"] == result["remount_write"] == 200
+    # the row logic of the remounted project runs once per write, before the audit listener
+    assert result["row_events"] == [1, 1]
+    assert result["listeners"] == result["remount_listeners"] == [
+        "logic_bank.exec_trans_logic.listeners.before_flush", "audit.before_flush"]
+
+
+def test_rebuild_after_release_all(projects, run_multiapp):
+    projects.add("nw")
+    result = run_multiapp("""
+from mounts import release_all
+from pools import manager
+engines = len(manager.engines)
+release_all(app)
+result["released"] = len(manager.engines)
+app = multiapp.main()
+result["engines"] = len(manager.engines) == engines
+result["status"] = Client(app).get("/nw/api/Category/1").status_code
+""")
+    assert result == {"released": 0, "engines": True, "status": 200}
+
+
+def test_unmount_before_the_request_starts(projects, run_multiapp):
+    projects.add("nw")
+    result = run_multiapp("""
+import mounts
+account = mounts.projects["/nw"]
+begin = account.begin
+
+def unmount_and_begin():
+    # the memory budget of another request unmounts the idle project
+    app.apply_budget()
+    return begin()
+
+account.begin = unmount_and_begin
+result["status"] = client.get("/nw/api/Category/1").status_code
+result["mounts"] = account.mounts
+""", env={"MEMORY_BUDGET_MB": "0.001", "MEMORY_MIN_IDLE": "0"})
+    assert result == {"status": 200, "mounts": 2}
@@ -0,0 +1,53 @@
+import sys
+import threading
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+from conftest import multiapp_dir
+
+sys.path.insert(0, str(multiapp_dir))
+from pools import ConnectionManager, close_idle  # noqa: E402
+
+
+def test_budget_divided_by_workers(projects, run_multiapp):
+    projects.add("nw")
+    # gals.py imports multiapp before it sets MULTIAPP_WORKERS
+    result = run_multiapp("""
+from pools import manager
+result["budget"] = manager.budget
+result["server_budget"] = manager.server_budget
+""", env={"DB_CONNECTION_BUDGET": "40", "DB_SERVER_BUDGET": "20", "MULTIAPP_WORKERS": "4"})
+    assert result == {"budget": 10, "server_budget": 5}
+
+
+def test_configure_from_env(monkeypatch):
+    manager = ConnectionManager()
+    monkeypatch.setenv("DB_CONNECTION_BUDGET", "40")
+    monkeypatch.setenv("MULTIAPP_WORKERS", "4")
+    assert manager.configure_from_env().budget == 10
+
+
+def test_close_idle_keeps_checked_out(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'pool.sqlite'}", poolclass=QueuePool, pool_size=5,
+                           connect_args={"check_same_thread": False})
+    manager = ConnectionManager(idle_timeout=0)
+    manager.register(engine, "test")
+    info = manager.engines[0]
+    connections = [engine.connect() for _ in range(3)]
+    for connection in connections[1:]:
+        connection.close()
+    assert (info.checked_out, info.idle) == (1, 2)
+    assert close_idle(info) == 2
+    assert info.idle == 0
+    assert info.opened - info.closed == 1
+    # the checked out connection still works, it's closed when it's returned
+    assert connections[0].execute("select 1").scalar() == 1
+    connections[0].close()
+    assert info.opened - info.closed == 0
+    # the new pool of the engine
+    threads = [threading.Thread(target=lambda: engine.connect().close()) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert 1 <= info.idle <= 5
+    assert info.opened - info.closed == info.idle
@@ -0,0 +1,29 @@
+RULES = """
+from logic_bank.logic_bank import Rule
+from database import models
+
+
+def declare_logic():
+    Rule.sum(derive=models.Customer.Balance, as_sum_of=models.Order.AmountTotal, where=lambda row: row.ShippedDate is None)
+"""
+
+
+def test_null_stored_value_is_out_of_date(projects, run_multiapp):
+    projects.add("nw", rules=RULES)
+    result = run_multiapp("""
+import recompute
+
+def balance(report):
+    return next(entry for entry in report["columns"] if entry["column"] == "Customer.Balance")
+
+recompute.recompute_project("nw", repair=True)
+engine, rules = recompute.projects["nw"]
+with engine.begin() as connection:
+    # a customer without unshipped orders: the computed balance is 0
+    customer = connection.execute("select Id from Customer where Balance = 0 order by Id").scalar()
+    connection.execute("update Customer set Balance = NULL where Id = ?", customer)
+result["mismatched"] = balance(recompute.recompute_project("nw"))["mismatched"]
+result["repaired"] = balance(recompute.recompute_project("nw", repair=True))["repaired"]
+result["verified"] = balance(recompute.recompute_project("nw"))["mismatched"]
+""")
+    assert result == {"mismatched": 1, "repaired": 1, "verified": 0}
@@ -0,0 +1,63 @@
+import shutil
+import sqlite3
+import sys
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from conftest import multiapp_dir
+
+sys.path.insert(0, str(multiapp_dir))
+from replicas import install_replicas  # noqa: E402
+
+
+def test_get_reads_replica(projects, run_multiapp):
+    replica = projects.dir.parent / "replica.sqlite"
+    project_dir = projects.add("nw", replica_urls=f"sqlite:///{replica}")
+    shutil.copy(project_dir / "database/db.sqlite", replica)
+    with sqlite3.connect(replica) as connection:
+        connection.execute("update Category set Description = 'replica' where Id = 1")
+    result = run_multiapp("""
+def description():
+    response = client.get("/nw/api/Category/1")
+    return response.status_code, response.json["data"]["attributes"]["Description"]
+
+result["get"] = description()
+patch = {"data": {"type": "Category", "id": "1", "attributes": {"CategoryName": "Drinks"}}}
+result["patch"] = client.patch("/nw/api/Category/1", json=patch).status_code
+result["read_your_writes"] = description()
+client.cookie_jar.clear()
+result["after_window"] = description()
+""")
+    assert result["get"] == [200, "replica"]
+    assert result["patch"] == 200
+    # the client that wrote reads the primary
+    assert result["read_your_writes"][1] != "replica"
+    assert result["after_window"] == [200, "replica"]
+
+
+def test_db_model_get_reads_replica(tmp_path):
+    # the flask_sqlalchemy session binds the tables of db.Model to the primary engine (db.get_binds)
+    db = SQLAlchemy()
+
+    class Marker(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        name = db.Column(db.String)
+
+    urls = {}
+    for name in ("primary", "replica"):
+        urls[name] = f"sqlite:///{tmp_path / name}.sqlite"
+        with sqlite3.connect(tmp_path / f"{name}.sqlite") as connection:
+            connection.execute("create table marker (id integer primary key, name varchar)")
+            connection.execute("insert into marker values (1, ?)", (name,))
+    app = Flask("replica_test")
+    app.config.update(SQLALCHEMY_DATABASE_URI=urls["primary"], SQLALCHEMY_TRACK_MODIFICATIONS=False)
+    db.init_app(app)
+    install_replicas(app, db, [urls["replica"]])
+
+    @app.route("/marker", methods=["GET", "POST"])
+    def marker():
+        return db.session.query(Marker).get(1).name
+
+    app.teardown_appcontext(lambda exc: db.session.remove())
+    client = app.test_client()
+    assert client.get("/marker").data == b"replica"
+    assert client.post("/marker").data == b"primary"
@@ -0,0 +1,34 @@
+def test_count_of_search_after_project_without_search(projects, run_multiapp):
+    # the project without search is loaded first.
+    # COUNT_STRATEGY cached: counts.py counts the collection query itself
+    projects.add("plain", config={"COUNT_STRATEGY": "cached"})
+    projects.add("srch", config={"SEARCH_INDEX": {"Customer": ["CompanyName"]}, "COUNT_STRATEGY": "cached"})
+    result = run_multiapp("""
+result["total"] = client.get("/srch/api/Customer?page[limit]=1").json["meta"]["count"]
+result["count"] = client.get("/srch/api/Customer?search=market&page[limit]=1").json["meta"]["count"]
+result["names"] = [row["attributes"]["CompanyName"] for row in client.get("/srch/api/Customer?search=market").json["data"]]
+result["plain"] = client.get("/plain/api/Customer?search=market&page[limit]=1").json["meta"]["count"]
+""")
+    assert result["names"] and all("market" in name.lower() for name in result["names"])
+    assert result["count"] == len(result["names"]) < result["total"]
+    # the search parameter is ignored by the projects without search
+    assert result["plain"] == result["total"]
+
+
+def test_search_attributes_of_admin_yaml(projects, run_multiapp):
+    projects.add("plain")
+    project_dir = projects.add("srch", config={"SEARCH_INDEX": True})
+    (project_dir / "ui/admin").mkdir(parents=True, exist_ok=True)
+    (project_dir / "ui/admin/admin.yaml").write_text("""
+resources:
+  Customer:
+    type: Customer
+    attributes:
+    - name: CompanyName
+      search: true
+""")
+    result = run_multiapp("""
+result["srch"] = len(client.get("/srch/api/Customer?search=market").json["data"])
+result["plain"] = len(client.get("/plain/api/Customer?search=market&page[limit]=100").json["data"])
+""")
+    assert 0 < result["srch"] < result["plain"]
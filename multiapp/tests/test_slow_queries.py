@@ -0,0 +1,15 @@
+import json
+
+
+def test_parameter_values_are_redacted(projects, run_multiapp):
+    projects.add("redacted", config={"SLOW_QUERY_MS": 0.001})
+    projects.add("values", config={"SLOW_QUERY_MS": 0.001, "SLOW_QUERY_PARAMETERS": True})
+    result = run_multiapp("""
+import slow_queries
+for project in ("redacted", "values"):
+    client.get(f'/{project}/api/Customer?filter={{"name": "Country", "op": "eq", "val": "Mexico"}}')
+    result[project] = [entry for entry in slow_queries.projects[project].entries if "Country" in entry["statement"]]
+""")
+    assert result["redacted"] and "Mexico" not in json.dumps(result["redacted"])
+    assert {"count": 3, "types": ["str", "int", "int"]} in [entry["parameters"] for entry in result["redacted"]]
+    assert "Mexico" in json.dumps(result["values"])
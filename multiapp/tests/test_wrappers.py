@@ -0,0 +1,25 @@
+def test_admin_classes_use_the_safrs_methods(projects, run_multiapp):
+    projects.add("nw")
+    result = run_multiapp("""
+import blobs, wrappers
+from admin_api import Api, User
+from safrs.errors import ValidationError
+
+def filter_error(cls, app):
+    with app.app_context():
+        try:
+            cls._s_filter("not json")
+        except ValidationError as exc:
+            return str(exc.message)
+
+customer = next(cls for cls in blobs.exposed_classes(app.mounts["/nw"]) if cls.__name__ == "Customer")
+result["project_classes"] = sorted(cls.__name__ for cls in wrappers.project_classes)
+result["admin"] = filter_error(Api, app.mounts["/admin"])
+result["project"] = filter_error(customer, app.mounts["/nw"])
+result["collection"] = client.get('/nw/api/Customer?filter={"name": "Country", "op": "in", "val": ["USA"]}&page[limit]=100').json["meta"]["count"]
+""")
+    assert "Customer" in result["project_classes"]
+    assert "Api" not in result["project_classes"] and "User" not in result["project_classes"]
+    assert "safrs/wiki" in result["admin"]
+    assert "multiapp/filters.py" in result["project"]
+    assert result["collection"] == 13
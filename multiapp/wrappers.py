@@ -0,0 +1,96 @@
+"""
+    The SAFRSBase method wrappers of the project classes
+
+    The admin app (User, Api) and the projects share the safrs SAFRSBase class. The modules that change
+    how the project collections are queried and serialized wrap its methods, they're installed here once
+    and in this order, innermost first:
+
+    * _s_get: loading.py (loader options of include= and fields[]), search.py (search parameter),
+      counts.py (keeps the final collection query for the count)
+    * _s_count: counts.py
+    * _s_filter: filters.py (filter expressions)
+    * _s_jsonapi_attrs: fast_json.py (attribute values by type), blobs.py (binary columns as links, the blobs
+      are left out of the attributes converted by fast_json)
+    * _s_jsonapi_encode: resources.py (cached resource objects)
+
+    The wrappers apply to the classes registered by the project apps, the other classes (admin app) use the
+    safrs methods.
+"""
+import logging
+import threading
+import safrs
+from safrs import SAFRSBase
+from sqlalchemy.ext.hybrid import hybrid_method
+import blobs
+import counts
+import fast_json
+import filters
+import loading
+import resources
+import search
+
+log = logging.getLogger()
+
+project_classes = set()
+_installed = False
+_lock = threading.Lock()
+
+
+def for_projects(method, wrapped):
+    """
+        :return: function that calls wrapped for the project classes (and their instances), method for the others
+    """
+    def dispatch(cls_or_self, *args, **kwargs):
+        cls = cls_or_self if isinstance(cls_or_self, type) else type(cls_or_self)
+        return (wrapped if cls in project_classes else method)(cls_or_self, *args, **kwargs)
+
+    dispatch.__name__ = method.__name__
+    dispatch.__wrapped__ = method
+    return dispatch
+
+
+def install_wrappers():
+    """
+        Install the wrappers of the SAFRSBase methods (once, the safrs classes are shared by the projects)
+    """
+    global _installed
+    with _lock:
+        if _installed:
+            return
+        _installed = True
+
+    get = SAFRSBase.__dict__["_s_get"].__func__
+    wrapped = get
+    if loading.INCLUDE_LOADING != "lazy":
+        safrs.SAFRS.OPTIMIZED_LOADING = False
+        wrapped = loading.batched_get(wrapped)
+    wrapped = counts.counted_get(search.searched_get(wrapped))
+    SAFRSBase._s_get = classmethod(for_projects(get, wrapped))
+
+    s_count = SAFRSBase.__dict__["_s_count"].__func__
+    SAFRSBase._s_count = classmethod(for_projects(s_count, counts.counted(s_count)))
+
+    s_filter = SAFRSBase.__dict__["_s_filter"].__func__
+    SAFRSBase._s_filter = classmethod(for_projects(s_filter, filters._s_filter))
+
+    jsonapi_attrs = SAFRSBase.__dict__["_s_jsonapi_attrs"]
+    wrapped = blobs.linked_attrs(fast_json.fast_attrs(jsonapi_attrs.fget))
+    SAFRSBase._s_jsonapi_attrs = jsonapi_attrs.getter(for_projects(jsonapi_attrs.fget, wrapped))
+
+    jsonapi_encode = SAFRSBase.__dict__["_s_jsonapi_encode"]
+    wrapped = resources.cached_encode(jsonapi_encode.func)
+    SAFRSBase._s_jsonapi_encode = hybrid_method(for_projects(jsonapi_encode.func, wrapped), jsonapi_encode.expr)
+    log.info("SAFRSBase wrappers installed")
+
+
+def register(app):
+    """
+        Use the wrappers for the classes exposed by the project app
+    """
+    install_wrappers()
+    project_classes.update(blobs.exposed_classes(app))
+    return app
+
+
+def unregister(classes):
+    project_classes.difference_update(classes)